@@ -1,13 +1,37 @@
-from flask import Flask, request, redirect, url_for, render_template, session, flash, g, send_from_directory, send_file, jsonify, abort
-from datetime import datetime, date
+from flask import Flask, request, redirect, url_for, render_template, session, flash, g, send_from_directory, send_file, jsonify, abort, has_request_context, Response, stream_with_context
+from datetime import datetime, date, timedelta
 import sqlite3
 import os
 import math
+import json
+import time
+import queue
+import base64
+import atexit
+import threading
 from functools import wraps
-from openpyxl import Workbook
-from openpyxl.styles import Font, Alignment, PatternFill
-from io import BytesIO
+import click
 from translations import translate, get_all_translations
+from conexoes import PoolConexoes, PRAGMAS_LEITURA, uri_somente_leitura
+from migracoes import aplicar_migracoes, verificar_planos, versao_schema
+from busca import filtro_estoque, sugerir_produtos
+from cache_codigos import CACHE_CODIGOS, lotes_por_codigo
+from eventos import CANAL_EVENTOS, limite_de_conexoes
+from servico_estoque import (executar_transacao, adicionar, retirar, retirar_lote, retirar_fefo, registrar_entrada, varrer_estoque_zerado, metricas_limpeza,
+                             ErroEstoque, ProdutoNaoEncontrado, QuantidadeInvalida, RetiradaEmLoteRecusada,
+                             SQL_LOTE_POR_ID, SQL_LOTE_POR_CODIGO_E_VALIDADE, SQL_LOTE_POR_CODIGO_E_LOTE)
+from importacao import ler_linhas, importar_estoque
+from exportacao import gerar_xlsx_historico, gerar_csv, gerar_ndjson, COLUNAS_XLSX, COLUNAS_BRUTAS
+from filtros_historico import filtro_da_requisicao, clausulas, consulta
+from paginacao import COLUNAS_POR_CURSOR, FILTRO_IDS, ORDENACOES_HOME, ORDEM_HISTORICO, sql_contagem, sql_pagina
+from registros import Movimentacao, fabrica_movimentacao
+from validade import limites_validade, selecao_com_status, contar_vencimentos_por_categoria, DIAS_URGENTE, DIAS_PROXIMO
+from cache_exportacao import CacheExportacao, chave_exportacao
+from razao import gravar_snapshot, saldos_em, verificar_razao
+from resumos import GRANULARIDADES, AGRUPAMENTOS, consultar_tendencia, inicio_padrao, reconstruir_resumos
+from previsao import previsao_consumo, risco_desperdicio, limpar_cache_previsao, DIAS_HORIZONTE_DESPERDICIO, JANELA_DIAS_CONSUMO, DIAS_REPOSICAO, DIAS_SEGURANCA
+from estatisticas import (ler_estatisticas, listar_categorias, recalcular_estatisticas, comparar_estatisticas,
+                          criar_triggers_estoque)
 
 # Decorator para verificar se o usuário está logado
 def login_required(f):
@@ -29,6 +53,14 @@ DATABASE_PATH = os.path.join(app.root_path, 'banco.db')
 app.static_folder = os.path.join(app.root_path, 'static')
 app.template_folder = os.path.join(app.root_path, 'templates')
 
+# Cache em disco das exportações de períodos encerrados (LRU limitado por tamanho)
+app.config.setdefault('CACHE_EXPORTACAO_DIR', os.path.join(app.root_path, 'cache_exportacao'))
+app.config.setdefault('CACHE_EXPORTACAO_MAX_BYTES', 256 * 1024 * 1024)
+
+# Conexões SSE (/api/eventos_estoque) por processo; None usa o padrão do tipo de worker
+# (ver eventos.limite_de_conexoes). Com gthread, mantenha bem abaixo de --threads.
+app.config.setdefault('EVENTOS_MAX_CONEXOES', int(os.environ.get('EVENTOS_MAX_CONEXOES', 0)) or None)
+
 # Criar diretórios necessários se não existirem
 os.makedirs(os.path.join(app.static_folder, 'img'), exist_ok=True)
 os.makedirs(os.path.join(app.static_folder, 'css'), exist_ok=True)
@@ -48,61 +80,95 @@ def inject_translation():
 # ----------------------------
 # Funções de Banco de Dados
 # ----------------------------
-def get_db():
-    """Retorna a conexão com o banco de dados."""
+# Pools de conexões do processo; criados sob demanda para que cada worker do gunicorn
+# (após o fork) tenha as suas próprias conexões.
+# - escrita: uma única conexão, serializa as mutações de estoque do processo
+# - leitura: várias conexões mode=ro/query_only para as páginas GET; em WAL elas
+#   nunca bloqueiam (nem são bloqueadas por) o escritor
+_pool_escrita = None
+_pool_leitura = None
+TAMANHO_POOL_LEITURA = 8
+# Serializa a criação dos pools (e a migração): duas primeiras requisições simultâneas
+# no mesmo processo não podem migrar duas vezes nem deixar um pool de escrita órfão
+_lock_pools = threading.Lock()
+
+def _pools_validos():
+    return (_pool_escrita is not None and _pool_escrita.pid == os.getpid()
+            and _pool_escrita.caminho == DATABASE_PATH)
+
+def obter_pool(escrita=True):
+    """Retorna o pool de escrita (ou de leitura) deste processo, criando-os e migrando o schema na primeira vez."""
+    global _pool_escrita, _pool_leitura
+    if not _pools_validos():
+        with _lock_pools:
+            if not _pools_validos():
+                if _pool_escrita is not None and _pool_escrita.pid == os.getpid():
+                    _pool_escrita.fechar()
+                    _pool_leitura.fechar()
+                    # Outro banco: o cache de códigos e as taxas de consumo em memória não valem mais
+                    CACHE_CODIGOS.limpar()
+                    limpar_cache_previsao()
+                # PARSE_COLNAMES: só colunas marcadas como "coluna [conversor]" são convertidas (ver registros.py)
+                pool = PoolConexoes(DATABASE_PATH, tamanho=1, detect_types=sqlite3.PARSE_COLNAMES)
+                conn = pool.obter()
+                try:
+                    aplicar_migracoes(conn)
+                finally:
+                    pool.devolver(conn)
+                _pool_leitura = PoolConexoes(uri_somente_leitura(DATABASE_PATH), tamanho=TAMANHO_POOL_LEITURA,
+                                             pragmas=PRAGMAS_LEITURA, uri=True, detect_types=sqlite3.PARSE_COLNAMES)
+                _pool_escrita = pool
+    return _pool_escrita if escrita else _pool_leitura
+
+@atexit.register
+def fechar_pool():
+    """Fecha as conexões dos pools ao encerrar o processo."""
+    for pool in (_pool_escrita, _pool_leitura):
+        if pool is not None:
+            pool.fechar()
+
+def get_db_escrita():
+    """Retorna a conexão de escrita (única por processo) emprestada até o fim da requisição."""
     if 'db' not in g:
-        # usar caminho absoluto evita erros quando o working dir muda
-        g.db = sqlite3.connect(DATABASE_PATH)
-        g.db.row_factory = sqlite3.Row
+        g.db = obter_pool(escrita=True).obter()
     return g.db
 
+def get_db():
+    """Retorna a conexão com o banco de dados.
+
+    Em requisições GET/HEAD entrega uma conexão somente leitura; nos demais casos
+    (POST, comandos flask) entrega a conexão de escrita.
+    """
+    if has_request_context() and request.method in ('GET', 'HEAD'):
+        if 'db_leitura' not in g:
+            g.db_leitura = obter_pool(escrita=False).obter()
+        return g.db_leitura
+    return get_db_escrita()
+
 @app.teardown_appcontext
 def fechar_conexao(error):
-    """Fecha a conexão com o banco de dados no final da requisição."""
+    """Devolve as conexões aos pools no final da requisição.
+
+    Só faz commit se a requisição deixou uma transação aberta (GETs de leitura não abrem);
+    em caso de erro a transação é desfeita.
+    """
     db = g.pop('db', None)
     if db is not None:
-        db.commit()
-        db.close()
+        if db.in_transaction:
+            if error is None:
+                db.commit()
+            else:
+                db.rollback()
+        obter_pool(escrita=True).devolver(db)
+    db_leitura = g.pop('db_leitura', None)
+    if db_leitura is not None:
+        obter_pool(escrita=False).devolver(db_leitura)
 
 def init_db():
-    """Inicializa as tabelas do banco de dados."""
+    """Inicializa as tabelas do banco de dados (aplica as migrações pendentes)."""
     db = get_db()
+    aplicar_migracoes(db)
     cursor = db.cursor()
-    cursor.execute("PRAGMA foreign_keys = ON;")
-    cursor.execute('''CREATE TABLE IF NOT EXISTS estoque(
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        codigo_de_barras TEXT NOT NULL,
-        lote TEXT NOT NULL,
-        validade_int INTEGER NOT NULL,
-        validade_text TEXT NOT NULL,
-        produto_nome TEXT NOT NULL,
-        quantidade INTEGER,
-        image_path TEXT,
-        categoria INTEGER NOT NULL
-         )''') # Corrigi codigo_de_barras para TEXT para evitar erros com zeros a esquerda
-    
-
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS movimentacao (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            product_id INTEGER NOT NULL,
-            product_barcode TEXT NOT NULL,
-            name TEXT NOT NULL,
-            action TEXT NOT NULL,
-            quantidade INTEGER NOT NULL,
-            motivo TEXT,
-            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (product_id) REFERENCES estoque(id)
-        )
-    ''')
-    
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS responsaveis (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            nome TEXT NOT NULL UNIQUE,
-            criado_em DATETIME DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
     
     # Adicionar responsáveis padrão se a tabela estiver vazia
     cursor.execute('SELECT COUNT(*) FROM responsaveis')
@@ -119,31 +185,10 @@ def init_db():
 
 def limpar_estoque_zerado():
     """
-    Deleta do banco de dados todos os produtos onde a 'quantidade' é 0 ou menor.
-    Isso ajuda a manter o estoque principal limpo.
+    Varre em lotes os produtos com 'quantidade' 0 ou menor que ainda estejam no banco.
+    As retiradas já removem o lote zerado na mesma transação; isto só pega sobras.
     """
-    db = get_db()
-    cursor = db.cursor()
-    
-    try:
-        # A instrução SQL que deleta as linhas onde a quantidade é menor ou igual a zero
-        cursor.execute('DELETE FROM estoque WHERE quantidade <= 0')
-        
-        # O db.commit() é crucial para salvar a exclusão
-        db.commit()
-        
-        # Opcional: Retorna o número de itens deletados para fins de log
-        itens_deletados = cursor.rowcount
-        print(f"Limpeza de estoque concluída. {itens_deletados} itens zerados removidos.")
-        return itens_deletados
-        
-    except Exception as e:
-        print(f"Erro ao tentar limpar o estoque zerado: {e}")
-        db.rollback() # Desfaz a operação em caso de erro
-        return 0
-    finally:
-        # Nota: g.db é fechado no teardown
-        pass
+    return varrer_estoque_zerado(get_db_escrita())
 
 
 
@@ -151,6 +196,92 @@ def limpar_estoque_zerado():
 # FUNÇÕES AUXILIARES
 # --------------------------------------------------------------------------
 
+def obter_cache_exportacao():
+    """Cache de exportações configurado em app.config."""
+    return CacheExportacao(app.config['CACHE_EXPORTACAO_DIR'], app.config['CACHE_EXPORTACAO_MAX_BYTES'])
+
+def codificar_cursor(modo, valores):
+    """Codifica a chave da última/primeira linha da página em um token seguro para URL."""
+    bruto = json.dumps([modo, list(valores)], separators=(',', ':'))
+    return base64.urlsafe_b64encode(bruto.encode('utf-8')).decode('ascii').rstrip('=')
+
+def decodificar_cursor(token, modo):
+    """Decodifica um token de cursor; retorna None se inválido ou de outra ordenação."""
+    if not token:
+        return None
+    try:
+        bruto = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        modo_token, valores = json.loads(bruto.decode('utf-8'))
+    except Exception:
+        return None
+    if modo_token != modo or not isinstance(valores, list):
+        return None
+    # Token adulterado: a chave tem de ter um valor escalar por coluna da ordenação
+    if len(valores) != len(COLUNAS_POR_CURSOR.get(modo, ())):
+        return None
+    if not all(v is None or isinstance(v, (str, float)) or (isinstance(v, int) and -2 ** 63 <= v < 2 ** 63)
+               for v in valores):
+        return None
+    return valores
+
+def buscar_pagina(cursor, tabela, where_clauses, params, colunas, descendente, per_page, after=None, before=None,
+                  selecao='*', fabrica=None, params_selecao=()):
+    """
+    Paginação por chave (keyset): em vez de OFFSET, continua a partir da chave
+    (colunas) da última linha vista. O custo de cada página não depende da profundidade.
+    selecao/fabrica permitem devolver registros tipados (ex: Movimentacao) em vez de sqlite3.Row;
+    nesse caso o registro precisa ter chave_pagina(). params_selecao são os parâmetros de
+    expressões da selecao (ex: o status de validade), que vêm antes dos do WHERE.
+
+    Retorna (linhas, has_prev, has_next, chave_primeira, chave_ultima).
+    """
+    p = list(params)
+    voltando = before is not None
+    ancora = before if voltando else after
+    # Para voltar, percorre na ordem inversa e depois reverte as linhas
+    desc = descendente != voltando
+    if ancora is not None:
+        p.extend(ancora)
+
+    # Busca uma linha a mais para saber se existe página seguinte
+    if fabrica is not None:
+        cursor = cursor.connection.cursor()
+        cursor.row_factory = fabrica
+    linhas = cursor.execute(sql_pagina(tabela, where_clauses, colunas, desc, ancora is not None, selecao),
+                            list(params_selecao) + p + [per_page + 1]).fetchall()
+    tem_mais = len(linhas) > per_page
+    linhas = linhas[:per_page]
+    if voltando:
+        linhas.reverse()
+        has_prev, has_next = tem_mais, True
+    else:
+        has_prev, has_next = ancora is not None, tem_mais
+
+    if fabrica is not None:
+        primeira = linhas[0].chave_pagina() if linhas else None
+        ultima = linhas[-1].chave_pagina() if linhas else None
+    else:
+        primeira = [linhas[0][c] for c in colunas] if linhas else None
+        ultima = [linhas[-1][c] for c in colunas] if linhas else None
+    return linhas, has_prev, has_next, primeira, ultima
+
+# Cache simples de contagens: o total é só informativo, não precisa ser recalculado a cada página
+_CONTAGEM_TTL = 60
+_contagem_cache = {}
+
+def contar_com_cache(cursor, tabela, where_clauses, params):
+    """Retorna COUNT(*) para o filtro, reaproveitando o valor por alguns segundos."""
+    chave = (tabela, tuple(where_clauses), tuple(params))
+    agora = time.monotonic()
+    item = _contagem_cache.get(chave)
+    if item and agora - item[0] < _CONTAGEM_TTL:
+        return item[1]
+    total = cursor.execute(sql_contagem(tabela, where_clauses), params).fetchone()['cnt']
+    if len(_contagem_cache) > 256:
+        _contagem_cache.clear()
+    _contagem_cache[chave] = (agora, total)
+    return total
+
 def validar_imagem(filename):
     """Valida se o arquivo é uma imagem permitida."""
     ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
@@ -224,10 +355,12 @@ def creditos():
     """Página de créditos da equipe."""
     return render_template('creditos.html')
 
+# Produtos no ponto de reposição listados no painel da home
+ITENS_REPOSICAO_HOME = 5
+
 @app.route('/home', methods=['GET'])
 def home():
     """Exibe a lista de todos os produtos em estoque."""
-    from datetime import timedelta
     db = get_db()
     cursor = db.cursor()
 
@@ -237,6 +370,7 @@ def home():
     categoria_filter = request.args.get('categoria')
     busca = request.args.get('q', '').strip()
     ordenar = request.args.get('ordenar', 'validade')  # Novo parâmetro de ordenação
+    risco = request.args.get('risco') == '1'
 
     # Monta cláusula WHERE dinâmica
     where_clauses = []
@@ -247,81 +381,64 @@ def home():
         params.append(categoria_filter)
 
     if busca:
-        # busca por nome (case-insensitive)
-        where_clauses.append('LOWER(produto_nome) LIKE ?')
-        params.append(f"%{busca.lower()}%")
-
-    where_sql = ''
-    if where_clauses:
-        where_sql = 'WHERE ' + ' AND '.join(where_clauses)
-
-    # Define a ordenação baseada no parâmetro
-    order_by = 'ORDER BY validade_int ASC'  # Padrão
-    if ordenar == 'nome':
-        order_by = 'ORDER BY produto_nome ASC'
-    elif ordenar == 'quantidade':
-        order_by = 'ORDER BY quantidade DESC'
-    elif ordenar == 'validade':
-        order_by = 'ORDER BY validade_int ASC'
-
-    # Conta total de items (para paginação)
-    count_sql = f'SELECT COUNT(*) as cnt FROM estoque {where_sql}'
-    total_rows = cursor.execute(count_sql, params).fetchone()['cnt']
-
-    total_pages = max(1, math.ceil(total_rows / per_page))
-    if page < 1:
+        # busca textual por nome/código (FTS5, ignora acentos, prefixo por termo)
+        clausula, busca_params = filtro_estoque(busca)
+        if clausula:
+            where_clauses.append(clausula)
+            params.extend(busca_params)
+
+    # Só lotes com desperdício previsto (projeção em cache até a próxima mudança de estoque)
+    perdas = {}
+    if risco:
+        perdas = {lote['id']: lote['desperdicio'] for lote in risco_desperdicio(db)}
+        where_clauses.append(FILTRO_IDS)
+        params.append(json.dumps(list(perdas)))
+
+    # Define a ordenação (chave do cursor) baseada no parâmetro; id desempata
+    if ordenar not in ORDENACOES_HOME:
+        ordenar = 'validade'
+    colunas, descendente = ORDENACOES_HOME[ordenar]
+
+    after = decodificar_cursor(request.args.get('after'), ordenar)
+    before = decodificar_cursor(request.args.get('before'), ordenar)
+    if after is None and before is None:
         page = 1
-    if page > total_pages:
-        page = total_pages
 
-    offset = (page - 1) * per_page
+    # Limites de validade do dia (em cache) para o status e para o próximo vencimento
+    limites = limites_validade()
 
-    # Busca os produtos com paginação
-    sql = f'SELECT * FROM estoque {where_sql} {order_by} LIMIT ? OFFSET ?'
-    final_params = params + [per_page, offset]
-    produtos_raw = cursor.execute(sql, final_params).fetchall()
-    
-    # Adiciona status de validade para cada produto
-    hoje_ts = int(datetime.combine(date.today(), datetime.min.time()).timestamp())
-    dias_7_ts = int(datetime.combine(date.today() + timedelta(days=7), datetime.min.time()).timestamp())
-    dias_15_ts = int(datetime.combine(date.today() + timedelta(days=15), datetime.min.time()).timestamp())
-    
-    produtos = []
-    for p in produtos_raw:
-        produto_dict = dict(p)
-        validade_ts = produto_dict.get('validade_int', 0)
-        
-        # Define status de validade
-        if validade_ts < hoje_ts:
-            produto_dict['status_validade'] = 'vencido'
-        elif validade_ts < dias_7_ts:
-            produto_dict['status_validade'] = 'vence_urgente'
-        elif validade_ts < dias_15_ts:
-            produto_dict['status_validade'] = 'vence_proximo'
-        else:
-            produto_dict['status_validade'] = 'ok'
-        
-        produtos.append(produto_dict)
+    # Estatísticas do painel: contadores mantidos por triggers, lidos em uma consulta
+    stats = ler_estatisticas(db, limites.hoje, date.today().isoformat())
 
-    # Estatísticas simples
-    total_produtos = cursor.execute('SELECT SUM(COALESCE(quantidade,0)) as s FROM estoque').fetchone()['s'] or 0
-    # itens baixos: quantidade <= 5
-    produtos_baixos = cursor.execute('SELECT COUNT(*) as c FROM estoque WHERE quantidade <= 5').fetchone()['c'] or 0
+    # Conta total de items (informativo); sem filtros o contador já está pronto
+    if where_clauses:
+        total_rows = contar_com_cache(cursor, 'estoque', where_clauses, params)
+    else:
+        total_rows = stats['total_lotes']
+    total_pages = max(1, math.ceil(total_rows / per_page))
+    page = min(max(page, 1), total_pages)
+
+    # Busca os produtos da página a partir do cursor; o status de validade vem calculado
+    # pelo SQLite (CASE sobre validade_int), as linhas já chegam prontas para o template
+    produtos, has_prev, has_next, primeira, ultima = buscar_pagina(
+        cursor, 'estoque', where_clauses, params, colunas, descendente, per_page,
+        after=after, before=before, selecao=selecao_com_status(), params_selecao=limites)
+    prev_cursor = codificar_cursor(ordenar, primeira) if has_prev and primeira else None
+    next_cursor = codificar_cursor(ordenar, ultima) if has_next and ultima else None
+
+    total_produtos = stats['total_unidades']
+    # itens baixos: quantidade <= LIMITE_ESTOQUE_BAIXO
+    produtos_baixos = stats['lotes_baixos']
     # próximo vencimento (data text mais próxima no futuro ou hoje)
-    hoje_ts = int(datetime.combine(date.today(), datetime.min.time()).timestamp())
-    prox = cursor.execute('SELECT validade_text FROM estoque WHERE validade_int >= ? ORDER BY validade_int ASC LIMIT 1', (hoje_ts,)).fetchone()
-    vencimento_proximo = prox['validade_text'] if prox else 'Nenhum'
+    vencimento_proximo = stats['vencimento_proximo'] or 'Nenhum'
     # movimentações hoje
-    hoje_iso = date.today().isoformat()
-    movimentacoes_hoje = cursor.execute("SELECT COUNT(*) as c FROM movimentacao WHERE DATE(timestamp) = ?", (hoje_iso,)).fetchone()['c'] or 0
+    movimentacoes_hoje = stats['movimentacoes_hoje']
+    # produtos no ponto de reposição pela previsão de consumo (os mais urgentes)
+    reposicao = previsao_consumo(db, so_repor=True)
 
-    # Flags de paginação
-    has_prev = page > 1
-    has_next = page < total_pages
-    # Busca categorias distintas do estoque para popular o filtro de categorias
+    # Categorias com estoque para popular o filtro de categorias
     try:
-        cursor.execute('SELECT DISTINCT categoria FROM estoque ORDER BY categoria ASC')
-        cats_rows = cursor.fetchall()
+        cats_rows = listar_categorias(db)
     except Exception:
         cats_rows = []
 
@@ -361,10 +478,15 @@ def home():
                            produtos_baixos=produtos_baixos,
                            vencimento_proximo=vencimento_proximo,
                            movimentacoes_hoje=movimentacoes_hoje,
+                           reposicao=reposicao[:ITENS_REPOSICAO_HOME],
+                           total_reposicao=len(reposicao),
+                           perdas=perdas,
                            current_page=page,
                            total_pages=total_pages,
                            has_prev=has_prev,
                            has_next=has_next,
+                           prev_cursor=prev_cursor,
+                           next_cursor=next_cursor,
                            categorias=categorias)
 
 # --------------------------------------------------------------------------
@@ -374,8 +496,8 @@ def home():
 @app.route('/adicionar_produto', methods=['GET', 'POST'])
 def adicionar_produto():
     """Adiciona um novo produto ao estoque, somando a quantidade se o código de barras e a validade já existirem."""
-    db = get_db()
-    cursor = db.cursor()
+    # POST altera o estoque: usa a conexão de escrita; GET só renderiza o formulário
+    db = get_db_escrita() if request.method == 'POST' else get_db()
     
     if request.method == 'POST':
         try:
@@ -400,88 +522,34 @@ def adicionar_produto():
             # Garante que validade_text sempre esteja no formato brasileiro
             validade_text = datetime_validade.strftime('%d/%m/%Y')
             
-            # Busca produto existente com este código de barras e validade
-            cursor.execute('''
-                SELECT * FROM estoque 
-                WHERE codigo_de_barras = ? AND validade_text = ?
-            ''', (codigo_de_barras, validade_text))
-            
-            produto_existente = cursor.fetchone()
-            
             # Define os dados do produto baseado no modo
             if modo_rapido:
-                # Modo rápido: busca dados de produto existente
-                if produto_existente:
-                    # Produto já existe com esta validade, usa seus dados
-                    produto_nome = produto_existente['produto_nome']
-                    lote = produto_existente['lote']
-                    categoria = produto_existente['categoria']
-                    image_path = produto_existente['image_path']
-                else:
-                    # Se não encontrou com a validade, tenta buscar qualquer produto com este código de barras
-                    cursor.execute('''
-                        SELECT * FROM estoque 
-                        WHERE codigo_de_barras = ?
-                        LIMIT 1
-                    ''', (codigo_de_barras,))
-                    
-                    produto_ref = cursor.fetchone()
-                    
-                    if produto_ref:
-                        # Usa dados do produto de referência mas com nova validade
-                        produto_nome = produto_ref['produto_nome']
-                        lote = produto_ref['lote']
-                        categoria = produto_ref['categoria']
-                        image_path = produto_ref['image_path']
-                    else:
-                        flash('Produto não encontrado. Use o formulário completo para adicionar um novo produto.', 'error')
-                        return render_template('adicionar_estoque.html')
+                # Modo rápido: o serviço reaproveita os dados de um lote existente do mesmo código
+                dados = None
             else:
                 # Modo normal: captura todos os campos do formulário
-                lote = request.form.get('lote', '')
-                produto_nome = request.form['produto_nome']
-                categoria = request.form['categoria']
-                image_path = request.form.get('image_path', '')
+                dados = {
+                    'lote': request.form.get('lote', ''),
+                    'produto_nome': request.form['produto_nome'],
+                    'categoria': request.form['categoria'],
+                    'image_path': request.form.get('image_path', ''),
+                }
             
-            # Agora processa a adição/atualização
-            if produto_existente:
-                # SE EXISTE: ATUALIZA (SOMA) A QUANTIDADE
-                produto_id = produto_existente['id']
-                quantidade_atual = produto_existente['quantidade']
-                nova_quantidade_total = quantidade_atual + quantidade_nova
-                
-                # Atualiza a quantidade e demais metadados
-                cursor.execute('''
-                    UPDATE estoque
-                    SET quantidade = ?, validade_int = ?, validade_text = ?, categoria = ?, produto_nome = ?, image_path = ?, lote = ?
-                    WHERE id = ?
-                ''', (nova_quantidade_total, validade_int, validade_text, categoria, produto_nome, image_path, lote, produto_id))
-                
-                # Registra movimentação de entrada pela adição de quantidade
-                cursor.execute('''
-                    INSERT INTO movimentacao (product_id, product_barcode, name, action, quantidade)
-                    VALUES (?, ?, ?, ?, ?)
-                ''', (produto_id, codigo_de_barras, produto_nome, 'entrada', quantidade_nova))
-
-                flash(f"Quantidade do item '{produto_nome}' (Validade: {validade_text}) atualizada para {nova_quantidade_total}!", 'success')
-                
-            else:
-                # SE NÃO EXISTE: INSERE NOVO REGISTRO
-                cursor.execute('''
-                    INSERT INTO estoque (codigo_de_barras, lote, validade_int, validade_text, produto_nome, quantidade, categoria, image_path)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (codigo_de_barras, lote, validade_int, validade_text, produto_nome, quantidade_nova, categoria, image_path))
-                # obtém id do novo produto
-                novo_id = cursor.lastrowid
-                # Registra movimentação de entrada para o novo produto
-                cursor.execute('''
-                    INSERT INTO movimentacao (product_id, product_barcode, name, action, quantidade)
-                    VALUES (?, ?, ?, ?, ?)
-                ''', (novo_id, codigo_de_barras, produto_nome, 'entrada', quantidade_nova))
-
+            # Soma no lote existente (código + validade) ou cria um novo, em uma transação
+            try:
+                resultado = registrar_entrada(db, codigo_de_barras, validade_int, validade_text, quantidade_nova, dados)
+            except ProdutoNaoEncontrado:
+                flash('Produto não encontrado. Use o formulário completo para adicionar um novo produto.', 'error')
+                return render_template('adicionar_estoque.html')
+            except QuantidadeInvalida:
+                flash("Erro: A quantidade deve ser um número válido.", 'error')
+                return render_template('adicionar_estoque.html')
+
+            if resultado['novo_lote']:
                 flash("Produto adicionado com sucesso!", 'success')
+            else:
+                flash(f"Quantidade do item '{resultado['produto_nome']}' (Validade: {validade_text}) atualizada para {resultado['nova_quantidade']}!", 'success')
             
-            db.commit()
             return redirect(url_for('home'))
             
         except ValueError:
@@ -521,11 +589,7 @@ def retirada():
                 validade_int = int(validade_dt.timestamp())
                 
                 # Buscar produtos com este código de barras e data de validade
-                produto = cursor.execute('''
-                    SELECT * FROM estoque 
-                    WHERE codigo_de_barras = ? AND validade_int = ?
-                    AND quantidade > 0
-                ''', (codigo_de_barras, validade_int)).fetchone()
+                produto = cursor.execute(SQL_LOTE_POR_CODIGO_E_VALIDADE, (codigo_de_barras, validade_int)).fetchone()
                 
                 if produto:
                     return redirect(url_for('retirada_com_id', produto_id=produto['id']))
@@ -536,8 +600,7 @@ def retirada():
                 error = translate('invalid_date', lang)
                 return render_template('retirar.html', error=error)
             # Busca o produto exato no estoque (caso use lote)
-            produto = cursor.execute('SELECT * FROM estoque WHERE codigo_de_barras = ? AND lote = ?', 
-                                     (codigo_de_barras, lote)).fetchone()
+            produto = cursor.execute(SQL_LOTE_POR_CODIGO_E_LOTE, (codigo_de_barras, lote)).fetchone()
             
             if produto:
                 id_encontrado = produto['id']
@@ -563,42 +626,204 @@ def api_produtos_por_codigo():
         return jsonify([])
 
     db = get_db()
-    cursor = db.cursor()
     try:
-        rows = cursor.execute('''
-            SELECT id, produto_nome, validade_text, validade_int, quantidade, lote, image_path
-            FROM estoque
-            WHERE codigo_de_barras = ?
-            ORDER BY validade_int ASC
-        ''', (codigo,)).fetchall()
-
-        resultados = []
-        for r in rows:
-            resultados.append({
-                'id': r['id'],
-                'produto_nome': r['produto_nome'],
-                'validade_text': r['validade_text'],
-                'validade_int': r['validade_int'],
-                'quantidade': r['quantidade'],
-                'lote': r['lote'],
-                'image_path': r['image_path']
-            })
-
-        return jsonify(resultados)
-    except Exception as e:
+        # Em cache por código (invalidado a cada mutação do estoque; ver cache_codigos.py)
+        return jsonify(list(lotes_por_codigo(db, codigo)))
+    except Exception:
         # Em caso de erro, retorna lista vazia para o front-end tratar
-        print('Erro ao buscar produtos por codigo:', e)
+        app.logger.exception('Erro ao buscar produtos por codigo')
         return jsonify([]), 500
 
 
+@app.route('/api/busca_produtos')
+def api_busca_produtos():
+    """Sugestões para o autocomplete da busca da home.
+
+    Query params:
+      - q: texto digitado (busca por prefixo, sem diferenciar acentos)
+    Retorna lista de objetos: id, produto_nome, codigo_de_barras, validade_text, quantidade
+    """
+    busca = request.args.get('q', '').strip()
+    if not busca:
+        return jsonify([])
+
+    db = get_db()
+    try:
+        return jsonify(sugerir_produtos(db, busca))
+    except Exception:
+        app.logger.exception('Erro ao buscar sugestões de produtos')
+        return jsonify([]), 500
+
+
+@app.route('/api/vencimentos')
+def api_vencimentos():
+    """Lotes vencidos / vencendo em breve por categoria (para alertas e painéis).
+
+    Retorna, por categoria: vencido, vence_urgente (até DIAS_URGENTE dias),
+    vence_proximo (até DIAS_PROXIMO dias) e as unidades desses lotes, além dos totais.
+    Só os lotes que vencem antes do limite "próximo" são lidos (faixa no índice de validade).
+    """
+    lang = session.get('lang', 'pt')
+    contagens = contar_vencimentos_por_categoria(get_db())
+    categorias = []
+    totais = {'vencido': 0, 'vence_urgente': 0, 'vence_proximo': 0, 'unidades': 0}
+    for categoria, contagem in contagens.items():
+        categorias.append({'categoria': categoria, 'label': translate(f'category_{categoria}', lang), **contagem})
+        for chave in totais:
+            totais[chave] += contagem[chave]
+    return jsonify({
+        'ok': True,
+        'data_referencia': date.today().isoformat(),
+        'dias_urgente': DIAS_URGENTE,
+        'dias_proximo': DIAS_PROXIMO,
+        'categorias': categorias,
+        'totais': totais,
+    })
+
+
+@app.route('/api/estoque_em')
+@login_required
+def api_estoque_em():
+    """Saldo de cada lote no fim de um dia (UTC), a partir do livro-razão.
+
+    Query params:
+      - data: YYYY-MM-DD (obrigatório)
+      - codigo: código de barras (opcional)
+    Usa a fotografia de saldo mais próxima da data e reproduz só as linhas do razão entre as duas.
+    """
+    try:
+        dia = date.fromisoformat(request.args.get('data', ''))
+    except ValueError:
+        return {'ok': False, 'error': 'Informe data=YYYY-MM-DD'}, 400
+    codigo = request.args.get('codigo', '').strip() or None
+    ate = (dia + timedelta(days=1)).isoformat()
+    resultado = saldos_em(get_db(), ate, codigo)
+    return jsonify({
+        'ok': True,
+        'data': dia.isoformat(),
+        'ate': ate,
+        'codigo': codigo,
+        'base': resultado['base'],
+        'total_unidades': sum(lote['quantidade'] for lote in resultado['lotes']),
+        'lotes': resultado['lotes'],
+    })
+
+
+@app.route('/api/tendencias')
+@login_required
+def api_tendencias():
+    """Série de movimentações para gráficos de tendência (lê só as tabelas de resumo).
+
+    Query params:
+      - granularidade: dia | semana | mes (padrão dia)
+      - inicio, fim: YYYY-MM-DD (padrão: últimos 30 dias / 12 semanas / 12 meses até hoje)
+      - por: total | codigo | acao | motivo (padrão total)
+      - codigo, action, motivo: filtros opcionais
+    """
+    granularidade = request.args.get('granularidade', 'dia')
+    agrupar = request.args.get('por', 'total')
+    if granularidade not in GRANULARIDADES or agrupar not in AGRUPAMENTOS:
+        return {'ok': False, 'error': f"Use granularidade={'|'.join(GRANULARIDADES)} e por={'|'.join(AGRUPAMENTOS)}"}, 400
+    try:
+        fim = date.fromisoformat(request.args['fim']) if request.args.get('fim') else date.today()
+        inicio = date.fromisoformat(request.args['inicio']) if request.args.get('inicio') \
+            else inicio_padrao(granularidade, fim)
+    except ValueError:
+        return {'ok': False, 'error': 'Datas no formato YYYY-MM-DD'}, 400
+    serie = consultar_tendencia(get_db(), granularidade, inicio, fim, agrupar,
+                                codigo=request.args.get('codigo') or None,
+                                acao=request.args.get('action') or None,
+                                motivo=request.args.get('motivo'))
+    return jsonify({
+        'ok': True,
+        'granularidade': granularidade,
+        'por': agrupar,
+        'inicio': inicio.isoformat(),
+        'fim': fim.isoformat(),
+        'serie': serie,
+    })
+
+
+@app.route('/api/previsao_consumo')
+@login_required
+def api_previsao_consumo():
+    """Taxa de consumo, dias de cobertura e ponto de reposição por código de barras.
+
+    Query params:
+      - codigo: só um código de barras
+      - repor=1: só os que já estão no ponto de reposição
+    """
+    itens = previsao_consumo(get_db(), codigo=request.args.get('codigo') or None,
+                             so_repor=request.args.get('repor') in ('1', 'true'))
+    return jsonify({
+        'ok': True,
+        'janela_dias': JANELA_DIAS_CONSUMO,
+        'dias_reposicao': DIAS_REPOSICAO,
+        'dias_seguranca': DIAS_SEGURANCA,
+        'itens': itens,
+    })
+
+
+@app.route('/api/risco_desperdicio')
+@login_required
+def api_risco_desperdicio():
+    """Lotes que devem vencer antes de serem consumidos, do maior para o menor desperdício previsto.
+
+    Query params:
+      - dias: horizonte de vencimento em dias (padrão DIAS_HORIZONTE_DESPERDICIO)
+      - codigo: só os lotes de um código de barras
+    """
+    try:
+        dias = int(request.args.get('dias', DIAS_HORIZONTE_DESPERDICIO))
+    except ValueError:
+        return {'ok': False, 'error': 'dias deve ser um número inteiro'}, 400
+    if not 1 <= dias <= 3650:
+        return {'ok': False, 'error': 'dias deve estar entre 1 e 3650'}, 400
+    lotes = risco_desperdicio(get_db(), horizonte_dias=dias)
+    codigo = request.args.get('codigo')
+    if codigo:
+        lotes = [lote for lote in lotes if lote['codigo_de_barras'] == codigo]
+    return jsonify({
+        'ok': True,
+        'horizonte_dias': dias,
+        'unidades': sum(lote['desperdicio'] for lote in lotes),
+        'lotes': lotes,
+    })
+
+
+@app.route('/api/eventos_estoque')
+@login_required
+def api_eventos_estoque():
+    """Fluxo SSE (text/event-stream) com o saldo dos lotes alterados; home.js atualiza os cartões.
+
+    Eventos: 'estoque' ({lotes: [{id, codigo_de_barras, quantidade, removido}]}) e
+    'recarregar' (a fila desta conexão transbordou). Comentários periódicos mantêm a conexão viva.
+    Worker síncrono (uma requisição por vez) recebe 503: a página segue funcionando sem tempo real.
+    """
+    limite = limite_de_conexoes(request.environ, app.config['EVENTOS_MAX_CONEXOES'])
+    if not limite:
+        return {'ok': False, 'error': 'Eventos em tempo real exigem worker com threads ou gevent'}, 503
+    assinatura = CANAL_EVENTOS.assinar(limite)
+    if assinatura is None:
+        return {'ok': False, 'error': 'Limite de conexões de eventos atingido'}, 503
+    # Não usa o banco nem stream_with_context: a conexão ociosa não segura nada do pool
+    resposta = Response(CANAL_EVENTOS.fluxo(assinatura), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+    # Se o cliente cair antes do primeiro envio o gerador nem começa; cancela aqui também
+    resposta.call_on_close(lambda: CANAL_EVENTOS.cancelar(assinatura))
+    return resposta
+
+
 @app.route('/retirada_estoque/<int:produto_id>', methods=['GET', 'POST'])
 def retirada_com_id(produto_id):
     """Exibe o produto e gerencia a submissão da quantidade a ser retirada."""
-    db = get_db()
+    db = get_db_escrita() if request.method == 'POST' else get_db()
     cursor = db.cursor()
     
     # 1. Busca o produto para exibição/validação
-    produto = cursor.execute('SELECT * FROM estoque WHERE id = ?', (produto_id,)).fetchone()
+    produto = cursor.execute(SQL_LOTE_POR_ID, (produto_id,)).fetchone()
     
     lang = session.get('lang', 'pt')
     if request.method == 'POST':
@@ -611,31 +836,18 @@ def retirada_com_id(produto_id):
             return render_template('retirar_estoque.html', produto=produto, produto_id=produto_id, error=error)
             
         
-        # 2. Validação: Verifica se o estoque é suficiente
-        if produto and quantidade_retirada > 0 and produto['quantidade'] >= quantidade_retirada:
-            
-            nova_quantidade = produto['quantidade'] - quantidade_retirada
-            
-            # 3. ATUALIZA ESTOQUE
-            cursor.execute('UPDATE estoque SET quantidade = ? WHERE id = ?', (nova_quantidade, produto_id))
-            
-            # 4. REGISTRA MOVIMENTAÇÃO COM RESPONSÁVEL (armazenado em motivo para compatibilidade)
-            cursor.execute('''
-                INSERT INTO movimentacao (product_id, product_barcode, name, action, quantidade, motivo)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (produto['id'], produto['codigo_de_barras'], produto['produto_nome'], 'retirada', quantidade_retirada, responsavel))
-            
-            # 5. EXECUTA A LIMPEZA AUTOMÁTICA
-            # Remove itens que ficaram com quantidade <= 0 após a retirada (o commit finaliza tudo)
-            limpar_estoque_zerado()
-            
-            flash(translate('success', lang) + f" - {quantidade_retirada} {translate('units', lang)}", 'success')
-            return redirect(url_for('retirada'))
-        
-        else:
+        # 2. Retirada atômica: valida e desconta o estoque em um único UPDATE condicional;
+        #    se o lote zerar ele é removido na mesma transação
+        #    (o responsável é armazenado em motivo para compatibilidade)
+        try:
+            retirar(db, produto_id, quantidade_retirada, responsavel)
+        except ErroEstoque:
             error = translate('insufficient_stock', lang)
             return render_template('retirar_estoque.html', produto=produto, produto_id=produto_id, error=error)
 
+        flash(translate('success', lang) + f" - {quantidade_retirada} {translate('units', lang)}", 'success')
+        return redirect(url_for('retirada'))
+
     # Exibe a página de retirada (GET)
     return render_template('retirar_estoque.html', produto=produto, produto_id=produto_id)
 
@@ -643,38 +855,25 @@ def retirada_com_id(produto_id):
 # Endpoint AJAX para ajuste rápido de quantidade (incremento/decremento)
 @app.route('/api/adjust_quantity', methods=['POST'])
 def api_adjust_quantity():
-    db = get_db()
-    cursor = db.cursor()
+    db = get_db_escrita()
     try:
         data = request.get_json()
         product_id = int(data.get('product_id'))
         action = data.get('action')
 
-        produto = cursor.execute('SELECT * FROM estoque WHERE id = ?', (product_id,)).fetchone()
-        if not produto:
-            return {'ok': False, 'error': 'Produto não encontrado'}, 404
-
         if action == 'add':
-            novo = produto['quantidade'] + 1
-            movimento = 'entrada'
-            cursor.execute('UPDATE estoque SET quantidade = ? WHERE id = ?', (novo, product_id))
-            cursor.execute('INSERT INTO movimentacao (product_id, product_barcode, name, action, quantidade, motivo) VALUES (?, ?, ?, ?, ?, ?)',
-                       (product_id, produto['codigo_de_barras'], produto['produto_nome'], movimento, 1, 'Adição rápida'))
+            novo = adicionar(db, product_id, 1, 'Adição rápida')
         elif action == 'remove':
             # Remove não faz mais nada - modal cuida disso
             return {'ok': False, 'error': 'Use o modal para retiradas'}, 400
         else:
             return {'ok': False, 'error': 'Ação inválida'}, 400
 
-        if novo < 0:
-            return {'ok': False, 'error': 'Quantidade não pode ser negativa'}, 400
-
-        db.commit()
-
-        # Limpa itens zerados
-        limpar_estoque_zerado()
-
         return {'ok': True, 'new_quantity': novo}
+    except ProdutoNaoEncontrado as e:
+        return {'ok': False, 'error': str(e)}, 404
+    except ErroEstoque as e:
+        return {'ok': False, 'error': str(e)}, 400
     except Exception as e:
         db.rollback()
         return {'ok': False, 'error': str(e)}, 500
@@ -683,8 +882,7 @@ def api_adjust_quantity():
 # Nova rota para retirada com motivo (via modal)
 @app.route('/api/retirar_com_motivo', methods=['POST'])
 def api_retirar_com_motivo():
-    db = get_db()
-    cursor = db.cursor()
+    db = get_db_escrita()
     try:
         data = request.get_json()
         product_id = int(data.get('product_id'))
@@ -694,37 +892,136 @@ def api_retirar_com_motivo():
         if not motivo:
             return {'ok': False, 'error': 'Motivo é obrigatório'}, 400
 
-        produto = cursor.execute('SELECT * FROM estoque WHERE id = ?', (product_id,)).fetchone()
-        if not produto:
-            return {'ok': False, 'error': 'Produto não encontrado'}, 404
+        # Desconto atômico: UPDATE condicional dentro de BEGIN IMMEDIATE
+        novo = retirar(db, product_id, quantidade, motivo)
 
-        if quantidade > produto['quantidade']:
-            return {'ok': False, 'error': 'Quantidade insuficiente em estoque'}, 400
+        return {'ok': True, 'new_quantity': novo}
+    except ProdutoNaoEncontrado as e:
+        return {'ok': False, 'error': str(e)}, 404
+    except ErroEstoque as e:
+        return {'ok': False, 'error': str(e)}, 400
+    except Exception as e:
+        db.rollback()
+        return {'ok': False, 'error': str(e)}, 500
 
-        novo = produto['quantidade'] - quantidade
-        
-        cursor.execute('UPDATE estoque SET quantidade = ? WHERE id = ?', (novo, product_id))
-        cursor.execute('''INSERT INTO movimentacao 
-            (product_id, product_barcode, name, action, quantidade, motivo) 
-            VALUES (?, ?, ?, ?, ?, ?)''',
-            (product_id, produto['codigo_de_barras'], produto['produto_nome'], 
-             'retirada', quantidade, motivo))
-        db.commit()
 
-        # Limpa itens zerados
-        limpar_estoque_zerado()
+# Limite de linhas por despacho em lote
+MAX_ITENS_LOTE = 1000
 
-        return {'ok': True, 'new_quantity': novo}
+# Retirada de vários lotes de uma vez (despacho de distribuição): um único commit
+@app.route('/api/retirar_lote', methods=['POST'])
+@login_required
+def api_retirar_lote():
+    """
+    Corpo: {"itens": [{"product_id", "quantidade", "motivo"}], "motivo": padrão opcional}.
+    Tudo ou nada: se alguma linha for inválida nada é retirado e a resposta traz o resultado de cada linha.
+    """
+    db = get_db_escrita()
+    data = request.get_json(silent=True) or {}
+    linhas = data.get('itens') if isinstance(data, dict) else data
+    if not isinstance(linhas, list) or not linhas:
+        return {'ok': False, 'error': 'Informe a lista de itens'}, 400
+    if len(linhas) > MAX_ITENS_LOTE:
+        return {'ok': False, 'error': f'Máximo de {MAX_ITENS_LOTE} itens por lote'}, 400
+    motivo_padrao = (data.get('motivo') or '').strip() if isinstance(data, dict) else ''
+
+    itens = []
+    resultados = []
+    for linha, bruto in enumerate(linhas):
+        try:
+            item = {
+                'produto_id': int(bruto.get('product_id')),
+                'quantidade': int(bruto.get('quantidade', 1)),
+                'motivo': (bruto.get('motivo') or motivo_padrao).strip(),
+            }
+        except (AttributeError, TypeError, ValueError):
+            resultados.append({'linha': linha, 'ok': False, 'error': 'Linha inválida'})
+            continue
+        erro = None
+        if item['quantidade'] <= 0:
+            erro = 'Quantidade deve ser maior que zero'
+        elif not item['motivo']:
+            erro = 'Motivo é obrigatório'
+        resultados.append({'linha': linha, 'product_id': item['produto_id'], 'quantidade': item['quantidade'],
+                           'ok': erro is None, **({'error': erro} if erro else {})})
+        itens.append(item)
+    if not all(r['ok'] for r in resultados):
+        return {'ok': False, 'error': 'Há linhas inválidas; nada foi retirado', 'resultados': resultados}, 400
+
+    try:
+        resultados = retirar_lote(db, itens)
+        return {'ok': True, 'resultados': resultados}
+    except RetiradaEmLoteRecusada as e:
+        return {'ok': False, 'error': str(e), 'resultados': e.resultados}, 400
+    except ErroEstoque as e:
+        return {'ok': False, 'error': str(e)}, 400
     except Exception as e:
         db.rollback()
         return {'ok': False, 'error': str(e)}, 500
 
 
+# Retirada por código de barras sem escolher a validade: o sistema aloca os lotes em FEFO
+@app.route('/api/retirar_fefo', methods=['POST'])
+@login_required
+def api_retirar_fefo():
+    """
+    Corpo: {"codigo_de_barras", "quantidade", "motivo", "incluir_vencidos": false}.
+    Retira dos lotes que vencem primeiro (pode abranger vários lotes); lotes já vencidos
+    ficam de fora, a menos que incluir_vencidos seja verdadeiro (p.ex. para descarte).
+    """
+    db = get_db_escrita()
+    data = request.get_json(silent=True) or {}
+    codigo = str(data.get('codigo_de_barras') or '').strip()
+    motivo = (data.get('motivo') or '').strip()
+    try:
+        quantidade = int(data.get('quantidade', 1))
+    except (TypeError, ValueError):
+        return {'ok': False, 'error': 'Quantidade inválida'}, 400
+    if not codigo:
+        return {'ok': False, 'error': 'Código de barras é obrigatório'}, 400
+    if not motivo:
+        return {'ok': False, 'error': 'Motivo é obrigatório'}, 400
+    validade_minima = None if data.get('incluir_vencidos') else limites_validade().hoje
+
+    try:
+        alocacoes = retirar_fefo(db, codigo, quantidade, motivo, validade_minima)
+        return {'ok': True, 'quantidade': quantidade, 'alocacoes': alocacoes}
+    except ProdutoNaoEncontrado as e:
+        return {'ok': False, 'error': str(e)}, 404
+    except ErroEstoque as e:
+        return {'ok': False, 'error': str(e)}, 400
+    except Exception as e:
+        db.rollback()
+        return {'ok': False, 'error': str(e)}, 500
+
+
+# Importação em massa (entrega de caminhão): arquivo .csv ou .xlsx no campo 'arquivo'
+@app.route('/api/importar_estoque', methods=['POST'])
+@login_required
+def api_importar_estoque():
+    """Soma/cria lotes a partir de uma planilha; responde com o relatório (contagens, erros por linha, vazão)."""
+    arquivo = request.files.get('arquivo')
+    if arquivo is None or not arquivo.filename:
+        return {'ok': False, 'error': 'Envie um arquivo .csv ou .xlsx no campo "arquivo"'}, 400
+    try:
+        linhas = ler_linhas(arquivo.stream, arquivo.filename)
+        # Pool, e não get_db_escrita(): a conexão de escrita (única) é devolvida entre os blocos
+        relatorio = importar_estoque(obter_pool(escrita=True), linhas, motivo=f'Importação {arquivo.filename}')
+    except ValueError as e:
+        return {'ok': False, 'error': str(e)}, 400
+    except queue.Empty:
+        raise
+    except Exception as e:
+        app.logger.error(f"Erro na importação de {arquivo.filename}: {e}", exc_info=True)
+        return {'ok': False, 'error': str(e)}, 500
+    app.logger.info(f"Importação {arquivo.filename}: {relatorio['importadas']} linhas em {relatorio['segundos']}s")
+    return {'ok': True, **relatorio}
+
+
 # Nova rota para adição com motivo (via modal)
 @app.route('/api/adicionar_com_motivo', methods=['POST'])
 def api_adicionar_com_motivo():
-    db = get_db()
-    cursor = db.cursor()
+    db = get_db_escrita()
     try:
         data = request.get_json()
         product_id = int(data.get('product_id'))
@@ -734,21 +1031,13 @@ def api_adicionar_com_motivo():
         if not motivo:
             return {'ok': False, 'error': 'Motivo é obrigatório'}, 400
 
-        produto = cursor.execute('SELECT * FROM estoque WHERE id = ?', (product_id,)).fetchone()
-        if not produto:
-            return {'ok': False, 'error': 'Produto não encontrado'}, 404
-
-        novo = produto['quantidade'] + quantidade
-        
-        cursor.execute('UPDATE estoque SET quantidade = ? WHERE id = ?', (novo, product_id))
-        cursor.execute('''INSERT INTO movimentacao 
-            (product_id, product_barcode, name, action, quantidade, motivo) 
-            VALUES (?, ?, ?, ?, ?, ?)''',
-            (product_id, produto['codigo_de_barras'], produto['produto_nome'], 
-             'entrada', quantidade, motivo))
-        db.commit()
+        novo = adicionar(db, product_id, quantidade, motivo)
 
         return {'ok': True, 'new_quantity': novo}
+    except ProdutoNaoEncontrado as e:
+        return {'ok': False, 'error': str(e)}, 404
+    except ErroEstoque as e:
+        return {'ok': False, 'error': str(e)}, 400
     except Exception as e:
         db.rollback()
         return {'ok': False, 'error': str(e)}, 500
@@ -758,7 +1047,6 @@ def api_adicionar_com_motivo():
 @login_required
 def historico():
     """Exibe o histórico de movimentações com filtros."""
-    from datetime import timedelta
     db = get_db()
     cursor = db.cursor()
 
@@ -767,159 +1055,39 @@ def historico():
     per_page = int(request.args.get('per_page', 50))
     periodo = request.args.get('periodo', 'today')  # Novo parâmetro de período
     custom_date = request.args.get('date', '')  # Data customizada (quando periodo='custom')
-    action_filter = request.args.get('action')
-    busca = request.args.get('q', '').strip()
 
-    # Calcula as datas baseado no período selecionado
+    # Período, ação e busca viram cláusulas WHERE no mesmo construtor usado pelas exportações
+    filtro = filtro_da_requisicao(request.args)
+    periodo_display = filtro.periodo.exibicao
+    where_clauses, params = clausulas(filtro)
     hoje = date.today()
-    date_from = None
-    date_to = None
-    periodo_display = ''
-    
-    if periodo == 'today':
-        date_from = date_to = hoje
-        periodo_display = f"{hoje.strftime('%d/%m/%Y')}"
-    elif periodo == 'week':
-        date_from = hoje - timedelta(days=7)
-        date_to = hoje
-        periodo_display = f"{date_from.strftime('%d/%m/%Y')} - {date_to.strftime('%d/%m/%Y')}"
-    elif periodo == 'month':
-        date_from = hoje - timedelta(days=30)
-        date_to = hoje
-        periodo_display = f"{date_from.strftime('%d/%m/%Y')} - {date_to.strftime('%d/%m/%Y')}"
-    elif periodo == 'current_month':
-        date_from = date(hoje.year, hoje.month, 1)
-        date_to = hoje
-        periodo_display = f"{date_from.strftime('%B/%Y')}"
-    elif periodo == 'last_month':
-        # Primeiro dia do mês passado
-        if hoje.month == 1:
-            date_from = date(hoje.year - 1, 12, 1)
-            ultimo_dia = date(hoje.year, 1, 1) - timedelta(days=1)
-        else:
-            date_from = date(hoje.year, hoje.month - 1, 1)
-            ultimo_dia = date(hoje.year, hoje.month, 1) - timedelta(days=1)
-        date_to = ultimo_dia
-        periodo_display = f"{date_from.strftime('%B/%Y')}"
-    elif periodo == 'year':
-        date_from = date(hoje.year, 1, 1)
-        date_to = hoje
-        periodo_display = f"{hoje.year}"
-    elif periodo == 'custom' and custom_date:
-        try:
-            date_from = date_to = date.fromisoformat(custom_date)
-            periodo_display = f"{date_from.strftime('%d/%m/%Y')}"
-        except ValueError:
-            date_from = date_to = hoje
-            periodo_display = f"{hoje.strftime('%d/%m/%Y')}"
-    elif periodo == 'all':
-        # Sem filtro de data - mostra tudo
-        date_from = date_to = None
-        periodo_display = "Todas as movimentações"
-    else:
-        # Padrão: hoje
-        date_from = date_to = hoje
-        periodo_display = f"{hoje.strftime('%d/%m/%Y')}"
 
-    # Monta cláusula WHERE dinâmica
-    where_clauses = []
-    params = []
-
-    if action_filter:
-        where_clauses.append('action = ?')
-        params.append(action_filter)
-
-    if busca:
-        where_clauses.append('(LOWER(name) LIKE ? OR product_barcode LIKE ?)')
-        search_term = f"%{busca.lower()}%"
-        params.extend([search_term, search_term])
-
-    # Aplica filtros de data apenas se não for 'all'
-    if date_from and date_to:
-        if date_from == date_to:
-            where_clauses.append('DATE(timestamp) = DATE(?)')
-            params.append(date_from.isoformat())
-        else:
-            where_clauses.append('DATE(timestamp) >= DATE(?)')
-            params.append(date_from.isoformat())
-            where_clauses.append('DATE(timestamp) <= DATE(?)')
-            params.append(date_to.isoformat())
-
-    where_sql = ''
-    if where_clauses:
-        where_sql = 'WHERE ' + ' AND '.join(where_clauses)
-
-    # Conta total de items (para paginação)
-    count_sql = f'SELECT COUNT(*) as cnt FROM movimentacao {where_sql}'
-    total_rows = cursor.execute(count_sql, params).fetchone()['cnt']
-
-    total_pages = max(1, math.ceil(total_rows / per_page))
-    if page < 1:
+    after = decodificar_cursor(request.args.get('after'), 'historico')
+    before = decodificar_cursor(request.args.get('before'), 'historico')
+    if after is None and before is None:
         page = 1
-    if page > total_pages:
-        page = total_pages
-
-    offset = (page - 1) * per_page
-
-    # Busca as movimentações com paginação
-    sql = f'''SELECT *, datetime(timestamp) as timestamp 
-             FROM movimentacao {where_sql} 
-             ORDER BY timestamp DESC 
-             LIMIT ? OFFSET ?'''
-    final_params = params + [per_page, offset]
-    movimentacoes_raw = cursor.execute(sql, final_params).fetchall()
-
-    # Busca datas disponíveis para o seletor
-    datas_disponiveis = cursor.execute('''
-        SELECT DISTINCT DATE(timestamp) as data 
-        FROM movimentacao 
-        ORDER BY data DESC
-    ''').fetchall()
-    datas_disponiveis = [row['data'] for row in datas_disponiveis]
-
-    # Normaliza o campo timestamp para objetos datetime (o template usa .strftime)
-    from datetime import datetime as _dt
-    from types import SimpleNamespace
-
-    movimentacoes = []
-    for mov in movimentacoes_raw:
-        # mov pode ser sqlite3.Row; converte para dict primeiro
-        try:
-            row = dict(mov)
-        except Exception:
-            # se já for dict
-            row = mov
 
-        ts = row.get('timestamp')
-        parsed = ts
-        if isinstance(ts, (int, float)):
-            try:
-                parsed = _dt.fromtimestamp(ts)
-            except Exception:
-                parsed = ts
-        elif isinstance(ts, str):
-            # tenta vários formatos comuns
-            for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d'):
-                try:
-                    parsed = _dt.strptime(ts, fmt)
-                    break
-                except Exception:
-                    try:
-                        parsed = _dt.fromisoformat(ts)
-                        break
-                    except Exception:
-                        parsed = ts
+    # Conta total de items (informativo, reaproveitado entre páginas)
+    total_rows = contar_com_cache(cursor, 'movimentacao', where_clauses, params)
+    total_pages = max(1, math.ceil(total_rows / per_page))
+    page = min(max(page, 1), total_pages)
 
-        row['timestamp'] = parsed
-        # transforma em um objeto com atributos para facilitar o template
-        movimentacoes.append(SimpleNamespace(**row))
+    # Busca as movimentações da página (mais recentes primeiro) a partir do cursor, já como
+    # registros Movimentacao com o timestamp convertido pelo driver (o template usa .strftime)
+    movimentacoes, has_prev, has_next, primeira, ultima = buscar_pagina(
+        cursor, 'movimentacao', where_clauses, params, *ORDEM_HISTORICO, per_page,
+        after=after, before=before, selecao=Movimentacao.COLUNAS_SQL, fabrica=fabrica_movimentacao)
+    prev_cursor = codificar_cursor('historico', primeira) if has_prev and primeira else None
+    next_cursor = codificar_cursor('historico', ultima) if has_next and ultima else None
 
     return render_template('historico.html',
                          movimentacoes=movimentacoes,
                          current_page=page,
                          total_pages=total_pages,
-                         has_prev=page > 1,
-                         has_next=page < total_pages,
+                         has_prev=has_prev,
+                         has_next=has_next,
+                         prev_cursor=prev_cursor,
+                         next_cursor=next_cursor,
                          periodo=periodo,
                          periodo_display=periodo_display,
                          custom_date=custom_date or hoje.isoformat(),
@@ -930,157 +1098,73 @@ def historico():
 @login_required
 def exportar_historico():
     """Exporta o histórico de movimentações do período selecionado para Excel (.xlsx)."""
-    from datetime import timedelta
     db = get_db()
     cursor = db.cursor()
-    
-    # Parâmetros
-    periodo = request.args.get('periodo', 'today')
-    custom_date = request.args.get('date', '')
-    
-    # Calcula as datas baseado no período selecionado (mesma lógica da visualização)
-    hoje = date.today()
-    date_from = None
-    date_to = None
-    periodo_nome = ''
-    
-    if periodo == 'today':
-        date_from = date_to = hoje
-        periodo_nome = f"{hoje.strftime('%d-%m-%Y')}"
-    elif periodo == 'week':
-        date_from = hoje - timedelta(days=7)
-        date_to = hoje
-        periodo_nome = f"Ultimos_7_dias_{date_to.strftime('%d-%m-%Y')}"
-    elif periodo == 'month':
-        date_from = hoje - timedelta(days=30)
-        date_to = hoje
-        periodo_nome = f"Ultimos_30_dias_{date_to.strftime('%d-%m-%Y')}"
-    elif periodo == 'current_month':
-        date_from = date(hoje.year, hoje.month, 1)
-        date_to = hoje
-        periodo_nome = f"{date_from.strftime('%B_%Y')}"
-    elif periodo == 'last_month':
-        if hoje.month == 1:
-            date_from = date(hoje.year - 1, 12, 1)
-            ultimo_dia = date(hoje.year, 1, 1) - timedelta(days=1)
-        else:
-            date_from = date(hoje.year, hoje.month - 1, 1)
-            ultimo_dia = date(hoje.year, hoje.month, 1) - timedelta(days=1)
-        date_to = ultimo_dia
-        periodo_nome = f"{date_from.strftime('%B_%Y')}"
-    elif periodo == 'year':
-        date_from = date(hoje.year, 1, 1)
-        date_to = hoje
-        periodo_nome = f"Ano_{hoje.year}"
-    elif periodo == 'custom' and custom_date:
-        try:
-            date_from = date_to = date.fromisoformat(custom_date)
-            periodo_nome = f"{date_from.strftime('%d-%m-%Y')}"
-        except ValueError:
-            date_from = date_to = hoje
-            periodo_nome = f"{hoje.strftime('%d-%m-%Y')}"
-    elif periodo == 'all':
-        date_from = date_to = None
-        periodo_nome = "Todas_movimentacoes"
-    else:
-        date_from = date_to = hoje
-        periodo_nome = f"{hoje.strftime('%d-%m-%Y')}"
-    
-    # Monta a query baseado no período
-    if date_from and date_to:
-        if date_from == date_to:
-            where_clause = 'WHERE DATE(timestamp) = DATE(?)'
-            params = (date_from.isoformat(),)
-        else:
-            where_clause = 'WHERE DATE(timestamp) >= DATE(?) AND DATE(timestamp) <= DATE(?)'
-            params = (date_from.isoformat(), date_to.isoformat())
-    else:
-        # Todas as movimentações
-        where_clause = ''
-        params = ()
-    
-    # Busca as movimentações
-    movimentacoes = cursor.execute(f'''
-        SELECT 
-            datetime(timestamp) as timestamp,
-            product_barcode,
-            name,
-            action,
-            quantidade,
-            motivo
-        FROM movimentacao 
-        {where_clause}
-        ORDER BY timestamp DESC
-    ''', params).fetchall()
-    
-    # Cria o workbook do Excel
-    wb = Workbook()
-    ws = wb.active
-    ws.title = f"Histórico {periodo_nome[:25]}"  # Limite de 31 caracteres para título de aba
-    
-    # Estilo do cabeçalho
-    header_fill = PatternFill(start_color="4D7033", end_color="4D7033", fill_type="solid")
-    header_font = Font(bold=True, color="FFFFFF", size=12)
-    
-    # Cabeçalhos
-    headers = ['Data/Hora', 'Código de Barras', 'Produto', 'Ação', 'Quantidade', 'Responsável']
-    for col_num, header in enumerate(headers, 1):
-        cell = ws.cell(row=1, column=col_num)
-        cell.value = header
-        cell.fill = header_fill
-        cell.font = header_font
-        cell.alignment = Alignment(horizontal='center', vertical='center')
-    
-    # Dados
-    for row_num, mov in enumerate(movimentacoes, 2):
-        # Formata timestamp
-        try:
-            if isinstance(mov['timestamp'], str):
-                ts = datetime.fromisoformat(mov['timestamp'].replace(' ', 'T'))
-            else:
-                ts = mov['timestamp']
-            timestamp_str = ts.strftime('%d/%m/%Y %H:%M:%S')
-        except:
-            timestamp_str = str(mov['timestamp'])
-        
-        ws.cell(row=row_num, column=1).value = timestamp_str
-        ws.cell(row=row_num, column=2).value = mov['product_barcode']
-        ws.cell(row=row_num, column=3).value = mov['name']
-        
-        # Ação com cor
-        action_cell = ws.cell(row=row_num, column=4)
-        action_cell.value = mov['action'].title()
-        if mov['action'] == 'entrada':
-            action_cell.font = Font(color="006400", bold=True)  # Verde escuro
-        else:
-            action_cell.font = Font(color="8B0000", bold=True)  # Vermelho escuro
-        
-        ws.cell(row=row_num, column=5).value = mov['quantidade']
-        ws.cell(row=row_num, column=6).value = mov['motivo'] or '-'
-    
-    # Ajusta largura das colunas
-    ws.column_dimensions['A'].width = 20
-    ws.column_dimensions['B'].width = 18
-    ws.column_dimensions['C'].width = 35
-    ws.column_dimensions['D'].width = 12
-    ws.column_dimensions['E'].width = 12
-    ws.column_dimensions['F'].width = 40
-    
-    # Salva em memória
-    output = BytesIO()
-    wb.save(output)
-    output.seek(0)
-    
-    # Nome do arquivo
+
+    # Mesmo filtro da tela do histórico (periodo, date, action, q), mesmas linhas e ordem
+    filtro = filtro_da_requisicao(request.args)
+    periodo_nome = filtro.periodo.nome_arquivo
     filename = f"historico_{periodo_nome}.xlsx"
+    mimetype = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    sql, params = consulta(filtro, COLUNAS_XLSX)
+
+    # Período já encerrado: o conteúdo não muda mais, então vem do cache em disco
+    # (com ETag/Last-Modified); só períodos em aberto são gerados a cada pedido
+    if filtro.periodo.date_to is not None and filtro.periodo.date_to < date.today():
+        sql_versao, params_versao = consulta(filtro, 'MAX(id), COUNT(*)', None)
+        max_id, total = cursor.execute(sql_versao, params_versao).fetchone()
+        chave = chave_exportacao(formato='xlsx', sql=sql, params=params, titulo=periodo_nome,
+                                 schema=versao_schema(db), max_id=max_id, total=total)
+        cache = obter_cache_exportacao()
+        caminho = cache.obter(chave, '.xlsx')
+        if caminho is None:
+            with gerar_xlsx_historico(cursor.execute(sql, params), f"Histórico {periodo_nome[:25]}") as gerado:
+                caminho = cache.guardar(chave, '.xlsx', gerado)
+        # Abre antes de responder: mesmo que o arquivo seja descartado do cache, o envio termina
+        arquivo = open(caminho, 'rb')
+        resposta = send_file(arquivo, mimetype=mimetype, as_attachment=True, download_name=filename,
+                             etag=chave, last_modified=os.fstat(arquivo.fileno()).st_mtime,
+                             conditional=True)
+        resposta.headers['Cache-Control'] = 'private, no-cache'
+        return resposta
+
+    # Percorre o cursor sem fetchall: a planilha é gravada linha a linha (exportacao.py)
+    output = gerar_xlsx_historico(cursor.execute(sql, params), f"Histórico {periodo_nome[:25]}")
     
     return send_file(
         output,
-        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+        mimetype=mimetype,
         as_attachment=True,
         download_name=filename
     )
 
+# Formatos brutos do histórico para integrações (BI): sem estilo, em streaming.
+# Content-Type completo (passado como content_type: mimetype= acrescentaria outro charset)
+FORMATOS_EXPORTACAO = {
+    'csv': (gerar_csv, 'text/csv; charset=utf-8'),
+    'ndjson': (gerar_ndjson, 'application/x-ndjson; charset=utf-8'),
+}
+
+@app.route('/exportar_historico/<formato>')
+@login_required
+def exportar_historico_bruto(formato):
+    """
+    Exporta as movimentações em CSV ou NDJSON, em ordem de id, com os mesmos filtros do
+    histórico (periodo, date, action, q). since_id=N traz só as linhas com id > N,
+    para cargas incrementais (use periodo=all para não limitar por data).
+    """
+    if formato not in FORMATOS_EXPORTACAO:
+        abort(404)
+    gerador, content_type = FORMATOS_EXPORTACAO[formato]
+
+    sql, params = consulta(filtro_da_requisicao(request.args), COLUNAS_BRUTAS, 'id ASC')
+    cursor = get_db().execute(sql, params)
+
+    # stream_with_context mantém a conexão de leitura emprestada até o fim do envio
+    return Response(stream_with_context(gerador(cursor)), content_type=content_type, headers={
+        'Content-Disposition': f'attachment; filename=movimentacoes.{formato}',
+    })
+
 @app.route('/logout')
 def logout():
     session.pop('user', None)
@@ -1115,7 +1199,7 @@ def add_responsavel():
     if not nome:
         return jsonify({'ok': False, 'error': 'Nome é obrigatório'}), 400
     
-    db = get_db()
+    db = get_db_escrita()
     cursor = db.cursor()
     
     try:
@@ -1131,7 +1215,7 @@ def add_responsavel():
 @login_required
 def delete_responsavel(responsavel_id):
     """Remove um responsável."""
-    db = get_db()
+    db = get_db_escrita()
     cursor = db.cursor()
     
     try:
@@ -1156,6 +1240,102 @@ def init_db_command():
         init_db()
         print('Banco de dados inicializado.')
 
+@app.cli.command('reconstruir-estatisticas')
+def reconstruir_estatisticas_command():
+    """Recria os triggers, recalcula os contadores do painel do zero e mostra divergências (ex: flask reconstruir-estatisticas)."""
+    with app.app_context():
+        db = get_db()
+        divergencias = comparar_estatisticas(db)
+        for nome, atual, novo in divergencias:
+            print(f'{nome}: {atual} -> {novo}')
+        criar_triggers_estoque(db.cursor())
+        recalcular_estatisticas(db.cursor())
+        db.commit()
+        print(f'Estatísticas reconstruídas ({len(divergencias)} divergências corrigidas).')
+
+@app.cli.command('reconstruir-resumos')
+def reconstruir_resumos_command():
+    """Refaz os resumos diários/semanais/mensais a partir do histórico (ex: flask reconstruir-resumos)."""
+    with app.app_context():
+        db = get_db_escrita()
+        executar_transacao(db, lambda conexao: reconstruir_resumos(conexao.cursor()))
+        limpar_cache_previsao()
+        contagens = {nome: db.execute(f'SELECT COUNT(*) FROM {granularidade.tabela}').fetchone()[0]
+                     for nome, granularidade in GRANULARIDADES.items()}
+        print('Resumos reconstruídos: ' + ', '.join(f'{nome} {total} linhas' for nome, total in contagens.items()) + '.')
+
+@app.cli.command('varrer-estoque-zerado')
+def varrer_estoque_zerado_command():
+    """Remove em lotes os produtos com quantidade <= 0 (ex: flask varrer-estoque-zerado, via cron)."""
+    with app.app_context():
+        removidos = limpar_estoque_zerado()
+        print(f'{removidos} lotes zerados removidos.')
+
+@app.cli.command('gravar-snapshot')
+@click.option('--manter', type=int, default=None, help='Mantém só as N fotografias mais recentes.')
+def gravar_snapshot_command(manter):
+    """Grava o saldo atual de cada lote no livro-razão (ex: flask gravar-snapshot --manter 400, via cron diário)."""
+    with app.app_context():
+        resultado = gravar_snapshot(get_db_escrita(), manter=manter)
+        print(f"Snapshot {resultado['snapshot_id']}: {resultado['lotes']} lotes, {resultado['unidades']} unidades "
+              f"(razão até o id {resultado['ultimo_razao_id']}).")
+        if resultado.get('removidos'):
+            print(f"{resultado['removidos']} snapshots antigos removidos.")
+
+@app.cli.command('verificar-razao')
+@click.option('--completo', is_flag=True, help='Confere também cada snapshot contra o anterior.')
+def verificar_razao_command(completo):
+    """Falha se o último snapshot + razão não bater com o estoque (ex: flask verificar-razao)."""
+    with app.app_context():
+        problemas = verificar_razao(get_db(), completo=completo)
+        for problema in problemas[:100]:
+            print(f"{problema['verificacao']}: lote {problema['produto_id']} razão={problema['razao']} "
+                  f"atual={problema['atual']}")
+        if problemas:
+            print(f'{len(problemas)} divergências.')
+            raise SystemExit(1)
+        print('Razão, snapshots e estoque conferem.')
+
+@app.cli.command('importar-estoque')
+@click.argument('caminho', type=click.Path(exists=True, dir_okay=False))
+def importar_estoque_command(caminho):
+    """Importa entradas de estoque de um .csv/.xlsx (ex: flask importar-estoque entrega.xlsx)."""
+    with app.app_context():
+        nome = os.path.basename(caminho)
+        with open(caminho, 'rb') as arquivo:
+            relatorio = importar_estoque(obter_pool(escrita=True), ler_linhas(arquivo, nome), motivo=f'Importação {nome}')
+        for erro in relatorio['erros']:
+            print(f"Linha {erro['linha']}: {erro['erro']}")
+        print(f"{relatorio['linhas']} linhas lidas, {relatorio['importadas']} importadas "
+              f"({relatorio['lotes_criados']} lotes novos, {relatorio['lotes_atualizados']} atualizados), "
+              f"{relatorio['total_erros']} erros, {relatorio['segundos']}s ({relatorio['linhas_por_segundo']} linhas/s).")
+
+@app.cli.command('verificar-indices')
+def verificar_indices_command():
+    """Falha se alguma consulta das rotas cair em SCAN completo (ex: flask verificar-indices)."""
+    with app.app_context():
+        db = get_db()
+        problemas = verificar_planos(db)
+        print(f'Schema na versão {versao_schema(db)}.')
+        if problemas:
+            for nome, detalhe in problemas:
+                print(f'SCAN completo em "{nome}": {detalhe}')
+            raise SystemExit(1)
+        print('Todas as consultas das rotas usam índices.')
+
+@app.route('/api/saude')
+def api_saude():
+    """Verificação de saúde do banco: estado do pool, um SELECT 1, os contadores de limpeza, do cache de códigos e dos eventos."""
+    status = {
+        'escrita': obter_pool(escrita=True).saude(),
+        'leitura': obter_pool(escrita=False).saude(),
+        'limpeza': metricas_limpeza(),
+        'cache_codigos': CACHE_CODIGOS.metricas(),
+        'eventos': CANAL_EVENTOS.metricas(),
+    }
+    ok = status['escrita'].get('ok') and status['leitura'].get('ok')
+    return jsonify(status), (200 if ok else 503)
+
 # Rota de debug (apenas para ambiente de desenvolvimento) para listar templates e static
 @app.route('/debug/list_files')
 @login_required
@@ -1240,6 +1420,14 @@ def not_found_error(error):
                          error_code=404,
                          error_description=error.description), 404
 
+# Conexão de escrita ocupada além do timeout do pool (ex: importação grande em andamento)
+@app.errorhandler(queue.Empty)
+def conexao_indisponivel(error):
+    app.logger.warning(f"Sem conexão livre no pool para {request.method} {request.path}")
+    if request.path.startswith('/api/'):
+        return {'ok': False, 'error': 'Banco ocupado, tente novamente em instantes'}, 503
+    return "Banco ocupado, tente novamente em instantes.", 503
+
 # Handler 500 para log melhor (dev)
 @app.errorhandler(500)
 def internal_error(error):
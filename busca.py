@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+Busca textual (FTS5) sobre estoque e movimentacao
+As tabelas virtuais estoque_fts e movimentacao_fts são mantidas por triggers
+(ver migracoes.py) e usam o tokenizer unicode61 com remoção de acentos, então
+"acucar" encontra "Açúcar".
+"""
+
+import re
+
+# Tokenizer compartilhado pelas duas tabelas virtuais
+TOKENIZER_FTS = "unicode61 remove_diacritics 2"
+
+# Limite de termos por busca, evita consultas MATCH enormes vindas da URL
+_MAX_TERMOS = 8
+
+
+def montar_consulta_fts(texto):
+    """
+    Converte o texto digitado em uma expressão MATCH com prefixo por termo:
+    'arroz tip' -> '"arroz"* "tip"*'. Retorna None se não houver termos válidos.
+    """
+    termos = re.findall(r'\w+', texto or '')[:_MAX_TERMOS]
+    if not termos:
+        return None
+    return ' '.join(f'"{termo}"*' for termo in termos)
+
+
+def filtro_estoque(texto):
+    """Cláusula WHERE (e parâmetros) que filtra estoque pela busca textual."""
+    consulta = montar_consulta_fts(texto)
+    if consulta is None:
+        return None, []
+    return 'id IN (SELECT rowid FROM estoque_fts WHERE estoque_fts MATCH ?)', [consulta]
+
+
+def filtro_movimentacao(texto):
+    """Cláusula WHERE (e parâmetros) que filtra movimentacao pela busca textual."""
+    consulta = montar_consulta_fts(texto)
+    if consulta is None:
+        return None, []
+    return 'id IN (SELECT rowid FROM movimentacao_fts WHERE movimentacao_fts MATCH ?)', [consulta]
+
+
+def sugerir_produtos(db, texto, limite=10):
+    """Sugestões para o autocomplete da busca, ordenadas por relevância (bm25)."""
+    consulta = montar_consulta_fts(texto)
+    if consulta is None:
+        return []
+    rows = db.execute('''
+        SELECT e.id, e.produto_nome, e.codigo_de_barras, e.validade_text, e.quantidade
+        FROM estoque_fts f
+        JOIN estoque e ON e.id = f.rowid
+        WHERE estoque_fts MATCH ?
+        ORDER BY bm25(estoque_fts), e.validade_int ASC
+        LIMIT ?
+    ''', (consulta, limite)).fetchall()
+    return [dict(r) for r in rows]
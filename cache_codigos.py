@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+Cache em memória das consultas por código de barras
+Os fluxos de leitor (retirada.js a cada leitura, modo rápido de adicionar_produto)
+repetem as mesmas poucas centenas de códigos. Guardamos, por processo, os lotes
+de cada código e os dados do produto no catálogo (nome, categoria, imagem),
+com limite de itens (LRU) e validade (TTL).
+
+Invalidação write-through: toda mutação de estoque em servico_estoque/importacao
+chama invalidar_codigos() com os códigos tocados, dentro da transação e de novo depois do
+commit. Uma carga só é guardada se nenhuma invalidação aconteceu enquanto ela lia
+o banco (contador de geração), então uma leitura que viu o estado antigo nunca
+sobrescreve a invalidação. Entre processos (vários workers) não há aviso: lá o
+TTL limita por quanto tempo um valor antigo pode ser servido.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+# Itens (código x tipo) guardados por processo
+MAX_ITENS_CACHE_CODIGOS = 2048
+
+# Segundos que um item vale; limita a defasagem entre workers diferentes
+TTL_CACHE_CODIGOS = 30
+
+# Consultas de carga (também conferidas por migracoes.verificar_planos)
+SQL_LOTES_POR_CODIGO = '''
+    SELECT id, produto_nome, validade_text, validade_int, quantidade, lote, image_path
+    FROM estoque
+    WHERE codigo_de_barras = ?
+    ORDER BY validade_int ASC
+'''
+SQL_PRODUTO_DO_CATALOGO = '''
+    SELECT produto_nome, categoria, image_path FROM produtos
+    WHERE codigo_de_barras = ?
+'''
+
+_pendentes = threading.local()
+
+
+class CacheCodigos:
+    """LRU com TTL, chave (tipo, codigo). Seguro entre threads."""
+
+    def __init__(self, max_itens=MAX_ITENS_CACHE_CODIGOS, ttl=TTL_CACHE_CODIGOS):
+        self.max_itens = max_itens
+        self.ttl = ttl
+        self._itens = OrderedDict()
+        self._lock = threading.Lock()
+        self._geracao = 0
+        self._contadores = {'acertos': 0, 'faltas': 0, 'invalidacoes': 0, 'cargas_descartadas': 0}
+
+    def obter(self, tipo, codigo, carregar):
+        """Valor em cache para (tipo, codigo) ou carregar() — guardado se nada foi invalidado no meio."""
+        chave = (tipo, codigo)
+        agora = time.monotonic()
+        with self._lock:
+            item = self._itens.get(chave)
+            if item is not None and item[0] > agora:
+                self._itens.move_to_end(chave)
+                self._contadores['acertos'] += 1
+                return item[1]
+            self._contadores['faltas'] += 1
+            geracao = self._geracao
+
+        valor = carregar()
+
+        with self._lock:
+            if geracao != self._geracao:
+                self._contadores['cargas_descartadas'] += 1
+                return valor
+            self._itens[chave] = (time.monotonic() + self.ttl, valor)
+            self._itens.move_to_end(chave)
+            while len(self._itens) > self.max_itens:
+                self._itens.popitem(last=False)
+        return valor
+
+    def invalidar(self, codigos):
+        """Remove os códigos e descarta as cargas em andamento."""
+        with self._lock:
+            self._geracao += 1
+            self._contadores['invalidacoes'] += 1
+            for chave in [chave for chave in self._itens if chave[1] in codigos]:
+                del self._itens[chave]
+
+    def limpar(self):
+        """Esvazia o cache (mutação sem lista de códigos, ex.: varredura de lotes zerados)."""
+        with self._lock:
+            self._geracao += 1
+            self._contadores['invalidacoes'] += 1
+            self._itens.clear()
+
+    def metricas(self):
+        """Contadores de acertos/faltas/invalidações e ocupação."""
+        with self._lock:
+            consultas = self._contadores['acertos'] + self._contadores['faltas']
+            return dict(self._contadores, itens=len(self._itens), max_itens=self.max_itens, ttl=self.ttl,
+                        taxa_acerto=round(self._contadores['acertos'] / consultas, 3) if consultas else None)
+
+
+CACHE_CODIGOS = CacheCodigos()
+
+
+def invalidar_codigos(*codigos):
+    """
+    Chamado pelas mutações dentro da transação: invalida já e anota os códigos para
+    invalidar de novo após o commit (ver confirmar_invalidacoes), cobrindo leituras
+    que começaram entre a mudança e o commit e ainda viam o estado antigo.
+    Sem códigos (None) esvazia o cache inteiro.
+    """
+    if not codigos:
+        return
+    pendentes = getattr(_pendentes, 'codigos', None)
+    if pendentes is None:
+        pendentes = _pendentes.codigos = set()
+    if codigos == (None,):
+        CACHE_CODIGOS.limpar()
+        pendentes.add(None)
+        return
+    CACHE_CODIGOS.invalidar(set(codigos))
+    pendentes.update(codigos)
+
+
+def confirmar_invalidacoes():
+    """Depois do commit (ou rollback) da transação: repete as invalidações anotadas nesta thread."""
+    pendentes = getattr(_pendentes, 'codigos', None)
+    if not pendentes:
+        return
+    _pendentes.codigos = None
+    if None in pendentes:
+        CACHE_CODIGOS.limpar()
+    else:
+        CACHE_CODIGOS.invalidar(pendentes)
+
+
+def _carregar_lotes(db, codigo):
+    return tuple({
+        'id': r['id'],
+        'produto_nome': r['produto_nome'],
+        'validade_text': r['validade_text'],
+        'validade_int': r['validade_int'],
+        'quantidade': r['quantidade'],
+        'lote': r['lote'],
+        'image_path': r['image_path'],
+    } for r in db.execute(SQL_LOTES_POR_CODIGO, (codigo,)))
+
+
+def lotes_por_codigo(db, codigo):
+    """Lotes do código em ordem de validade (tupla de dicts; não alterar)."""
+    return CACHE_CODIGOS.obter('lotes', codigo, lambda: _carregar_lotes(db, codigo))
+
+
+def _carregar_produto(db, codigo):
+    row = db.execute(SQL_PRODUTO_DO_CATALOGO, (codigo,)).fetchone()
+    return dict(row) if row else None
+
+
+def produto_do_catalogo(db, codigo):
+    """Dados do catálogo (produto_nome, categoria, image_path) do código, ou None (dict; não alterar)."""
+    return CACHE_CODIGOS.obter('produto', codigo, lambda: _carregar_produto(db, codigo))
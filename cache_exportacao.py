@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+Cache em disco das planilhas exportadas
+Exportações de períodos já encerrados (mês passado, um dia antigo...) não mudam,
+então o arquivo gerado é guardado em disco com uma chave que identifica o
+conteúdo (período, filtros, versão do schema, maior id de movimentação do
+período). A chave também serve de ETag. O diretório tem tamanho máximo; ao
+passar do limite os arquivos usados há mais tempo são apagados (LRU).
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def chave_exportacao(**partes):
+    """Hash estável das partes que determinam o conteúdo do arquivo."""
+    texto = json.dumps(partes, sort_keys=True, default=str)
+    return hashlib.sha256(texto.encode('utf-8')).hexdigest()[:32]
+
+
+class CacheExportacao:
+    """
+    Arquivos <chave><extensão> em um diretório. O horário de acesso (atime) é
+    atualizado explicitamente a cada leitura e define a ordem de descarte; o de
+    modificação (mtime) é o momento da geração e vira o Last-Modified.
+    """
+
+    def __init__(self, diretorio, limite_bytes):
+        self.diretorio = diretorio
+        self.limite_bytes = limite_bytes
+
+    def _caminho(self, chave, extensao):
+        return os.path.join(self.diretorio, f'{chave}{extensao}')
+
+    def obter(self, chave, extensao):
+        """Caminho do arquivo em cache (marcando o uso) ou None."""
+        caminho = self._caminho(chave, extensao)
+        try:
+            info = os.stat(caminho)
+            os.utime(caminho, (time.time(), info.st_mtime))
+        except FileNotFoundError:
+            return None
+        return caminho
+
+    def guardar(self, chave, extensao, arquivo):
+        """
+        Copia o arquivo aberto (posicionado no início) para o cache e retorna o caminho.
+        Grava num temporário e renomeia, então outro processo nunca lê um arquivo pela metade.
+        """
+        os.makedirs(self.diretorio, exist_ok=True)
+        caminho = self._caminho(chave, extensao)
+        descritor, temporario = tempfile.mkstemp(dir=self.diretorio, suffix='.tmp')
+        try:
+            with os.fdopen(descritor, 'wb') as destino:
+                shutil.copyfileobj(arquivo, destino)
+            os.replace(temporario, caminho)
+        except BaseException:
+            try:
+                os.remove(temporario)
+            except FileNotFoundError:
+                pass
+            raise
+        self.descartar_excedente(manter=caminho)
+        return caminho
+
+    def descartar_excedente(self, manter=None):
+        """Apaga os arquivos menos usados até o diretório caber no limite (nunca `manter`, o recém-gravado)."""
+        arquivos = []
+        total = 0
+        with os.scandir(self.diretorio) as entradas:
+            for entrada in entradas:
+                if not entrada.is_file() or entrada.name.endswith('.tmp'):
+                    continue
+                info = entrada.stat()
+                total += info.st_size
+                if entrada.path != manter:
+                    arquivos.append((info.st_atime, info.st_size, entrada.path))
+        removidos = 0
+        for _, tamanho, caminho in sorted(arquivos):
+            if total <= self.limite_bytes:
+                break
+            try:
+                os.remove(caminho)
+            except FileNotFoundError:
+                pass
+            total -= tamanho
+            removidos += 1
+        if removidos:
+            logger.info('Cache de exportação: %d arquivos descartados (%d bytes em uso)', removidos, total)
+        return removidos
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+Pool de conexões SQLite por processo
+Cada processo (ex: worker do gunicorn) mantém um conjunto de conexões já
+configuradas (WAL, synchronous=NORMAL, cache, mmap, busy_timeout, foreign_keys)
+que são reaproveitadas entre requisições em vez de abrir uma nova a cada acesso.
+Leituras usam um pool separado de conexões somente leitura (mode=ro, query_only).
+"""
+
+import os
+import queue
+import sqlite3
+import threading
+import time
+from urllib.request import pathname2url
+
+# Pragmas aplicados em toda conexão nova
+PRAGMAS_PADRAO = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('foreign_keys', 'ON'),
+    ('busy_timeout', 5000),          # ms esperando um lock antes de SQLITE_BUSY
+    ('cache_size', -16000),          # ~16 MB de cache de páginas por conexão
+    ('mmap_size', 128 * 1024 * 1024),
+    ('temp_store', 'MEMORY'),
+)
+
+# Conexões somente leitura: sem journal_mode/synchronous (exigem escrita) e com query_only
+PRAGMAS_LEITURA = (
+    ('query_only', 'ON'),
+    ('busy_timeout', 5000),
+    ('cache_size', -16000),
+    ('mmap_size', 128 * 1024 * 1024),
+    ('temp_store', 'MEMORY'),
+)
+
+# Conexões paradas há mais tempo que isso passam por um SELECT 1 antes de serem entregues
+_INTERVALO_VERIFICACAO = 30
+
+
+class PoolConexoes:
+    """Pool simples baseado em fila; conexões são criadas sob demanda até o limite."""
+
+    def __init__(self, caminho, tamanho=8, pragmas=PRAGMAS_PADRAO, timeout=10, uri=False, detect_types=0):
+        self.caminho = caminho
+        self.tamanho = tamanho
+        self.pragmas = pragmas
+        self.timeout = timeout
+        self.uri = uri
+        self.detect_types = detect_types
+        self.pid = os.getpid()
+        self._livres = queue.LifoQueue()
+        self._criadas = 0
+        self._lock = threading.Lock()
+        self._fechado = False
+        self._ultimo_uso = {}
+
+    def _conectar(self):
+        """Abre e configura uma conexão nova."""
+        conn = sqlite3.connect(self.caminho, timeout=self.timeout, check_same_thread=False, uri=self.uri,
+                               detect_types=self.detect_types)
+        conn.row_factory = sqlite3.Row
+        for nome, valor in self.pragmas:
+            conn.execute(f'PRAGMA {nome} = {valor}')
+        return conn
+
+    def _saudavel(self, conn):
+        """Verifica se a conexão ainda responde."""
+        try:
+            conn.execute('SELECT 1').fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def _descartar(self, conn):
+        with self._lock:
+            self._criadas -= 1
+            self._ultimo_uso.pop(id(conn), None)
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+    def obter(self, timeout=None):
+        """Entrega uma conexão livre (ou cria uma nova se o pool ainda não estiver cheio)."""
+        if timeout is None:
+            timeout = self.timeout
+        if self._fechado:
+            raise RuntimeError('Pool de conexões já foi fechado')
+        while True:
+            try:
+                conn = self._livres.get_nowait()
+            except queue.Empty:
+                with self._lock:
+                    pode_criar = self._criadas < self.tamanho
+                    if pode_criar:
+                        self._criadas += 1
+                if pode_criar:
+                    try:
+                        return self._conectar()
+                    except Exception:
+                        with self._lock:
+                            self._criadas -= 1
+                        raise
+                # Pool cheio: espera alguém devolver uma conexão
+                conn = self._livres.get(timeout=timeout)
+
+            ocioso = time.monotonic() - self._ultimo_uso.get(id(conn), 0)
+            if ocioso < _INTERVALO_VERIFICACAO or self._saudavel(conn):
+                return conn
+            self._descartar(conn)
+
+    def devolver(self, conn):
+        """Devolve a conexão ao pool, desfazendo qualquer transação deixada aberta."""
+        if conn.in_transaction:
+            try:
+                conn.rollback()
+            except sqlite3.Error:
+                self._descartar(conn)
+                return
+        if self._fechado:
+            self._descartar(conn)
+            return
+        self._ultimo_uso[id(conn)] = time.monotonic()
+        self._livres.put(conn)
+
+    def fechar(self):
+        """Fecha todas as conexões livres; as em uso são fechadas ao serem devolvidas."""
+        self._fechado = True
+        while True:
+            try:
+                conn = self._livres.get_nowait()
+            except queue.Empty:
+                break
+            self._descartar(conn)
+
+    def saude(self):
+        """
+        Resumo do estado do pool, com um SELECT 1 em uma conexão emprestada.
+        Sem caminho do banco nem pid: o resumo sai em /api/saude, que não exige login.
+        """
+        status = {
+            'tamanho': self.tamanho,
+            'criadas': self._criadas,
+            'livres': self._livres.qsize(),
+            'fechado': self._fechado,
+        }
+        conn = None
+        try:
+            conn = self.obter(timeout=1)
+            status['ok'] = self._saudavel(conn)
+            status['journal_mode'] = conn.execute('PRAGMA journal_mode').fetchone()[0]
+        except queue.Empty:
+            # Todas as conexões em uso (ex: o escritor durante uma retirada): ocupado, não falho
+            status['ok'] = True
+            status['ocupado'] = True
+        except Exception as e:
+            status['ok'] = False
+            status['erro'] = str(e)
+        finally:
+            if conn is not None:
+                self.devolver(conn)
+        return status
+
+
+def uri_somente_leitura(caminho):
+    """URI SQLite que abre o arquivo em modo somente leitura."""
+    return f'file:{pathname2url(os.path.abspath(caminho))}?mode=ro'
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+Estatísticas do painel (/home) mantidas incrementalmente
+Os contadores são atualizados por triggers (ver migracoes.py) dentro da mesma
+transação de cada alteração em estoque/movimentacao; a home só lê uma linha.
+"""
+
+import re
+
+# Quantidade a partir da qual um lote é considerado "estoque baixo" (usado nos triggers)
+LIMITE_ESTOQUE_BAIXO = 5
+
+# Leituras do painel (parâmetros: dia UTC, limites_validade().hoje); conferidas por migracoes.verificar_planos
+SQL_LER_ESTATISTICAS = '''
+    SELECT e.total_unidades, e.lotes_baixos, e.total_lotes,
+           (SELECT total FROM estatisticas_movimentacao_dia WHERE dia = ?) AS movimentacoes_hoje,
+           (SELECT validade_text FROM estoque WHERE validade_int >= ?
+            ORDER BY validade_int ASC LIMIT 1) AS vencimento_proximo
+    FROM estatisticas_estoque e WHERE e.id = 1
+'''
+SQL_CATEGORIAS = 'SELECT categoria FROM estatisticas_categoria WHERE lotes > 0 ORDER BY categoria ASC'
+
+TRIGGERS_ESTOQUE = ('trg_estatisticas_estoque_insert', 'trg_estatisticas_estoque_delete',
+                    'trg_estatisticas_estoque_update')
+
+
+def criar_triggers_estoque(cursor):
+    """(Re)cria os triggers de estoque dos contadores com o LIMITE_ESTOQUE_BAIXO atual."""
+    # Trigger não aceita parâmetros: o limite entra no texto (sempre inteiro)
+    baixo = int(LIMITE_ESTOQUE_BAIXO)
+    for nome in TRIGGERS_ESTOQUE:
+        cursor.execute(f'DROP TRIGGER IF EXISTS {nome}')
+    cursor.execute(f'''
+        CREATE TRIGGER trg_estatisticas_estoque_insert AFTER INSERT ON estoque
+        BEGIN
+            UPDATE estatisticas_estoque SET
+                total_unidades = total_unidades + COALESCE(NEW.quantidade, 0),
+                lotes_baixos = lotes_baixos + (NEW.quantidade IS NOT NULL AND NEW.quantidade <= {baixo}),
+                total_lotes = total_lotes + 1
+            WHERE id = 1;
+            INSERT INTO estatisticas_categoria (categoria, lotes) VALUES (NEW.categoria, 1)
+                ON CONFLICT(categoria) DO UPDATE SET lotes = lotes + 1;
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER trg_estatisticas_estoque_delete AFTER DELETE ON estoque
+        BEGIN
+            UPDATE estatisticas_estoque SET
+                total_unidades = total_unidades - COALESCE(OLD.quantidade, 0),
+                lotes_baixos = lotes_baixos - (OLD.quantidade IS NOT NULL AND OLD.quantidade <= {baixo}),
+                total_lotes = total_lotes - 1
+            WHERE id = 1;
+            UPDATE estatisticas_categoria SET lotes = lotes - 1 WHERE categoria = OLD.categoria;
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER trg_estatisticas_estoque_update AFTER UPDATE OF quantidade, categoria ON estoque
+        BEGIN
+            UPDATE estatisticas_estoque SET
+                total_unidades = total_unidades - COALESCE(OLD.quantidade, 0) + COALESCE(NEW.quantidade, 0),
+                lotes_baixos = lotes_baixos
+                    - (OLD.quantidade IS NOT NULL AND OLD.quantidade <= {baixo})
+                    + (NEW.quantidade IS NOT NULL AND NEW.quantidade <= {baixo})
+            WHERE id = 1;
+            UPDATE estatisticas_categoria SET lotes = lotes - 1
+                WHERE categoria = OLD.categoria AND OLD.categoria IS NOT NEW.categoria;
+            INSERT INTO estatisticas_categoria (categoria, lotes)
+                SELECT NEW.categoria, 1 WHERE OLD.categoria IS NOT NEW.categoria
+                ON CONFLICT(categoria) DO UPDATE SET lotes = lotes + 1;
+        END
+    ''')
+
+
+def limite_nos_triggers(db):
+    """
+    Limite de estoque baixo com que os triggers foram criados, lido de sqlite_master.
+    None se falta algum trigger ou se eles usam limites diferentes entre si.
+    """
+    marcadores = ', '.join('?' * len(TRIGGERS_ESTOQUE))
+    sqls = [row[0] for row in db.execute(
+        f"SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name IN ({marcadores})", TRIGGERS_ESTOQUE)]
+    limites = {int(valor) for sql in sqls for valor in re.findall(r'quantidade <= (\d+)', sql)}
+    if len(sqls) != len(TRIGGERS_ESTOQUE) or len(limites) != 1:
+        return None
+    return limites.pop()
+
+
+def sincronizar_limite_estoque_baixo(db):
+    """
+    Se os triggers não usam o LIMITE_ESTOQUE_BAIXO atual, recria-os e recalcula os contadores
+    numa transação de escrita (relendo o limite com a trava). Retorna True se recriou.
+    """
+    if limite_nos_triggers(db) == LIMITE_ESTOQUE_BAIXO:
+        return False
+    cursor = db.cursor()
+    try:
+        cursor.execute('BEGIN IMMEDIATE')
+        if limite_nos_triggers(db) == LIMITE_ESTOQUE_BAIXO:
+            db.rollback()
+            return False
+        criar_triggers_estoque(cursor)
+        recalcular_estatisticas(cursor)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return True
+
+
+def recalcular_estatisticas(cursor):
+    """Recalcula todos os contadores a partir das tabelas de origem."""
+    cursor.execute('DELETE FROM estatisticas_estoque')
+    cursor.execute('''
+        INSERT INTO estatisticas_estoque (id, total_unidades, lotes_baixos, total_lotes)
+        SELECT 1,
+               COALESCE(SUM(COALESCE(quantidade, 0)), 0),
+               COALESCE(SUM(quantidade IS NOT NULL AND quantidade <= ?), 0),
+               COUNT(*)
+        FROM estoque
+    ''', (LIMITE_ESTOQUE_BAIXO,))
+
+    cursor.execute('DELETE FROM estatisticas_categoria')
+    cursor.execute('''
+        INSERT INTO estatisticas_categoria (categoria, lotes)
+        SELECT categoria, COUNT(*) FROM estoque GROUP BY categoria
+    ''')
+
+    cursor.execute('DELETE FROM estatisticas_movimentacao_dia')
+    cursor.execute('''
+        INSERT INTO estatisticas_movimentacao_dia (dia, total)
+        SELECT substr(timestamp, 1, 10), COUNT(*) FROM movimentacao
+        WHERE timestamp IS NOT NULL
+        GROUP BY substr(timestamp, 1, 10)
+    ''')
+
+
+def ler_estatisticas(db, hoje_ts, dia_utc):
+    """
+    Lê os números do painel em uma única consulta.
+    O próximo vencimento depende da data atual, então é uma busca pelo índice de validade.
+    """
+    row = db.execute(SQL_LER_ESTATISTICAS, (dia_utc, hoje_ts)).fetchone()
+    if row is None:
+        return {'total_unidades': 0, 'lotes_baixos': 0, 'total_lotes': 0,
+                'movimentacoes_hoje': 0, 'vencimento_proximo': None}
+    return {
+        'total_unidades': row['total_unidades'] or 0,
+        'lotes_baixos': row['lotes_baixos'] or 0,
+        'total_lotes': row['total_lotes'] or 0,
+        'movimentacoes_hoje': row['movimentacoes_hoje'] or 0,
+        'vencimento_proximo': row['vencimento_proximo'],
+    }
+
+
+def listar_categorias(db):
+    """Categorias que possuem ao menos um lote em estoque."""
+    return [row[0] for row in db.execute(SQL_CATEGORIAS).fetchall()]
+
+
+def comparar_estatisticas(db):
+    """
+    Compara os contadores atuais com um recálculo completo, sem alterar o banco.
+    Retorna a lista de divergências (descrição, valor_atual, valor_recalculado).
+    """
+    atuais = {
+        'estoque': db.execute('SELECT total_unidades, lotes_baixos, total_lotes FROM estatisticas_estoque WHERE id = 1').fetchone(),
+        'categorias': dict(db.execute('SELECT categoria, lotes FROM estatisticas_categoria WHERE lotes > 0').fetchall()),
+        'dias': dict(db.execute('SELECT dia, total FROM estatisticas_movimentacao_dia WHERE total > 0').fetchall()),
+    }
+    db.execute('SAVEPOINT comparar_estatisticas')
+    try:
+        recalcular_estatisticas(db.cursor())
+        novos = {
+            'estoque': db.execute('SELECT total_unidades, lotes_baixos, total_lotes FROM estatisticas_estoque WHERE id = 1').fetchone(),
+            'categorias': dict(db.execute('SELECT categoria, lotes FROM estatisticas_categoria').fetchall()),
+            'dias': dict(db.execute('SELECT dia, total FROM estatisticas_movimentacao_dia').fetchall()),
+        }
+    finally:
+        db.execute('ROLLBACK TO comparar_estatisticas')
+        db.execute('RELEASE comparar_estatisticas')
+
+    divergencias = []
+    limite = limite_nos_triggers(db)
+    if limite != LIMITE_ESTOQUE_BAIXO:
+        divergencias.append(('limite de estoque baixo nos triggers', limite, LIMITE_ESTOQUE_BAIXO))
+    for i, nome in enumerate(('total_unidades', 'lotes_baixos', 'total_lotes')):
+        atual = atuais['estoque'][i] if atuais['estoque'] else None
+        novo = novos['estoque'][i] if novos['estoque'] else None
+        if atual != novo:
+            divergencias.append((nome, atual, novo))
+    for grupo in ('categorias', 'dias'):
+        for chave in sorted(set(atuais[grupo]) | set(novos[grupo]), key=str):
+            if atuais[grupo].get(chave) != novos[grupo].get(chave):
+                divergencias.append((f'{grupo}[{chave}]', atuais[grupo].get(chave), novos[grupo].get(chave)))
+    return divergencias
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+Eventos de estoque em tempo real (Server-Sent Events)
+Cada transação de servico_estoque que muda quantidades publica, depois do commit,
+um evento com o saldo atual dos lotes tocados. Os lotes saem do livro-razão
+(razao_estoque, ver razao.py): anota-se o último id antes da mutação e lê-se o que
+entrou depois, então todo caminho de escrita (retirada, adição, FEFO, lote,
+importação, varredura) é coberto sem código próprio. Sem assinantes nada é lido.
+
+Pub/sub em memória, por processo: com vários workers cada estação só recebe os
+eventos do worker em que está conectada (o restante chega no próximo carregamento).
+Cada assinante tem uma fila limitada; quem não acompanha perde a fila e recebe um
+aviso para recarregar. Assinantes ociosos só acordam a cada batimento (heartbeat),
+que também descobre conexões já fechadas.
+
+Cada conexão aberta ocupa o atendente (thread ou greenlet) enquanto a aba existir,
+então o limite depende do servidor (ver limite_de_conexoes): worker síncrono (uma
+requisição por vez) não aceita o fluxo; com threads (gthread, servidor de
+desenvolvimento) o limite tem de ficar bem abaixo do número de threads do worker;
+com gevent cabem centenas de conexões ociosas.
+"""
+
+import json
+import sys
+import threading
+from collections import deque
+
+# Eventos guardados por assinante antes de ele ser considerado atrasado
+MAX_FILA_EVENTOS = 100
+
+# Conexões simultâneas aceitas por processo com gevent (greenlets são baratos)
+MAX_ASSINANTES = 500
+
+# Padrão por processo com threads: fique bem abaixo de --threads do gunicorn, para
+# sobrar thread para as outras requisições (ajustável em EVENTOS_MAX_CONEXOES)
+MAX_ASSINANTES_THREADS = 24
+
+# Segundos entre batimentos (comentário SSE) numa conexão sem eventos
+INTERVALO_HEARTBEAT = 15
+
+# Espera sugerida ao navegador antes de reconectar (ms)
+RECONEXAO_MS = 3000
+
+# Saldo atual dos lotes que entraram no razão depois do marcador (ver coletar_mudancas)
+SQL_LOTES_ALTERADOS = '''
+    SELECT r.produto_id, r.codigo_de_barras, e.quantidade
+    FROM razao_estoque r LEFT JOIN estoque e ON e.id = r.produto_id
+    WHERE r.id > ?
+    GROUP BY r.produto_id
+'''
+
+
+class Assinatura:
+    """Fila limitada de mensagens já formatadas de um assinante."""
+
+    def __init__(self, max_fila):
+        self._fila = deque()
+        self._max_fila = max_fila
+        self._sinal = threading.Event()
+        self._lock = threading.Lock()
+        self.atrasado = False
+
+    def entregar(self, mensagem):
+        with self._lock:
+            if self.atrasado:
+                # Já vai recarregar: o que chegar até lá não importa
+                return
+            if len(self._fila) >= self._max_fila:
+                # Não acompanhou: descarta tudo e avisa para recarregar a página
+                self._fila.clear()
+                self.atrasado = True
+            else:
+                self._fila.append(mensagem)
+        self._sinal.set()
+
+    def esperar(self, timeout):
+        """Mensagens pendentes (lista, vazia se o tempo acabou) e se houve atraso."""
+        self._sinal.wait(timeout)
+        with self._lock:
+            self._sinal.clear()
+            mensagens = list(self._fila)
+            self._fila.clear()
+            atrasado, self.atrasado = self.atrasado, False
+        return mensagens, atrasado
+
+
+class CanalEventos:
+    """Assinantes do processo; publicar() formata a mensagem uma vez e entrega a todos."""
+
+    def __init__(self, max_fila=MAX_FILA_EVENTOS, max_assinantes=MAX_ASSINANTES):
+        self.max_fila = max_fila
+        self.max_assinantes = max_assinantes
+        self._assinantes = set()
+        self._lock = threading.Lock()
+        self._sequencia = 0
+        self._contadores = {'publicados': 0, 'atrasos': 0, 'recusados': 0}
+
+    def tem_assinantes(self):
+        return bool(self._assinantes)
+
+    def assinar(self, limite=None):
+        """Nova assinatura, ou None se o limite de conexões (o menor entre o do canal e `limite`) foi atingido."""
+        limite = self.max_assinantes if limite is None else min(limite, self.max_assinantes)
+        with self._lock:
+            if len(self._assinantes) >= limite:
+                self._contadores['recusados'] += 1
+                return None
+            assinatura = Assinatura(self.max_fila)
+            self._assinantes.add(assinatura)
+            return assinatura
+
+    def cancelar(self, assinatura):
+        with self._lock:
+            self._assinantes.discard(assinatura)
+
+    def publicar(self, tipo, dados):
+        with self._lock:
+            self._sequencia += 1
+            self._contadores['publicados'] += 1
+            mensagem = f'id: {self._sequencia}\nevent: {tipo}\ndata: {json.dumps(dados, ensure_ascii=False)}\n\n'
+            assinantes = list(self._assinantes)
+        for assinatura in assinantes:
+            assinatura.entregar(mensagem)
+
+    def metricas(self):
+        with self._lock:
+            return dict(self._contadores, assinantes=len(self._assinantes), max_assinantes=self.max_assinantes)
+
+    def fluxo(self, assinatura, intervalo=None):
+        """Gerador do corpo text/event-stream; cancela a assinatura quando a conexão fecha."""
+        intervalo = intervalo or INTERVALO_HEARTBEAT
+        try:
+            yield f'retry: {RECONEXAO_MS}\n: conectado\n\n'
+            while True:
+                mensagens, atrasado = assinatura.esperar(intervalo)
+                if atrasado:
+                    with self._lock:
+                        self._contadores['atrasos'] += 1
+                    yield 'event: recarregar\ndata: {}\n\n'
+                elif mensagens:
+                    yield ''.join(mensagens)
+                else:
+                    yield ': heartbeat\n\n'
+        finally:
+            self.cancelar(assinatura)
+
+
+CANAL_EVENTOS = CanalEventos()
+
+
+def _gevent_ativo():
+    # Só se o gevent já foi carregado (worker gevent do gunicorn); nunca o importa à toa
+    if 'gevent' not in sys.modules:
+        return False
+    from gevent import monkey
+    return monkey.is_module_patched('threading')
+
+
+def limite_de_conexoes(environ, configurado=None):
+    """
+    Conexões SSE que este processo pode manter, conforme o servidor da requisição:
+    gevent -> configurado ou MAX_ASSINANTES; threads (wsgi.multithread) -> configurado ou
+    MAX_ASSINANTES_THREADS; worker síncrono -> 0 (o fluxo prenderia o worker inteiro).
+    """
+    if _gevent_ativo():
+        return configurado or MAX_ASSINANTES
+    if not environ.get('wsgi.multithread'):
+        return 0
+    return configurado or MAX_ASSINANTES_THREADS
+
+
+def marcar_mudancas(db):
+    """Dentro da transação, antes da mutação: último id do razão, ou None se ninguém escuta."""
+    if not CANAL_EVENTOS.tem_assinantes():
+        return None
+    return db.execute('SELECT COALESCE(MAX(id), 0) FROM razao_estoque').fetchone()[0]
+
+
+def coletar_mudancas(db, marcador):
+    """Dentro da transação, depois da mutação: saldo atual dos lotes que entraram no razão."""
+    if marcador is None:
+        return []
+    return [{
+        'id': row[0],
+        'codigo_de_barras': row[1],
+        'quantidade': row[2] or 0,
+        'removido': row[2] is None,
+    } for row in db.execute(SQL_LOTES_ALTERADOS, (marcador,))]
+
+
+def publicar_mudancas(lotes):
+    """Depois do commit: um evento 'estoque' com todos os lotes da transação."""
+    if lotes:
+        CANAL_EVENTOS.publicar('estoque', {'lotes': lotes})
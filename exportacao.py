@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+Exportação do histórico de movimentações
+A planilha é gerada em modo write-only do openpyxl: as linhas vêm direto do
+cursor, são gravadas em disco à medida que chegam e os estilos são nomeados e
+compartilhados (não um Font/Alignment por célula). O arquivo final fica num
+temporário em disco, então a memória não cresce com o número de movimentações.
+Os formatos brutos (CSV e NDJSON) são gerados em blocos direto do cursor.
+"""
+
+import csv
+import io
+import json
+import tempfile
+from datetime import datetime
+
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font, Alignment, PatternFill, NamedStyle
+
+CABECALHOS_HISTORICO = ['Data/Hora', 'Código de Barras', 'Produto', 'Ação', 'Quantidade', 'Responsável']
+LARGURAS_HISTORICO = {'A': 20, 'B': 18, 'C': 35, 'D': 12, 'E': 12, 'F': 40}
+
+# Colunas dos formatos brutos (CSV / NDJSON), na ordem do SELECT
+COLUNAS_MOVIMENTACAO = ['id', 'timestamp', 'product_id', 'product_barcode', 'name', 'action', 'quantidade', 'motivo']
+
+# Colunas selecionadas por cada exportação (SELECT montado por filtros_historico.consulta)
+COLUNAS_XLSX = 'timestamp, product_barcode, name, action, quantidade, motivo'
+COLUNAS_BRUTAS = ', '.join(COLUNAS_MOVIMENTACAO)
+
+# Linhas buscadas do cursor (e enviadas) por vez nos formatos brutos
+TAMANHO_BLOCO_STREAM = 1000
+
+# Temporários até este tamanho ficam em memória; acima disso vão para o disco
+_LIMITE_MEMORIA = 4 * 1024 * 1024
+
+
+def _estilos():
+    cabecalho = NamedStyle(name='historico_cabecalho')
+    cabecalho.fill = PatternFill(start_color="4D7033", end_color="4D7033", fill_type="solid")
+    cabecalho.font = Font(bold=True, color="FFFFFF", size=12)
+    cabecalho.alignment = Alignment(horizontal='center', vertical='center')
+
+    entrada = NamedStyle(name='historico_entrada')
+    entrada.font = Font(color="006400", bold=True)  # Verde escuro
+
+    retirada = NamedStyle(name='historico_retirada')
+    retirada.font = Font(color="8B0000", bold=True)  # Vermelho escuro
+    return cabecalho, entrada, retirada
+
+
+def formatar_timestamp(valor):
+    """'YYYY-MM-DD HH:MM:SS' (ou datetime) -> 'DD/MM/YYYY HH:MM:SS'."""
+    try:
+        if isinstance(valor, str):
+            valor = datetime.fromisoformat(valor.replace(' ', 'T'))
+        return valor.strftime('%d/%m/%Y %H:%M:%S')
+    except (TypeError, ValueError, AttributeError):
+        return str(valor)
+
+
+def gerar_xlsx_historico(movimentacoes, titulo):
+    """
+    Gera a planilha a partir de um iterável de linhas (timestamp, product_barcode,
+    name, action, quantidade, motivo) e devolve um arquivo temporário aberto, já
+    posicionado no início, pronto para send_file.
+    """
+    wb = Workbook(write_only=True)
+    cabecalho, entrada, retirada = _estilos()
+    for estilo in (cabecalho, entrada, retirada):
+        wb.add_named_style(estilo)
+
+    ws = wb.create_sheet(title=titulo[:31])  # Limite de 31 caracteres para título de aba
+    for coluna, largura in LARGURAS_HISTORICO.items():
+        ws.column_dimensions[coluna].width = largura
+
+    linha_cabecalho = []
+    for texto in CABECALHOS_HISTORICO:
+        celula = WriteOnlyCell(ws, value=texto)
+        celula.style = cabecalho.name
+        linha_cabecalho.append(celula)
+    ws.append(linha_cabecalho)
+
+    for mov in movimentacoes:
+        acao = WriteOnlyCell(ws, value=(mov['action'] or '').title())
+        acao.style = entrada.name if mov['action'] == 'entrada' else retirada.name
+        ws.append([
+            formatar_timestamp(mov['timestamp']),
+            mov['product_barcode'],
+            mov['name'],
+            acao,
+            mov['quantidade'],
+            mov['motivo'] or '-',
+        ])
+
+    arquivo = tempfile.SpooledTemporaryFile(max_size=_LIMITE_MEMORIA)
+    wb.save(arquivo)
+    arquivo.seek(0)
+    return arquivo
+
+
+def _blocos(cursor):
+    while True:
+        linhas = cursor.fetchmany(TAMANHO_BLOCO_STREAM)
+        if not linhas:
+            return
+        yield linhas
+
+
+def gerar_csv(cursor):
+    """Gera o CSV (com cabeçalho) em pedaços de texto, um por bloco de linhas do cursor."""
+    buffer = io.StringIO()
+    escritor = csv.writer(buffer)
+    escritor.writerow(COLUNAS_MOVIMENTACAO)
+    for linhas in _blocos(cursor):
+        escritor.writerows(linhas)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def gerar_ndjson(cursor):
+    """Gera um objeto JSON por linha (NDJSON), em pedaços de um bloco do cursor."""
+    for linhas in _blocos(cursor):
+        yield ''.join(json.dumps(dict(zip(COLUNAS_MOVIMENTACAO, linha)), ensure_ascii=False) + '\n'
+                      for linha in linhas)
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+Filtros do histórico de movimentações (período, ação, busca, since_id)
+Um único lugar transforma os parâmetros da URL em um filtro e o filtro em SQL,
+usado pela tela do histórico e por todas as exportações, para que mostrem
+exatamente as mesmas linhas. O texto SQL depende só da "forma" do filtro
+(quais filtros estão presentes), então é montado uma vez por forma e reaproveitado;
+como o texto é idêntico, o sqlite3 também reaproveita o statement já preparado.
+"""
+
+from collections import namedtuple
+from datetime import date, timedelta
+from functools import lru_cache
+
+from busca import filtro_movimentacao
+
+# date_from/date_to inclusivos (None em 'all'); exibicao para a tela, nome_arquivo para exportações
+Periodo = namedtuple('Periodo', 'nome date_from date_to exibicao nome_arquivo')
+
+FiltroHistorico = namedtuple('FiltroHistorico', 'periodo action busca since_id')
+
+
+def limites_periodo(date_from, date_to):
+    """
+    Converte um intervalo de datas (inclusivo) em limites semiabertos de timestamp:
+    timestamp >= inicio AND timestamp < fim. Assim o índice em movimentacao(timestamp)
+    pode ser usado, ao contrário de DATE(timestamp) = ?.
+    """
+    return date_from.isoformat(), (date_to + timedelta(days=1)).isoformat()
+
+
+@lru_cache(maxsize=64)
+def _resolver_periodo(periodo, custom_date, hoje):
+    if periodo == 'week':
+        inicio = hoje - timedelta(days=7)
+        return Periodo(periodo, inicio, hoje,
+                       f"{inicio.strftime('%d/%m/%Y')} - {hoje.strftime('%d/%m/%Y')}",
+                       f"Ultimos_7_dias_{hoje.strftime('%d-%m-%Y')}")
+    if periodo == 'month':
+        inicio = hoje - timedelta(days=30)
+        return Periodo(periodo, inicio, hoje,
+                       f"{inicio.strftime('%d/%m/%Y')} - {hoje.strftime('%d/%m/%Y')}",
+                       f"Ultimos_30_dias_{hoje.strftime('%d-%m-%Y')}")
+    if periodo == 'current_month':
+        inicio = date(hoje.year, hoje.month, 1)
+        return Periodo(periodo, inicio, hoje, inicio.strftime('%B/%Y'), inicio.strftime('%B_%Y'))
+    if periodo == 'last_month':
+        ultimo_dia = date(hoje.year, hoje.month, 1) - timedelta(days=1)
+        inicio = date(ultimo_dia.year, ultimo_dia.month, 1)
+        return Periodo(periodo, inicio, ultimo_dia, inicio.strftime('%B/%Y'), inicio.strftime('%B_%Y'))
+    if periodo == 'year':
+        return Periodo(periodo, date(hoje.year, 1, 1), hoje, f"{hoje.year}", f"Ano_{hoje.year}")
+    if periodo == 'all':
+        return Periodo(periodo, None, None, "Todas as movimentações", "Todas_movimentacoes")
+    dia = hoje
+    if periodo == 'custom' and custom_date:
+        try:
+            dia = date.fromisoformat(custom_date)
+        except ValueError:
+            pass
+    return Periodo(periodo, dia, dia, dia.strftime('%d/%m/%Y'), dia.strftime('%d-%m-%Y'))
+
+
+def resolver_periodo(periodo, custom_date='', hoje=None):
+    """Converte ?periodo=/&date= no intervalo de datas e nos rótulos (em cache por dia).
+    Valores desconhecidos de periodo (ou custom sem data válida) viram o dia de hoje."""
+    return _resolver_periodo(periodo or 'today', custom_date or '', hoje or date.today())
+
+
+def filtro_da_requisicao(args, hoje=None):
+    """Monta o filtro a partir de request.args (periodo, date, action, q, since_id)."""
+    try:
+        since_id = int(args.get('since_id'))
+    except (TypeError, ValueError):
+        since_id = None
+    return FiltroHistorico(
+        periodo=resolver_periodo(args.get('periodo', 'today'), args.get('date', ''), hoje),
+        action=args.get('action') or None,
+        busca=(args.get('q') or '').strip() or None,
+        since_id=since_id,
+    )
+
+
+@lru_cache(maxsize=None)
+def _clausulas_da_forma(tem_acao, clausula_busca, tem_periodo, tem_since):
+    clausulas = []
+    if tem_acao:
+        clausulas.append('action = ?')
+    if clausula_busca:
+        clausulas.append(clausula_busca)
+    if tem_periodo:
+        # Intervalo semiaberto sobre o texto canônico: usa o índice de timestamp
+        clausulas.append('timestamp >= ? AND timestamp < ?')
+    if tem_since:
+        clausulas.append('id > ?')
+    return tuple(clausulas)
+
+
+def clausulas(filtro):
+    """(lista de cláusulas WHERE, parâmetros) do filtro, no formato usado por buscar_pagina/contar_com_cache."""
+    params = []
+    if filtro.action:
+        params.append(filtro.action)
+    clausula_busca, busca_params = filtro_movimentacao(filtro.busca) if filtro.busca else (None, [])
+    params.extend(busca_params)
+    tem_periodo = filtro.periodo.date_from is not None
+    if tem_periodo:
+        params.extend(limites_periodo(filtro.periodo.date_from, filtro.periodo.date_to))
+    if filtro.since_id is not None:
+        params.append(filtro.since_id)
+    forma = _clausulas_da_forma(bool(filtro.action), clausula_busca, tem_periodo, filtro.since_id is not None)
+    return list(forma), params
+
+
+@lru_cache(maxsize=128)
+def _sql_da_forma(forma, colunas, ordem):
+    where_sql = f"WHERE {' AND '.join(forma)}" if forma else ''
+    ordem_sql = f'ORDER BY {ordem}' if ordem else ''
+    return f'SELECT {colunas} FROM movimentacao {where_sql} {ordem_sql}'.strip()
+
+
+def consulta(filtro, colunas, ordem='timestamp DESC, id DESC'):
+    """SQL completo (em cache por forma do filtro) e parâmetros para o filtro."""
+    forma, params = clausulas(filtro)
+    return _sql_da_forma(tuple(forma), colunas, ordem), params
@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+"""
+Importação de entradas de estoque em massa (CSV ou XLSX)
+O arquivo é lido linha a linha (módulo csv / openpyxl em read_only) e
+processado em blocos: cada bloco é uma transação que soma nos lotes existentes
+(mesmo código de barras + validade) ou cria lotes novos, e registra as entradas
+em movimentacao com executemany. A memória usada não cresce com o tamanho do arquivo.
+"""
+
+import csv
+import io
+import time
+from datetime import datetime, date
+
+from openpyxl import load_workbook
+
+from cache_codigos import invalidar_codigos
+from conexoes import PoolConexoes
+from servico_estoque import executar_transacao, gravar_no_catalogo
+
+# Linhas por transação
+TAMANHO_BLOCO_IMPORTACAO = 1000
+
+# Quantos erros de linha são devolvidos no relatório (o total é sempre contado)
+MAX_ERROS_RELATORIO = 100
+
+# Lotes e catálogo dos códigos de um bloco ({marcadores}: um ? por código);
+# também conferidas por migracoes.verificar_planos
+SQL_LOTES_DO_BLOCO = '''
+    SELECT id, codigo_de_barras, validade_text
+    FROM estoque WHERE codigo_de_barras IN ({marcadores})
+'''
+SQL_CATALOGO_DO_BLOCO = '''
+    SELECT codigo_de_barras, produto_nome, categoria, image_path
+    FROM produtos WHERE codigo_de_barras IN ({marcadores})
+'''
+
+# Nomes de coluna aceitos no cabeçalho -> campo
+_COLUNAS = {
+    'codigo_de_barras': 'codigo_de_barras', 'codigo': 'codigo_de_barras', 'barcode': 'codigo_de_barras',
+    'produto_nome': 'produto_nome', 'produto': 'produto_nome', 'nome': 'produto_nome', 'name': 'produto_nome',
+    'validade': 'validade', 'expiry': 'validade',
+    'quantidade': 'quantidade', 'qtd': 'quantidade', 'quantity': 'quantidade',
+    'lote': 'lote', 'batch': 'lote',
+    'categoria': 'categoria', 'category': 'categoria',
+    'image_path': 'image_path', 'imagem': 'image_path',
+}
+
+
+class ErroLinha(ValueError):
+    """Linha do arquivo com dado inválido."""
+
+
+def _normalizar_cabecalho(cabecalho):
+    campos = []
+    for nome in cabecalho:
+        chave = str(nome or '').strip().lower().replace(' ', '_')
+        campos.append(_COLUNAS.get(chave))
+    if 'codigo_de_barras' not in campos or 'validade' not in campos or 'quantidade' not in campos:
+        raise ValueError('O cabeçalho precisa ter as colunas codigo_de_barras, validade e quantidade')
+    return campos
+
+
+def _linhas_csv(arquivo):
+    texto = io.TextIOWrapper(arquivo, encoding='utf-8-sig', newline='') if not isinstance(arquivo, io.TextIOBase) else arquivo
+    amostra = texto.read(4096)
+    texto.seek(0)
+    try:
+        dialeto = csv.Sniffer().sniff(amostra, delimiters=',;\t')
+    except csv.Error:
+        dialeto = csv.excel
+    leitor = csv.reader(texto, dialeto)
+    campos = _normalizar_cabecalho(next(leitor, []))
+    for numero, valores in enumerate(leitor, start=2):
+        if not any(valores):
+            continue
+        yield numero, {campo: valor for campo, valor in zip(campos, valores) if campo}
+
+
+def _linhas_xlsx(arquivo):
+    livro = load_workbook(arquivo, read_only=True, data_only=True)
+    try:
+        linhas = livro.active.iter_rows(values_only=True)
+        campos = _normalizar_cabecalho(next(linhas, ()))
+        for numero, valores in enumerate(linhas, start=2):
+            if not any(v not in (None, '') for v in valores):
+                continue
+            yield numero, {campo: valor for campo, valor in zip(campos, valores) if campo}
+    finally:
+        livro.close()
+
+
+def ler_linhas(arquivo, nome_arquivo):
+    """Gera (número da linha, {campo: valor}) a partir de um arquivo binário .csv ou .xlsx."""
+    if nome_arquivo.lower().endswith('.xlsx'):
+        return _linhas_xlsx(arquivo)
+    if nome_arquivo.lower().endswith('.csv'):
+        return _linhas_csv(arquivo)
+    raise ValueError('Formato não suportado: envie um arquivo .csv ou .xlsx')
+
+
+def _texto(valor):
+    if valor is None:
+        return ''
+    if isinstance(valor, float) and valor.is_integer():
+        valor = int(valor)
+    return str(valor).strip()
+
+
+def _inteiro(valor, mensagem):
+    """Número inteiro da célula ('3', '3.0' ou 3.0 do Excel); fração, inf/nan, fora de faixa ou texto viram ErroLinha."""
+    try:
+        numero = float(_texto(valor))
+        # também fora do INTEGER do SQLite (64 bits), que estouraria só na gravação do bloco
+        if not numero.is_integer() or abs(numero) >= 2 ** 63:
+            raise ValueError(numero)
+        return int(numero)
+    except (ValueError, OverflowError):
+        raise ErroLinha(mensagem)
+
+
+def _converter_validade(valor):
+    """Mesmas regras do formulário: DD/MM/YYYY ou YYYY-MM-DD (ou data vinda do Excel)."""
+    if isinstance(valor, datetime):
+        data = valor
+    elif isinstance(valor, date):
+        data = datetime(valor.year, valor.month, valor.day)
+    else:
+        texto = _texto(valor)
+        try:
+            data = datetime.strptime(texto, '%d/%m/%Y')
+        except ValueError:
+            try:
+                data = datetime.fromisoformat(texto)
+            except ValueError:
+                raise ErroLinha(f'Validade inválida: {texto!r}')
+    data = datetime(data.year, data.month, data.day)
+    return int(data.timestamp()), data.strftime('%d/%m/%Y')
+
+
+def converter_linha(campos):
+    """Valida e normaliza uma linha do arquivo."""
+    codigo = _texto(campos.get('codigo_de_barras'))
+    if not codigo:
+        raise ErroLinha('Código de barras vazio')
+    validade_int, validade_text = _converter_validade(campos.get('validade'))
+    quantidade = _inteiro(campos.get('quantidade'), 'Quantidade inválida')
+    if quantidade <= 0:
+        raise ErroLinha('Quantidade deve ser maior que zero')
+
+    nome = _texto(campos.get('produto_nome'))
+    dados = None
+    if nome:
+        categoria = _inteiro(campos.get('categoria'), 'Categoria inválida')
+        dados = {
+            'produto_nome': nome,
+            'lote': _texto(campos.get('lote')),
+            'categoria': categoria,
+            'image_path': _texto(campos.get('image_path')),
+        }
+    return {
+        'codigo_de_barras': codigo,
+        'validade_int': validade_int,
+        'validade_text': validade_text,
+        'quantidade': quantidade,
+        'dados': dados,
+    }
+
+
+def _importar_bloco(db, bloco, motivo):
+    """
+    Aplica um bloco já validado. O índice em memória (código, validade) -> lote
+    cobre só os códigos do bloco: busca os lotes existentes pelo índice do banco
+    e acumula as linhas repetidas antes de escrever.
+    """
+    codigos = sorted({linha['codigo_de_barras'] for _, linha in bloco})
+    marcadores = ','.join('?' * len(codigos))
+    indice = {}
+    for row in db.execute(SQL_LOTES_DO_BLOCO.format(marcadores=marcadores), codigos):
+        indice[(row['codigo_de_barras'], row['validade_text'])] = row['id']
+    # Linhas sem nome usam o catálogo (lote novo sem número de lote, como no modo rápido)
+    referencias = {row['codigo_de_barras']: dict(row, lote='')
+                   for row in db.execute(SQL_CATALOGO_DO_BLOCO.format(marcadores=marcadores), codigos)}
+    catalogo = {}       # código -> dados mais recentes do arquivo
+
+    atualizacoes = {}   # id do lote -> [delta, dados]
+    novos = {}          # (código, validade) -> linha acumulada
+    movimentos = []     # (chave, código, nome, quantidade)
+    erros = []
+    for numero, linha in bloco:
+        chave = (linha['codigo_de_barras'], linha['validade_text'])
+        dados = linha['dados']
+        if dados:
+            catalogo[linha['codigo_de_barras']] = dados
+        if chave in indice:
+            pendente = atualizacoes.setdefault(indice[chave], [0, None])
+            pendente[0] += linha['quantidade']
+            if dados:
+                pendente[1] = dados
+            nome = (dados or referencias[linha['codigo_de_barras']])['produto_nome']
+        elif chave in novos:
+            novos[chave]['quantidade'] += linha['quantidade']
+            if dados:
+                novos[chave]['dados'] = dados
+            nome = novos[chave]['dados']['produto_nome']
+        else:
+            if dados is None:
+                # Sem nome: como no modo rápido, usa o catálogo (ou uma linha anterior do arquivo)
+                dados = referencias.get(linha['codigo_de_barras'])
+                if dados is None:
+                    erros.append((numero, 'Produto não encontrado; informe produto_nome e categoria'))
+                    continue
+            novos[chave] = dict(linha, dados=dados)
+            nome = dados['produto_nome']
+        if linha['dados']:
+            referencias[linha['codigo_de_barras']] = dict(linha['dados'], lote='')
+        movimentos.append((chave, linha['codigo_de_barras'], nome, linha['quantidade']))
+
+    invalidar_codigos(*{codigo for _, codigo, _, _ in movimentos})
+    for codigo, dados in catalogo.items():
+        gravar_no_catalogo(db, codigo, dados)
+    if atualizacoes:
+        db.executemany('''
+            UPDATE estoque
+            SET quantidade = quantidade + ?,
+                produto_nome = COALESCE(?, produto_nome), lote = COALESCE(?, lote),
+                categoria = COALESCE(?, categoria), image_path = COALESCE(?, image_path)
+            WHERE id = ?
+        ''', [(delta, dados and dados['produto_nome'], dados and dados['lote'],
+               dados and dados['categoria'], dados and dados['image_path'], produto_id)
+              for produto_id, (delta, dados) in atualizacoes.items()])
+
+    for chave, linha in novos.items():
+        dados = linha['dados']
+        cursor = db.execute('''
+            INSERT INTO estoque (codigo_de_barras, lote, validade_int, validade_text, produto_nome, quantidade, categoria, image_path)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (linha['codigo_de_barras'], dados['lote'], linha['validade_int'], linha['validade_text'],
+              dados['produto_nome'], linha['quantidade'], dados['categoria'], dados['image_path']))
+        indice[chave] = cursor.lastrowid
+
+    db.executemany('''
+        INSERT INTO movimentacao (product_id, product_barcode, name, action, quantidade, motivo)
+        VALUES (?, ?, ?, 'entrada', ?, ?)
+    ''', [(indice[chave], codigo, nome, quantidade, motivo) for chave, codigo, nome, quantidade in movimentos])
+
+    return {
+        'importadas': len(movimentos),
+        'lotes_criados': len(novos),
+        'lotes_atualizados': len(atualizacoes),
+        'erros': erros,
+    }
+
+
+def importar_estoque(db, linhas, motivo='Importação', tamanho_bloco=TAMANHO_BLOCO_IMPORTACAO):
+    """
+    Importa as linhas geradas por ler_linhas() em transações de `tamanho_bloco` linhas.
+    Linhas inválidas são puladas e listadas no relatório; as demais são aplicadas.
+    `db` é uma conexão ou um PoolConexoes; com o pool, a conexão é emprestada só durante
+    cada bloco, e outras escritas (ajustes do balcão) passam entre um bloco e o seguinte.
+    Retorna o relatório com contagens, erros por linha e vazão.
+    """
+    relatorio = {'linhas': 0, 'importadas': 0, 'lotes_criados': 0, 'lotes_atualizados': 0,
+                 'total_erros': 0, 'erros': []}
+
+    def registrar_erro(numero, mensagem):
+        relatorio['total_erros'] += 1
+        if len(relatorio['erros']) < MAX_ERROS_RELATORIO:
+            relatorio['erros'].append({'linha': numero, 'erro': mensagem})
+
+    def aplicar(bloco):
+        if isinstance(db, PoolConexoes):
+            conn = db.obter()
+            try:
+                parcial = executar_transacao(conn, _importar_bloco, bloco, motivo)
+            finally:
+                db.devolver(conn)
+        else:
+            parcial = executar_transacao(db, _importar_bloco, bloco, motivo)
+        for campo in ('importadas', 'lotes_criados', 'lotes_atualizados'):
+            relatorio[campo] += parcial[campo]
+        for numero, mensagem in parcial['erros']:
+            registrar_erro(numero, mensagem)
+
+    inicio = time.monotonic()
+    bloco = []
+    for numero, campos in linhas:
+        relatorio['linhas'] += 1
+        try:
+            bloco.append((numero, converter_linha(campos)))
+        except ErroLinha as e:
+            registrar_erro(numero, str(e))
+            continue
+        if len(bloco) >= tamanho_bloco:
+            aplicar(bloco)
+            bloco = []
+    if bloco:
+        aplicar(bloco)
+
+    relatorio['erros'].sort(key=lambda erro: erro['linha'])
+    segundos = time.monotonic() - inicio
+    relatorio['segundos'] = round(segundos, 3)
+    relatorio['linhas_por_segundo'] = round(relatorio['linhas'] / segundos) if segundos > 0 else None
+    return relatorio
@@ -0,0 +1,609 @@
+# -*- coding: utf-8 -*-
+"""
+Migrações versionadas do banco de dados (SQLite)
+A versão do schema fica em PRAGMA user_version; cada migração roda uma única vez
+e dentro de uma transação, permitindo atualizar bancos existentes no lugar.
+"""
+
+import time
+from datetime import date, timedelta
+
+from busca import TOKENIZER_FTS, filtro_estoque
+from cache_codigos import SQL_LOTES_POR_CODIGO, SQL_PRODUTO_DO_CATALOGO
+from eventos import SQL_LOTES_ALTERADOS
+from exportacao import COLUNAS_BRUTAS, COLUNAS_XLSX
+from filtros_historico import FiltroHistorico, clausulas, consulta, resolver_periodo
+from importacao import SQL_CATALOGO_DO_BLOCO, SQL_LOTES_DO_BLOCO
+from paginacao import FILTRO_IDS, ORDEM_HISTORICO, ORDENACOES_HOME, sql_contagem, sql_pagina
+from previsao import SQL_NOMES_DOS_CODIGOS, SQL_RETIRADAS_DIARIAS, SQL_RISCO_DESPERDICIO, SQL_SALDOS_DOS_CODIGOS
+from registros import Movimentacao
+from servico_estoque import (SQL_LOTE_POR_CODIGO_E_LOTE, SQL_LOTE_POR_CODIGO_E_VALIDADE, SQL_LOTE_POR_ID,
+                             SQL_LOTE_POR_VALIDADE_TEXTO, SQL_LOTES_FEFO)
+from validade import SQL_VENCIMENTOS_POR_CATEGORIA, limites_validade, selecao_com_status
+from estatisticas import (SQL_CATEGORIAS, SQL_LER_ESTATISTICAS, criar_triggers_estoque, recalcular_estatisticas,
+                          sincronizar_limite_estoque_baixo)
+from razao import (SQL_PRIMEIRA_LINHA_NA_DATA, SQL_SNAPSHOT_ANTERIOR, SQL_SNAPSHOT_POSTERIOR, _gravar_snapshot,
+                   sql_saldos)
+from resumos import GRANULARIDADES, consulta_tendencia, sql_criar_tabela, sql_somar, reconstruir_resumos
+
+
+def _colunas(cursor, tabela):
+    """Retorna o conjunto de colunas existentes em uma tabela."""
+    return {row[1] for row in cursor.execute(f'PRAGMA table_info({tabela})').fetchall()}
+
+
+def _v1_schema_base(cursor):
+    """Cria as tabelas principais (bancos novos) e garante a coluna motivo (bancos antigos)."""
+    cursor.execute('''CREATE TABLE IF NOT EXISTS estoque(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        codigo_de_barras TEXT NOT NULL,
+        lote TEXT NOT NULL,
+        validade_int INTEGER NOT NULL,
+        validade_text TEXT NOT NULL,
+        produto_nome TEXT NOT NULL,
+        quantidade INTEGER,
+        image_path TEXT,
+        categoria INTEGER NOT NULL
+         )''') # Corrigi codigo_de_barras para TEXT para evitar erros com zeros a esquerda
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS movimentacao (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            product_id INTEGER NOT NULL,
+            product_barcode TEXT NOT NULL,
+            name TEXT NOT NULL,
+            action TEXT NOT NULL,
+            quantidade INTEGER NOT NULL,
+            motivo TEXT,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (product_id) REFERENCES estoque(id)
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS responsaveis (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            nome TEXT NOT NULL UNIQUE,
+            criado_em DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Bancos criados pelo scripts/seed_db.py antigo não têm a coluna motivo
+    if 'motivo' not in _colunas(cursor, 'movimentacao'):
+        cursor.execute('ALTER TABLE movimentacao ADD COLUMN motivo TEXT DEFAULT NULL')
+
+
+def _v2_indices(cursor):
+    """Índices compostos alinhados com as consultas reais das rotas."""
+    # /retirada, /api/produtos_por_codigo (WHERE codigo = ? ORDER BY validade_int)
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_estoque_codigo_validade ON estoque(codigo_de_barras, validade_int)')
+    # adicionar_produto: dedupe por código + validade_text
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_estoque_codigo_validade_text ON estoque(codigo_de_barras, validade_text)')
+    # /home: ordenação padrão e "próximo vencimento"
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_estoque_validade ON estoque(validade_int)')
+    # /home: filtro por categoria ordenado por validade e lista de categorias
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_estoque_categoria_validade ON estoque(categoria, validade_int)')
+    # /home: ordenação por nome e por quantidade (e contagem de estoque baixo)
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_estoque_nome ON estoque(produto_nome)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_estoque_quantidade ON estoque(quantidade)')
+    # movimentacao: ordenação do histórico e vínculo com o lote
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_movimentacao_timestamp ON movimentacao(timestamp)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_movimentacao_product_id ON movimentacao(product_id)')
+
+
+def _v3_timestamp_canonico(cursor):
+    """
+    Normaliza movimentacao.timestamp para o formato canônico 'YYYY-MM-DD HH:MM:SS'.
+    Os filtros de período comparam o texto com limites semiabertos, então valores
+    em epoch ou ISO com 'T' ficariam fora do intervalo.
+    """
+    cursor.execute('''
+        UPDATE movimentacao SET timestamp = datetime(timestamp, 'unixepoch')
+        WHERE typeof(timestamp) IN ('integer', 'real')
+    ''')
+    cursor.execute('''
+        UPDATE movimentacao SET timestamp = datetime(timestamp)
+        WHERE timestamp IS NOT NULL AND datetime(timestamp) IS NOT NULL
+          AND timestamp <> datetime(timestamp)
+    ''')
+
+
+def _v4_estatisticas(cursor):
+    """Tabelas de contadores do painel e triggers que as mantêm na mesma transação."""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS estatisticas_estoque (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            total_unidades INTEGER NOT NULL DEFAULT 0,
+            lotes_baixos INTEGER NOT NULL DEFAULT 0,
+            total_lotes INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS estatisticas_categoria (
+            categoria INTEGER PRIMARY KEY,
+            lotes INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS estatisticas_movimentacao_dia (
+            dia TEXT PRIMARY KEY,
+            total INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+
+    # "Estoque baixo" vem de estatisticas.LIMITE_ESTOQUE_BAIXO (ver sincronizar_limite_estoque_baixo)
+    criar_triggers_estoque(cursor)
+    _triggers_estatisticas_movimentacao(cursor)
+
+    recalcular_estatisticas(cursor)
+
+
+def _triggers_estatisticas_movimentacao(cursor):
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_estatisticas_movimentacao_insert AFTER INSERT ON movimentacao
+        WHEN NEW.timestamp IS NOT NULL
+        BEGIN
+            INSERT INTO estatisticas_movimentacao_dia (dia, total) VALUES (substr(NEW.timestamp, 1, 10), 1)
+                ON CONFLICT(dia) DO UPDATE SET total = total + 1;
+        END
+    ''')
+
+
+def _v5_busca_textual(cursor):
+    """Tabelas FTS5 (conteúdo externo) sobre estoque e movimentacao, sincronizadas por triggers."""
+    cursor.execute(f'''
+        CREATE VIRTUAL TABLE IF NOT EXISTS estoque_fts USING fts5(
+            produto_nome, codigo_de_barras,
+            content='estoque', content_rowid='id',
+            tokenize='{TOKENIZER_FTS}'
+        )
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_estoque_fts_insert AFTER INSERT ON estoque
+        BEGIN
+            INSERT INTO estoque_fts (rowid, produto_nome, codigo_de_barras)
+            VALUES (NEW.id, NEW.produto_nome, NEW.codigo_de_barras);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_estoque_fts_delete AFTER DELETE ON estoque
+        BEGIN
+            INSERT INTO estoque_fts (estoque_fts, rowid, produto_nome, codigo_de_barras)
+            VALUES ('delete', OLD.id, OLD.produto_nome, OLD.codigo_de_barras);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_estoque_fts_update AFTER UPDATE OF produto_nome, codigo_de_barras ON estoque
+        BEGIN
+            INSERT INTO estoque_fts (estoque_fts, rowid, produto_nome, codigo_de_barras)
+            VALUES ('delete', OLD.id, OLD.produto_nome, OLD.codigo_de_barras);
+            INSERT INTO estoque_fts (rowid, produto_nome, codigo_de_barras)
+            VALUES (NEW.id, NEW.produto_nome, NEW.codigo_de_barras);
+        END
+    ''')
+
+    cursor.execute(f'''
+        CREATE VIRTUAL TABLE IF NOT EXISTS movimentacao_fts USING fts5(
+            name, product_barcode,
+            content='movimentacao', content_rowid='id',
+            tokenize='{TOKENIZER_FTS}'
+        )
+    ''')
+    _triggers_movimentacao_fts(cursor)
+
+    # Indexa as linhas já existentes
+    cursor.execute("INSERT INTO estoque_fts (estoque_fts) VALUES ('rebuild')")
+    cursor.execute("INSERT INTO movimentacao_fts (movimentacao_fts) VALUES ('rebuild')")
+
+
+def _triggers_movimentacao_fts(cursor):
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_movimentacao_fts_insert AFTER INSERT ON movimentacao
+        BEGIN
+            INSERT INTO movimentacao_fts (rowid, name, product_barcode)
+            VALUES (NEW.id, NEW.name, NEW.product_barcode);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_movimentacao_fts_delete AFTER DELETE ON movimentacao
+        BEGIN
+            INSERT INTO movimentacao_fts (movimentacao_fts, rowid, name, product_barcode)
+            VALUES ('delete', OLD.id, OLD.name, OLD.product_barcode);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_movimentacao_fts_update AFTER UPDATE OF name, product_barcode ON movimentacao
+        BEGIN
+            INSERT INTO movimentacao_fts (movimentacao_fts, rowid, name, product_barcode)
+            VALUES ('delete', OLD.id, OLD.name, OLD.product_barcode);
+            INSERT INTO movimentacao_fts (rowid, name, product_barcode)
+            VALUES (NEW.id, NEW.name, NEW.product_barcode);
+        END
+    ''')
+
+
+def _v6_movimentacao_sem_fk(cursor):
+    """
+    Recria movimentacao sem a FOREIGN KEY para estoque(id).
+    O histórico precisa sobreviver à remoção de lotes zerados; com foreign_keys=ON
+    em toda conexão, a FK antiga faria falhar toda retirada que zera um lote.
+    """
+    seq = cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'movimentacao'").fetchone()
+    cursor.execute('''
+        CREATE TABLE movimentacao_nova (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            product_id INTEGER NOT NULL,
+            product_barcode TEXT NOT NULL,
+            name TEXT NOT NULL,
+            action TEXT NOT NULL,
+            quantidade INTEGER NOT NULL,
+            motivo TEXT,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        INSERT INTO movimentacao_nova (id, product_id, product_barcode, name, action, quantidade, motivo, timestamp)
+        SELECT id, product_id, product_barcode, name, action, quantidade, motivo, timestamp FROM movimentacao
+    ''')
+    # DROP remove também os índices e triggers da tabela antiga
+    cursor.execute('DROP TABLE movimentacao')
+    cursor.execute('ALTER TABLE movimentacao_nova RENAME TO movimentacao')
+    if seq is not None:
+        cursor.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = 'movimentacao'", (seq[0],))
+
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_movimentacao_timestamp ON movimentacao(timestamp)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_movimentacao_product_id ON movimentacao(product_id)')
+    _triggers_estatisticas_movimentacao(cursor)
+    _triggers_movimentacao_fts(cursor)
+
+
+def _v7_catalogo_produtos(cursor):
+    """
+    Catálogo de produtos por código de barras (nome, categoria, imagem), separado dos lotes.
+    É preenchido a partir dos lotes existentes (um registro por código, com os dados do lote
+    mais recente) e os lotes do mesmo código passam a ter os mesmos dados do catálogo.
+    Lotes continuam guardando uma cópia de nome/categoria/imagem: a home ordena e filtra por
+    elas com índices próprios (idx_estoque_nome, idx_estoque_categoria_validade) e a busca
+    FTS e os contadores por categoria as leem; o catálogo é a fonte e os triggers mantêm as cópias.
+    O catálogo não é apagado quando o estoque do código zera.
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS produtos (
+            codigo_de_barras TEXT PRIMARY KEY,
+            produto_nome TEXT NOT NULL,
+            categoria INTEGER NOT NULL,
+            image_path TEXT
+        ) WITHOUT ROWID
+    ''')
+    # Colunas "soltas" com MAX(id): o SQLite devolve os valores da linha de maior id do grupo
+    cursor.execute('''
+        INSERT OR IGNORE INTO produtos (codigo_de_barras, produto_nome, categoria, image_path)
+        SELECT codigo_de_barras, produto_nome, categoria, image_path
+        FROM (SELECT codigo_de_barras, produto_nome, categoria, image_path, MAX(id)
+              FROM estoque GROUP BY codigo_de_barras)
+    ''')
+    cursor.execute('''
+        UPDATE estoque SET
+            produto_nome = (SELECT p.produto_nome FROM produtos p WHERE p.codigo_de_barras = estoque.codigo_de_barras),
+            categoria = (SELECT p.categoria FROM produtos p WHERE p.codigo_de_barras = estoque.codigo_de_barras),
+            image_path = (SELECT p.image_path FROM produtos p WHERE p.codigo_de_barras = estoque.codigo_de_barras)
+        WHERE EXISTS (
+            SELECT 1 FROM produtos p WHERE p.codigo_de_barras = estoque.codigo_de_barras
+            AND (p.produto_nome IS NOT estoque.produto_nome OR p.categoria IS NOT estoque.categoria
+                 OR p.image_path IS NOT estoque.image_path)
+        )
+    ''')
+
+    # Lote gravado por qualquer caminho (inclusive scripts) garante o código no catálogo
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_produtos_lote_insert AFTER INSERT ON estoque
+        BEGIN
+            INSERT OR IGNORE INTO produtos (codigo_de_barras, produto_nome, categoria, image_path)
+            VALUES (NEW.codigo_de_barras, NEW.produto_nome, NEW.categoria, NEW.image_path);
+        END
+    ''')
+    # Alteração no catálogo vale para todos os lotes do código
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_produtos_update AFTER UPDATE OF produto_nome, categoria, image_path ON produtos
+        BEGIN
+            UPDATE estoque SET produto_nome = NEW.produto_nome, categoria = NEW.categoria, image_path = NEW.image_path
+            WHERE codigo_de_barras = NEW.codigo_de_barras
+              AND (produto_nome IS NOT NEW.produto_nome OR categoria IS NOT NEW.categoria
+                   OR image_path IS NOT NEW.image_path);
+        END
+    ''')
+
+
+def _v8_razao_estoque(cursor):
+    """
+    Livro-razão (razao_estoque): um delta assinado por mudança de quantidade de lote,
+    gravado por triggers e só de inserção; fotografias de saldo por lote (snapshots_estoque +
+    saldos_snapshot) gravadas por flask gravar-snapshot. Os saldos atuais entram como
+    linhas de abertura, seguidas da primeira fotografia; as duas só são gravadas com as
+    tabelas vazias, então reexecutar a migração não duplica saldos nem fotografias.
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS razao_estoque (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            produto_id INTEGER NOT NULL,
+            codigo_de_barras TEXT NOT NULL,
+            delta INTEGER NOT NULL,
+            momento TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_razao_momento ON razao_estoque(momento)')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS snapshots_estoque (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            momento TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            ultimo_razao_id INTEGER NOT NULL,
+            lotes INTEGER,
+            unidades INTEGER
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_snapshots_momento ON snapshots_estoque(momento)')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS saldos_snapshot (
+            snapshot_id INTEGER NOT NULL REFERENCES snapshots_estoque(id) ON DELETE CASCADE,
+            produto_id INTEGER NOT NULL,
+            codigo_de_barras TEXT NOT NULL,
+            quantidade INTEGER NOT NULL,
+            PRIMARY KEY (snapshot_id, produto_id)
+        ) WITHOUT ROWID
+    ''')
+
+    cursor.execute('''
+        INSERT INTO razao_estoque (produto_id, codigo_de_barras, delta)
+        SELECT id, codigo_de_barras, quantidade FROM estoque
+        WHERE quantidade IS NOT NULL AND quantidade <> 0
+          AND NOT EXISTS (SELECT 1 FROM razao_estoque)
+        ORDER BY id
+    ''')
+
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_razao_insert AFTER INSERT ON estoque
+        WHEN COALESCE(NEW.quantidade, 0) <> 0
+        BEGIN
+            INSERT INTO razao_estoque (produto_id, codigo_de_barras, delta)
+            VALUES (NEW.id, NEW.codigo_de_barras, NEW.quantidade);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_razao_update AFTER UPDATE OF quantidade, codigo_de_barras ON estoque
+        WHEN NEW.codigo_de_barras IS OLD.codigo_de_barras
+         AND COALESCE(NEW.quantidade, 0) <> COALESCE(OLD.quantidade, 0)
+        BEGIN
+            INSERT INTO razao_estoque (produto_id, codigo_de_barras, delta)
+            VALUES (NEW.id, NEW.codigo_de_barras, COALESCE(NEW.quantidade, 0) - COALESCE(OLD.quantidade, 0));
+        END
+    ''')
+    # Lote que troca de código: sai do código antigo e entra no novo (totais por código continuam certos)
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_razao_update_codigo AFTER UPDATE OF codigo_de_barras ON estoque
+        WHEN NEW.codigo_de_barras IS NOT OLD.codigo_de_barras
+        BEGIN
+            INSERT INTO razao_estoque (produto_id, codigo_de_barras, delta)
+            SELECT OLD.id, OLD.codigo_de_barras, -OLD.quantidade WHERE COALESCE(OLD.quantidade, 0) <> 0;
+            INSERT INTO razao_estoque (produto_id, codigo_de_barras, delta)
+            SELECT NEW.id, NEW.codigo_de_barras, NEW.quantidade WHERE COALESCE(NEW.quantidade, 0) <> 0;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_razao_delete AFTER DELETE ON estoque
+        WHEN COALESCE(OLD.quantidade, 0) <> 0
+        BEGIN
+            INSERT INTO razao_estoque (produto_id, codigo_de_barras, delta)
+            VALUES (OLD.id, OLD.codigo_de_barras, -OLD.quantidade);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_razao_somente_insercao_update BEFORE UPDATE ON razao_estoque
+        BEGIN
+            SELECT RAISE(ABORT, 'razao_estoque aceita apenas inserções');
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_razao_somente_insercao_delete BEFORE DELETE ON razao_estoque
+        BEGIN
+            SELECT RAISE(ABORT, 'razao_estoque aceita apenas inserções');
+        END
+    ''')
+
+    if cursor.execute('SELECT 1 FROM snapshots_estoque LIMIT 1').fetchone() is None:
+        _gravar_snapshot(cursor)
+
+
+def _v9_resumos_movimentacao(cursor):
+    """Resumos de movimentação por dia/semana/mês (resumos.py), somados por trigger e preenchidos com o histórico."""
+    for granularidade in GRANULARIDADES:
+        cursor.execute(sql_criar_tabela(granularidade))
+    somas = ''.join(sql_somar(granularidade) for granularidade in GRANULARIDADES)
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_resumos_movimentacao_insert AFTER INSERT ON movimentacao
+        WHEN datetime(NEW.timestamp) IS NOT NULL
+        BEGIN
+            {somas}
+        END
+    ''')
+    reconstruir_resumos(cursor)
+
+
+# Lista ordenada de migrações: (versão, descrição, função)
+MIGRACOES = [
+    (1, 'schema base', _v1_schema_base),
+    (2, 'indices de estoque e movimentacao', _v2_indices),
+    (3, 'timestamp canonico em movimentacao', _v3_timestamp_canonico),
+    (4, 'contadores do painel mantidos por triggers', _v4_estatisticas),
+    (5, 'busca textual FTS5', _v5_busca_textual),
+    (6, 'movimentacao sem FK para estoque', _v6_movimentacao_sem_fk),
+    (7, 'catalogo de produtos por codigo de barras', _v7_catalogo_produtos),
+    (8, 'livro-razao do estoque e snapshots de saldo', _v8_razao_estoque),
+    (9, 'resumos de movimentacao por dia, semana e mes', _v9_resumos_movimentacao),
+]
+
+VERSAO_ATUAL = MIGRACOES[-1][0]
+
+
+def versao_schema(db):
+    """Retorna a versão atual do schema gravada no banco."""
+    return db.execute('PRAGMA user_version').fetchone()[0]
+
+
+def aplicar_migracoes(db, ate=None):
+    """
+    Aplica, em ordem, todas as migrações com versão maior que a do banco.
+    Cada migração roda em sua própria transação (BEGIN IMMEDIATE) junto com a atualização
+    de user_version; a versão é relida já com a trava de escrita, então processos ou threads
+    migrando ao mesmo tempo nunca aplicam a mesma migração duas vezes.
+    ate limita a versão final (verificações que precisam de um banco numa versão antiga).
+    Depois, se LIMITE_ESTOQUE_BAIXO mudou desde que os triggers foram criados, eles são
+    recriados e os contadores recalculados.
+    Retorna a lista de versões aplicadas.
+    """
+    aplicadas = []
+    for numero, descricao, funcao in MIGRACOES:
+        if ate is not None and numero > ate:
+            break
+        if numero <= versao_schema(db):
+            continue
+        cursor = db.cursor()
+        try:
+            cursor.execute('BEGIN IMMEDIATE')
+            if numero <= versao_schema(db):
+                # Outra conexão aplicou enquanto esperávamos a trava
+                db.rollback()
+                continue
+            funcao(cursor)
+            cursor.execute(f'PRAGMA user_version = {int(numero)}')
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        aplicadas.append(numero)
+    if versao_schema(db) >= 4:
+        sincronizar_limite_estoque_baixo(db)
+    return aplicadas
+
+
+# --------------------------------------------------------------------------
+# VERIFICAÇÃO DE PLANOS DE CONSULTA
+# --------------------------------------------------------------------------
+
+# Consultas usadas pelas rotas, com parâmetros de exemplo: (nome, sql, params).
+# O SQL vem das mesmas constantes/funções que as rotas executam, nunca de cópias.
+_HOJE = int(time.time())
+_DIA = date.today()
+_LIMITES = tuple(limites_validade(_DIA))
+_HOJE_PERIODO = resolver_periodo('today', hoje=_DIA)
+_TODAS = resolver_periodo('all', hoje=_DIA)
+_FIM = (_DIA + timedelta(days=1)).isoformat()
+_CODIGOS = ('7890000000000', '7890000000001')
+
+
+def _pagina_home(nome, ordenar, where_clauses, params, ancora):
+    colunas, descendente = ORDENACOES_HOME[ordenar]
+    return (nome, sql_pagina('estoque', where_clauses, colunas, descendente, True, selecao_com_status()),
+            _LIMITES + tuple(params) + ancora + (25,))
+
+
+def _pagina_historico(nome, filtro):
+    where_clauses, params = clausulas(filtro)
+    return (nome, sql_pagina('movimentacao', where_clauses, *ORDEM_HISTORICO, True, Movimentacao.COLUNAS_SQL),
+            tuple(params) + (_FIM, 1, 51))
+
+
+def _contagem_historico(nome, filtro):
+    where_clauses, params = clausulas(filtro)
+    return nome, sql_contagem('movimentacao', where_clauses), tuple(params)
+
+
+def _consulta_historico(nome, filtro, colunas, *ordem):
+    sql, params = consulta(filtro, colunas, *ordem)
+    return nome, sql, tuple(params)
+
+
+def _tendencia(nome, *args, **kwargs):
+    sql, params = consulta_tendencia(*args, **kwargs)
+    return nome, sql, tuple(params)
+
+
+_busca_estoque, _params_busca_estoque = filtro_estoque('acucar')
+_marcadores = ', '.join('?' * len(_CODIGOS))
+
+CONSULTAS_ROTAS = [
+    ('retirada: busca por codigo + validade', SQL_LOTE_POR_CODIGO_E_VALIDADE, (_CODIGOS[0], _HOJE)),
+    ('retirada: busca por codigo + lote', SQL_LOTE_POR_CODIGO_E_LOTE, (_CODIGOS[0], 'L1')),
+    ('api_produtos_por_codigo', SQL_LOTES_POR_CODIGO, (_CODIGOS[0],)),
+    ('api_retirar_fefo: lotes do codigo em ordem de vencimento', SQL_LOTES_FEFO, (_CODIGOS[0], _HOJE)),
+    ('adicionar_produto: dedupe', SQL_LOTE_POR_VALIDADE_TEXTO, (_CODIGOS[0], '01/01/2030')),
+    ('adicionar_produto: produto do catalogo', SQL_PRODUTO_DO_CATALOGO, (_CODIGOS[0],)),
+    ('importar_estoque: lotes do bloco', SQL_LOTES_DO_BLOCO.format(marcadores=_marcadores), _CODIGOS),
+    ('importar_estoque: catalogo do bloco', SQL_CATALOGO_DO_BLOCO.format(marcadores=_marcadores), _CODIGOS),
+    ('retirada_com_id / api: busca por id', SQL_LOTE_POR_ID, (1,)),
+    _pagina_home('home: ordenado por validade (cursor)', 'validade', [], [], (_HOJE, 1)),
+    _pagina_home('home: ordenado por nome (cursor)', 'nome', [], [], ('Arroz', 1)),
+    _pagina_home('home: ordenado por quantidade (cursor)', 'quantidade', [], [], (10, 1)),
+    _pagina_home('home: filtro por categoria (cursor)', 'validade', ['categoria = ?'], [1], (_HOJE, 1)),
+    _pagina_home('home: busca textual (cursor)', 'validade', [_busca_estoque], _params_busca_estoque, (_HOJE, 1)),
+    _pagina_home('home: filtro de risco de desperdicio', 'validade', [FILTRO_IDS], ['[1, 2, 3]'], (_HOJE, 1)),
+    ('home: contagem com filtro', sql_contagem('estoque', ['categoria = ?', _busca_estoque]),
+     (1,) + tuple(_params_busca_estoque)),
+    ('api_vencimentos: contagem por categoria', SQL_VENCIMENTOS_POR_CATEGORIA,
+     (_LIMITES[0], _LIMITES[0], _LIMITES[1], _LIMITES[1], _LIMITES[2])),
+    ('home: estatisticas do painel', SQL_LER_ESTATISTICAS, (_DIA.isoformat(), _HOJE)),
+    ('home: categorias', SQL_CATEGORIAS, ()),
+    _contagem_historico('historico: busca textual', FiltroHistorico(_TODAS, None, 'arroz', None)),
+    _pagina_historico('historico: periodo (cursor)', FiltroHistorico(_HOJE_PERIODO, None, None, None)),
+    _contagem_historico('historico: periodo + acao', FiltroHistorico(_HOJE_PERIODO, 'retirada', None, None)),
+    _pagina_historico('historico: todas (cursor)', FiltroHistorico(_TODAS, None, None, None)),
+    _consulta_historico('exportar_historico: periodo', FiltroHistorico(_HOJE_PERIODO, None, None, None),
+                        COLUNAS_XLSX),
+    _consulta_historico('exportar_historico: versao do periodo encerrado',
+                        FiltroHistorico(_HOJE_PERIODO, None, None, None), 'MAX(id), COUNT(*)', None),
+    _consulta_historico('exportar_historico/<formato>: periodo', FiltroHistorico(_HOJE_PERIODO, None, None, None),
+                        COLUNAS_BRUTAS, 'id ASC'),
+    _consulta_historico('exportar_historico/<formato>: incremental (since_id)',
+                        FiltroHistorico(_TODAS, None, None, 1000), COLUNAS_BRUTAS, 'id ASC'),
+    ('api_estoque_em: primeira linha do razao na data', SQL_PRIMEIRA_LINHA_NA_DATA, (_FIM,)),
+    ('api_estoque_em: snapshot anterior', SQL_SNAPSHOT_ANTERIOR, (_FIM,)),
+    ('api_estoque_em: snapshot posterior', SQL_SNAPSHOT_POSTERIOR, (_FIM,)),
+    ('api_estoque_em: snapshot + reproducao do razao', sql_saldos(True, False), (1, 1, 0, 1000)),
+    ('api_estoque_em: snapshot + reproducao do razao de um codigo', sql_saldos(True, True),
+     (1, _CODIGOS[0], 1, 0, 1000, _CODIGOS[0])),
+    _tendencia('api_tendencias: por mes e codigo', 'mes', _DIA, _DIA, 'codigo', acao='retirada'),
+    _tendencia('api_tendencias: por dia, total de um codigo', 'dia', _DIA, _DIA + timedelta(days=1),
+               codigo=_CODIGOS[0]),
+    ('previsao_consumo: retiradas diarias da janela', SQL_RETIRADAS_DIARIAS, (_DIA.isoformat(), _FIM)),
+    ('previsao_consumo: saldo dos codigos consumidos', SQL_SALDOS_DOS_CODIGOS.format(marcadores=_marcadores),
+     _CODIGOS),
+    ('previsao_consumo: nome dos codigos consumidos', SQL_NOMES_DOS_CODIGOS.format(marcadores=_marcadores),
+     _CODIGOS),
+    ('risco_desperdicio: lotes vencendo no horizonte, em ordem FEFO por codigo', SQL_RISCO_DESPERDICIO,
+     ('{"7890000000000": 1.5}', _HOJE, _HOJE, _HOJE + 60 * 86400)),
+    ('api_eventos_estoque: lotes alterados na transacao', SQL_LOTES_ALTERADOS, (0,)),
+]
+
+
+# Tabelas de tamanho limitado (uma linha por categoria etc.) que podem ser lidas inteiras
+TABELAS_PEQUENAS = {'estatisticas_categoria'}
+
+
+def verificar_planos(db, consultas=None):
+    """
+    Roda EXPLAIN QUERY PLAN em cada consulta registrada e retorna a lista de
+    problemas (nome, detalhe) para as que caem em SCAN completo da tabela.
+    Varreduras que usam um índice (SCAN ... USING INDEX) ou que leem o resultado
+    de uma subconsulta são aceitas.
+    """
+    problemas = []
+    for nome, sql, params in (consultas or CONSULTAS_ROTAS):
+        plano = [row[3] for row in db.execute(f'EXPLAIN QUERY PLAN {sql}', params).fetchall()]
+        # Subconsultas no FROM (MATERIALIZE s / CO-ROUTINE (subquery-N)): o SCAN delas lê o resultado, não uma tabela
+        derivadas = {detalhe.split(' ', 1)[1] for detalhe in plano if detalhe.startswith(('MATERIALIZE ', 'CO-ROUTINE '))}
+        for detalhe in plano:
+            if not detalhe.startswith('SCAN') or 'INDEX' in detalhe or 'CONSTANT ROW' in detalhe:
+                continue
+            if detalhe.split()[1] in TABELAS_PEQUENAS or detalhe.split(' ', 1)[1] in derivadas:
+                continue
+            problemas.append((nome, detalhe))
+    return problemas
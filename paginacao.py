@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""
+SQL da paginação por chave (keyset) das listagens (/home e /historico)
+app.buscar_pagina e app.contar_com_cache montam as consultas aqui, e
+migracoes.verificar_planos confere os planos das mesmas consultas.
+"""
+
+# Ordenações da home (?ordenar=) -> (colunas da chave, descendente); id desempata
+ORDENACOES_HOME = {
+    'validade': (('validade_int', 'id'), False),
+    'nome': (('produto_nome', 'id'), False),
+    'quantidade': (('quantidade', 'id'), True),
+}
+
+# Histórico: mais recentes primeiro
+ORDEM_HISTORICO = (('timestamp', 'id'), True)
+
+# Colunas da chave guardada em cada tipo de cursor (modo do token -> colunas)
+COLUNAS_POR_CURSOR = dict({modo: colunas for modo, (colunas, _) in ORDENACOES_HOME.items()},
+                          historico=ORDEM_HISTORICO[0])
+
+# Filtro por uma lista de ids em JSON (ex: lotes com desperdício previsto, ?risco=1 da home)
+FILTRO_IDS = 'id IN (SELECT value FROM json_each(?))'
+
+
+def sql_pagina(tabela, where_clauses, colunas, descendente, com_ancora, selecao='*'):
+    """
+    SELECT de uma página ordenada por colunas, continuando depois da âncora (chave da
+    última linha vista) quando com_ancora. Parâmetros: os da selecao, os das cláusulas,
+    os valores da âncora e o LIMIT.
+    """
+    clauses = list(where_clauses)
+    if com_ancora:
+        marcadores = ', '.join('?' * len(colunas))
+        clauses.append(f"({', '.join(colunas)}) {'<' if descendente else '>'} ({marcadores})")
+    where_sql = ('WHERE ' + ' AND '.join(clauses)) if clauses else ''
+    ordem = ' DESC' if descendente else ' ASC'
+    order_sql = ', '.join(c + ordem for c in colunas)
+    return f'SELECT {selecao} FROM {tabela} {where_sql} ORDER BY {order_sql} LIMIT ?'
+
+
+def sql_contagem(tabela, where_clauses):
+    """COUNT(*) AS cnt para as cláusulas (mesmos parâmetros delas)."""
+    where_sql = ('WHERE ' + ' AND '.join(where_clauses)) if where_clauses else ''
+    return f'SELECT COUNT(*) as cnt FROM {tabela} {where_sql}'
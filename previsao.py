@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+"""
+Previsão de consumo e ponto de reposição por código de barras
+A taxa diária de consumo de cada código é a suavização exponencial das retiradas
+diárias (resumo_movimentacao_dia, ver resumos.py) nos últimos JANELA_DIAS_CONSUMO
+dias completos. Com a taxa e o saldo atual saem os dias de cobertura e o ponto de
+reposição (consumo esperado durante o prazo de reposição mais a margem de segurança).
+
+As taxas só usam dias já fechados (UTC), então são calculadas uma vez por dia e
+ficam em cache por processo; o saldo é lido a cada consulta, de modo que cobertura
+e alerta de reposição acompanham cada movimentação. NumPy é usado se estiver
+instalado; sem ele o mesmo cálculo roda em Python puro.
+
+Risco de desperdício: supondo retiradas em ordem de vencimento (FEFO) à taxa do
+código, cada lote só é consumido depois dos que vencem antes dele (ou depois que
+eles vencem); o que sobra dele na data de validade é a perda prevista. O cálculo é
+uma única consulta com funções de janela sobre todos os lotes e fica em cache até a próxima mudança de
+estoque (último id do livro-razão, ver razao.py).
+"""
+
+import json
+import math
+import threading
+from datetime import date, timedelta
+
+from validade import limites_validade
+
+try:
+    import numpy as np
+except ImportError:  # opcional: só acelera o cálculo
+    np = None
+
+# Dias completos de retiradas considerados
+JANELA_DIAS_CONSUMO = 56
+
+# Peso do dia mais recente na suavização exponencial (0 < alfa <= 1)
+ALFA_SUAVIZACAO = 0.2
+
+# Dias entre pedir e receber a reposição, e margem de segurança em dias de consumo
+DIAS_REPOSICAO = 7
+DIAS_SEGURANCA = 3
+
+# Dias da média móvel simples devolvida junto (referência para a taxa suavizada)
+DIAS_MEDIA_MOVEL = 7
+
+# Lotes considerados no risco de desperdício: vencendo em até N dias
+DIAS_HORIZONTE_DESPERDICIO = 60
+
+# Retiradas diárias da janela (parâmetros: primeiro e último dia, 'YYYY-MM-DD')
+SQL_RETIRADAS_DIARIAS = '''
+    SELECT periodo, product_barcode, SUM(quantidade) FROM resumo_movimentacao_dia
+    WHERE periodo >= ? AND periodo <= ? AND action = 'retirada'
+    GROUP BY periodo, product_barcode
+'''
+
+# Saldo e nome dos códigos consumidos ({marcadores}: um ? por código)
+SQL_SALDOS_DOS_CODIGOS = '''
+    SELECT codigo_de_barras, SUM(quantidade) FROM estoque
+    WHERE codigo_de_barras IN ({marcadores})
+    GROUP BY codigo_de_barras
+'''
+SQL_NOMES_DOS_CODIGOS = '''
+    SELECT codigo_de_barras, produto_nome FROM produtos WHERE codigo_de_barras IN ({marcadores})
+'''
+
+# Parâmetros: taxas em JSON {codigo: taxa}, hoje, hoje, limite do horizonte (timestamps de validade).
+# Por código, em ordem de validade: demanda até o fim do dia da validade D = taxa * dias e
+# saldo acumulado S (este lote incluído). O consumido acumulado é C = min(C_anterior + q, D),
+# que desenrolado dá C = S + min(0, menor (D - S) até aqui): duas funções de janela.
+SQL_RISCO_DESPERDICIO = '''
+    WITH taxas(codigo, taxa) AS (SELECT key, value FROM json_each(?)),
+    lotes AS (
+        SELECT e.id, e.codigo_de_barras, e.produto_nome, e.lote, e.validade_text, e.validade_int,
+               e.quantidade, COALESCE(t.taxa, 0) AS taxa_diaria,
+               CAST(ROUND((e.validade_int - ?) / 86400.0) AS INTEGER) + 1 AS dias_ate_vencer,
+               SUM(e.quantidade) OVER fefo AS acumulado
+        FROM estoque e LEFT JOIN taxas t ON t.codigo = e.codigo_de_barras
+        WHERE e.validade_int >= ? AND e.validade_int < ? AND e.quantidade > 0
+        WINDOW fefo AS (PARTITION BY e.codigo_de_barras ORDER BY e.validade_int, e.id)
+    ),
+    consumo AS (
+        SELECT *, acumulado + MIN(0, MIN(taxa_diaria * dias_ate_vencer - acumulado) OVER fefo) AS consumido
+        FROM lotes
+        WINDOW fefo AS (PARTITION BY codigo_de_barras ORDER BY validade_int, id)
+    ),
+    projecao AS (
+        SELECT *, CAST(ROUND(quantidade - consumido + COALESCE(LAG(consumido) OVER fefo, 0)) AS INTEGER)
+                  AS desperdicio
+        FROM consumo
+        WINDOW fefo AS (PARTITION BY codigo_de_barras ORDER BY validade_int, id)
+    )
+    SELECT id, codigo_de_barras, produto_nome, lote, validade_text, quantidade,
+           ROUND(taxa_diaria, 2) AS taxa_diaria, dias_ate_vencer, desperdicio
+    FROM projecao
+    WHERE desperdicio > 0
+    ORDER BY desperdicio DESC, validade_int ASC, id ASC
+'''
+
+_cache_taxas = {}
+_lock_taxas = threading.Lock()
+_cache_risco = {}
+
+
+def _pesos(n, alfa):
+    # nível após n dias partindo da média da janela:
+    # sum(alfa * (1 - alfa)^(n-1-k) * x_k) + (1 - alfa)^n * média
+    return [alfa * (1 - alfa) ** (n - 1 - k) + (1 - alfa) ** n / n for k in range(n)]
+
+
+def suavizar(series, alfa=ALFA_SUAVIZACAO):
+    """
+    Taxa suavizada e média móvel dos últimos DIAS_MEDIA_MOVEL dias de cada série
+    (listas de mesmo tamanho, dia mais antigo primeiro). Retorna [(taxa, media_movel)].
+    """
+    if not series:
+        return []
+    n = len(series[0])
+    pesos = _pesos(n, alfa)
+    movel = min(DIAS_MEDIA_MOVEL, n)
+    if np is not None:
+        matriz = np.asarray(series, dtype=float)
+        return list(zip((matriz @ np.asarray(pesos)).tolist(), matriz[:, -movel:].mean(axis=1).tolist()))
+    return [(sum(p * x for p, x in zip(pesos, serie)), sum(serie[-movel:]) / movel) for serie in series]
+
+
+def _calcular_taxas(db, hoje):
+    inicio, fim = hoje - timedelta(days=JANELA_DIAS_CONSUMO), hoje - timedelta(days=1)
+    dias = {(inicio + timedelta(days=i)).isoformat(): i for i in range(JANELA_DIAS_CONSUMO)}
+    series = {}
+    for periodo, codigo, quantidade in db.execute(SQL_RETIRADAS_DIARIAS, (inicio.isoformat(), fim.isoformat())):
+        serie = series.get(codigo)
+        if serie is None:
+            serie = series[codigo] = [0] * JANELA_DIAS_CONSUMO
+        serie[dias[periodo]] = quantidade or 0
+    codigos = list(series)
+    return dict(zip(codigos, suavizar([series[codigo] for codigo in codigos])))
+
+
+def taxas_de_consumo(db, hoje=None):
+    """{codigo: (taxa diária suavizada, média móvel)} dos códigos com retiradas na janela, em cache por dia."""
+    hoje = hoje or date.today()
+    with _lock_taxas:
+        taxas = _cache_taxas.get(hoje)
+    if taxas is None:
+        taxas = _calcular_taxas(db, hoje)
+        with _lock_taxas:
+            _cache_taxas.clear()
+            _cache_taxas[hoje] = taxas
+    return taxas
+
+
+def limpar_cache_previsao():
+    """Descarta as taxas e o risco de desperdício em cache (troca de banco ou resumos reconstruídos)."""
+    with _lock_taxas:
+        _cache_taxas.clear()
+        _cache_risco.clear()
+
+
+def previsao_consumo(db, hoje=None, codigo=None, so_repor=False):
+    """
+    Cobertura e ponto de reposição dos códigos consumidos na janela (os demais não têm
+    consumo para prever). Ordenado por urgência: primeiro os que já estão no ponto de
+    reposição, depois por dias de cobertura. Cada item: codigo_de_barras, produto_nome,
+    estoque, taxa_diaria, media_movel, dias_cobertura, ponto_reposicao, repor.
+    """
+    taxas = taxas_de_consumo(db, hoje)
+    codigos = [codigo] if codigo is not None else [c for c, (taxa, _) in taxas.items() if taxa > 0]
+    codigos = [c for c in codigos if c in taxas]
+    if not codigos:
+        return []
+    marcadores = ', '.join('?' * len(codigos))
+    saldos = dict(db.execute(SQL_SALDOS_DOS_CODIGOS.format(marcadores=marcadores), codigos).fetchall())
+    nomes = dict(db.execute(SQL_NOMES_DOS_CODIGOS.format(marcadores=marcadores), codigos).fetchall())
+
+    itens = []
+    for c in codigos:
+        taxa, media_movel = taxas[c]
+        estoque = saldos.get(c) or 0
+        ponto = math.ceil(taxa * (DIAS_REPOSICAO + DIAS_SEGURANCA)) if taxa > 0 else 0
+        repor = taxa > 0 and estoque <= ponto
+        if so_repor and not repor:
+            continue
+        itens.append({
+            'codigo_de_barras': c,
+            'produto_nome': nomes.get(c),
+            'estoque': estoque,
+            'taxa_diaria': round(taxa, 2),
+            'media_movel': round(media_movel, 2),
+            'dias_cobertura': round(estoque / taxa, 1) if taxa > 0 else None,
+            'ponto_reposicao': ponto,
+            'repor': repor,
+        })
+    itens.sort(key=lambda item: (not item['repor'],
+                                 item['dias_cobertura'] if item['dias_cobertura'] is not None else math.inf,
+                                 item['codigo_de_barras']))
+    return itens
+
+
+def _calcular_risco(db, hoje, horizonte_dias, taxas):
+    limites = limites_validade(hoje)
+    limite = limites_validade(hoje + timedelta(days=horizonte_dias)).hoje
+    return [dict(row) for row in db.execute(SQL_RISCO_DESPERDICIO, (
+        json.dumps({codigo: taxa for codigo, (taxa, _) in taxas.items()}), limites.hoje, limites.hoje, limite))]
+
+
+def risco_desperdicio(db, hoje=None, horizonte_dias=DIAS_HORIZONTE_DESPERDICIO):
+    """
+    Lotes que devem vencer com saldo, do maior para o menor desperdício previsto (unidades).
+    Cada item: id, codigo_de_barras, produto_nome, lote, validade_text, quantidade,
+    taxa_diaria, dias_ate_vencer, desperdicio. Lista compartilhada do cache; não alterar.
+    """
+    hoje = hoje or date.today()
+    versao = db.execute('SELECT MAX(id) FROM razao_estoque').fetchone()[0]
+    chave = (hoje, horizonte_dias, versao)
+    with _lock_taxas:
+        lotes = _cache_risco.get(chave)
+    if lotes is None:
+        lotes = _calcular_risco(db, hoje, horizonte_dias, taxas_de_consumo(db, hoje))
+        with _lock_taxas:
+            # só a versão atual do estoque interessa
+            _cache_risco.clear()
+            _cache_risco[chave] = lotes
+    return lotes
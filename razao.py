@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+Livro-razão do estoque e fotografias (snapshots) de saldo por lote
+Toda mudança de estoque.quantidade (inserção, UPDATE, remoção de lote) acrescenta
+uma linha com o delta assinado em razao_estoque, por trigger (ver migracoes.py),
+então nenhum caminho de escrita fica de fora. A tabela só aceita inserção.
+
+Um job agendado (flask gravar-snapshot, via cron) grava o saldo de cada lote em
+saldos_snapshot junto com o último id do razão incluído. O saldo numa data é
+calculado a partir da fotografia mais próxima (antes ou depois da data) mais a
+reprodução só das linhas do razão entre as duas, por faixa de id.
+Momentos em UTC, no mesmo texto canônico de movimentacao.timestamp.
+"""
+
+from servico_estoque import executar_transacao
+
+# Consultas de saldos_em (parâmetro: a data); conferidas por migracoes.verificar_planos
+SQL_PRIMEIRA_LINHA_NA_DATA = 'SELECT id FROM razao_estoque WHERE momento >= ? ORDER BY momento, id LIMIT 1'
+SQL_SNAPSHOT_ANTERIOR = 'SELECT * FROM snapshots_estoque WHERE momento < ? ORDER BY momento DESC, id DESC LIMIT 1'
+SQL_SNAPSHOT_POSTERIOR = 'SELECT * FROM snapshots_estoque WHERE momento >= ? ORDER BY momento ASC, id ASC LIMIT 1'
+
+
+def _gravar_snapshot(db):
+    ultimo = db.execute('SELECT COALESCE(MAX(id), 0) FROM razao_estoque').fetchone()[0]
+    cursor = db.execute('INSERT INTO snapshots_estoque (ultimo_razao_id) VALUES (?)', (ultimo,))
+    snapshot_id = cursor.lastrowid
+    db.execute('''
+        INSERT INTO saldos_snapshot (snapshot_id, produto_id, codigo_de_barras, quantidade)
+        SELECT ?, id, codigo_de_barras, quantidade FROM estoque
+        WHERE quantidade IS NOT NULL AND quantidade <> 0
+    ''', (snapshot_id,))
+    lotes, unidades = db.execute('''
+        SELECT COUNT(*), COALESCE(SUM(quantidade), 0) FROM saldos_snapshot WHERE snapshot_id = ?
+    ''', (snapshot_id,)).fetchone()
+    db.execute('UPDATE snapshots_estoque SET lotes = ?, unidades = ? WHERE id = ?', (lotes, unidades, snapshot_id))
+    return {'snapshot_id': snapshot_id, 'ultimo_razao_id': ultimo, 'lotes': lotes, 'unidades': unidades}
+
+
+def gravar_snapshot(db, manter=None):
+    """
+    Grava o saldo atual de todos os lotes (com a trava de escrita, então fica coerente
+    com o razão). Com manter=N remove as fotografias mais antigas além das N mais recentes.
+    """
+    resultado = executar_transacao(db, _gravar_snapshot)
+    if manter:
+        resultado['removidos'] = executar_transacao(db, _podar_snapshots, manter)
+    return resultado
+
+
+def _podar_snapshots(db, manter):
+    # saldos_snapshot sai junto (ON DELETE CASCADE)
+    return db.execute('''
+        DELETE FROM snapshots_estoque WHERE id NOT IN (
+            SELECT id FROM snapshots_estoque ORDER BY id DESC LIMIT ?
+        )
+    ''', (manter,)).rowcount
+
+
+def _snapshot_vizinho(db, ate, anterior):
+    return db.execute(SQL_SNAPSHOT_ANTERIOR if anterior else SQL_SNAPSHOT_POSTERIOR, (ate,)).fetchone()
+
+
+def sql_saldos(com_snapshot, por_codigo):
+    """
+    Saldo por lote = fotografia (se houver) + sinal * deltas do razão numa faixa de id.
+    Parâmetros: [snapshot_id, [codigo]], sinal, id inicial e final (exclusivos), [codigo].
+    """
+    filtro_codigo = 'AND codigo_de_barras = ?' if por_codigo else ''
+    partes = []
+    if com_snapshot:
+        partes.append(f'''SELECT produto_id, codigo_de_barras, quantidade AS q FROM saldos_snapshot
+                          WHERE snapshot_id = ? {filtro_codigo}''')
+    partes.append(f'''SELECT produto_id, codigo_de_barras, ? * delta AS q FROM razao_estoque
+                      WHERE id > ? AND id < ? {filtro_codigo}''')
+    # O nome vem do catálogo, que continua existindo depois que o lote é removido
+    return f'''
+        SELECT s.produto_id, s.codigo_de_barras, p.produto_nome, s.quantidade
+        FROM (SELECT produto_id, codigo_de_barras, SUM(q) AS quantidade
+              FROM ({' UNION ALL '.join(partes)})
+              GROUP BY produto_id
+              HAVING SUM(q) <> 0) s
+        LEFT JOIN produtos p ON p.codigo_de_barras = s.codigo_de_barras
+        ORDER BY s.produto_id
+    '''
+
+
+def saldos_em(db, ate, codigo=None):
+    """
+    Saldo de cada lote considerando só o que aconteceu antes de `ate` (texto
+    'YYYY-MM-DD' ou 'YYYY-MM-DD HH:MM:SS', exclusivo), opcionalmente de um código.
+    Parte da fotografia mais próxima e reproduz as linhas do razão entre ela e a data:
+    para a frente (fotografia anterior + deltas) ou para trás (posterior - deltas),
+    o que tiver menos linhas. Retorna {lotes: [...], base: {...}}.
+    """
+    # Primeira linha do razão na data ou depois: as linhas anteriores a ela são as que contam
+    row = db.execute(SQL_PRIMEIRA_LINHA_NA_DATA, (ate,)).fetchone()
+    corte = row[0] if row else db.execute('SELECT COALESCE(MAX(id), 0) + 1 FROM razao_estoque').fetchone()[0]
+
+    anterior, posterior = _snapshot_vizinho(db, ate, True), _snapshot_vizinho(db, ate, False)
+    para_frente = corte - 1 - (anterior['ultimo_razao_id'] if anterior else 0)
+    para_tras = posterior['ultimo_razao_id'] - corte + 1 if posterior else None
+
+    if para_tras is not None and para_tras < para_frente:
+        base, sinal, faixa, linhas = posterior, -1, (corte - 1, posterior['ultimo_razao_id'] + 1), max(para_tras, 0)
+    else:
+        base, sinal, faixa, linhas = anterior, 1, ((anterior['ultimo_razao_id'] if anterior else 0), corte), para_frente
+
+    params = []
+    if base is not None:
+        params += [base['id']] + ([codigo] if codigo else [])
+    params += [sinal, faixa[0], faixa[1]] + ([codigo] if codigo else [])
+    lotes = [dict(r) for r in db.execute(sql_saldos(base is not None, bool(codigo)), params)]
+    return {
+        'lotes': lotes,
+        'base': {
+            'snapshot_id': base['id'] if base else None,
+            'snapshot_momento': base['momento'] if base else None,
+            'direcao': 'para_frente' if sinal > 0 else 'para_tras',
+            'linhas_reproduzidas': linhas,
+        },
+    }
+
+
+def _divergencias(db, snapshot, ate_id, atual_sql, atual_params):
+    """Lotes em que fotografia + razão (até ate_id, inclusive) != saldo de atual_sql, numa passada."""
+    partes = [f'SELECT produto_id, 0 AS r, q AS a FROM ({atual_sql})']
+    params = list(atual_params)
+    if snapshot is not None:
+        partes.append('SELECT produto_id, quantidade, 0 FROM saldos_snapshot WHERE snapshot_id = ?')
+        params.append(snapshot['id'])
+    partes.append('SELECT produto_id, delta, 0 FROM razao_estoque WHERE id > ? AND id <= ?')
+    params += [snapshot['ultimo_razao_id'] if snapshot else 0, ate_id]
+    return [{'produto_id': r[0], 'razao': r[1], 'atual': r[2]} for r in db.execute(f'''
+        SELECT produto_id, SUM(r), SUM(a) FROM ({' UNION ALL '.join(partes)})
+        GROUP BY produto_id
+        HAVING SUM(r) <> SUM(a)
+        ORDER BY produto_id
+    ''', params)]
+
+
+def verificar_razao(db, completo=False):
+    """
+    Confere, numa passada por tabela, que a última fotografia mais os deltas posteriores
+    dão exatamente estoque.quantidade de cada lote. Com completo=True confere também cada
+    fotografia contra a anterior mais os deltas entre elas.
+    Retorna a lista de problemas: {verificacao, produto_id, razao, atual}.
+    """
+    problemas = []
+    snapshots = db.execute('SELECT * FROM snapshots_estoque ORDER BY id').fetchall()
+    if completo:
+        for anterior, seguinte in zip([None] + snapshots[:-1], snapshots):
+            for d in _divergencias(db, anterior, seguinte['ultimo_razao_id'],
+                                   'SELECT produto_id, quantidade AS q FROM saldos_snapshot WHERE snapshot_id = ?',
+                                   (seguinte['id'],)):
+                problemas.append(dict(d, verificacao=f"snapshot {seguinte['id']}"))
+    ultimo_id = db.execute('SELECT COALESCE(MAX(id), 0) FROM razao_estoque').fetchone()[0]
+    for d in _divergencias(db, snapshots[-1] if snapshots else None, ultimo_id,
+                           'SELECT id AS produto_id, COALESCE(quantidade, 0) AS q FROM estoque', ()):
+        problemas.append(dict(d, verificacao='estoque'))
+    return problemas
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Registros tipados lidos do banco
+Movimentacao usa __slots__ (sem __dict__ por linha) e é criada direto pelo
+row_factory do cursor. O timestamp é convertido uma única vez, pelo próprio
+driver: colunas selecionadas como `timestamp AS "timestamp [datahora]"` passam
+pelo conversor registrado abaixo quando a conexão usa detect_types=PARSE_COLNAMES.
+Só colunas marcadas assim são convertidas; o resto das consultas não muda.
+"""
+
+import sqlite3
+from datetime import datetime
+
+# Nome do conversor usado nos aliases de coluna: "coluna [datahora]"
+CONVERSOR_DATAHORA = 'datahora'
+
+
+def converter_datahora(valor):
+    """
+    Texto canônico 'YYYY-MM-DD HH:MM:SS' (bytes, vindo do SQLite) -> datetime.
+    Um valor fora do formato (gravado à mão ou por script) volta como o texto original,
+    em vez de derrubar a consulta inteira: uma linha ruim não pode esconder o histórico.
+    """
+    texto = valor.decode(errors='replace')
+    try:
+        return datetime.fromisoformat(texto)
+    except ValueError:
+        return texto
+
+
+sqlite3.register_converter(CONVERSOR_DATAHORA, converter_datahora)
+
+
+class Movimentacao:
+    """Uma linha de movimentacao, com timestamp já convertido para datetime (ou o texto, se malformado)."""
+
+    __slots__ = ('id', 'product_id', 'product_barcode', 'name', 'action', 'quantidade', 'timestamp', 'motivo')
+
+    # SELECT na mesma ordem dos slots, com o timestamp marcado para o conversor
+    COLUNAS_SQL = ('id, product_id, product_barcode, name, action, quantidade, '
+                   f'timestamp AS "timestamp [{CONVERSOR_DATAHORA}]", motivo')
+
+    def __init__(self, id, product_id, product_barcode, name, action, quantidade, timestamp, motivo):
+        self.id = id
+        self.product_id = product_id
+        self.product_barcode = product_barcode
+        self.name = name
+        self.action = action
+        self.quantidade = quantidade
+        self.timestamp = timestamp
+        self.motivo = motivo
+
+    def chave_pagina(self):
+        """Chave (timestamp, id) da paginação do histórico, com o timestamp no texto canônico do banco."""
+        if isinstance(self.timestamp, datetime):
+            return [self.timestamp.isoformat(' '), self.id]
+        return [self.timestamp, self.id]
+
+    def timestamp_formatado(self, formato='%d/%m/%Y %H:%M'):
+        """Timestamp para exibição; texto malformado (ou None) aparece como está."""
+        if isinstance(self.timestamp, datetime):
+            return self.timestamp.strftime(formato)
+        return self.timestamp or ''
+
+    def __repr__(self):
+        return f'Movimentacao(id={self.id!r}, action={self.action!r}, timestamp={self.timestamp!r})'
+
+
+def fabrica_movimentacao(cursor, linha):
+    """row_factory: tupla de Movimentacao.COLUNAS_SQL -> Movimentacao."""
+    return Movimentacao(*linha)
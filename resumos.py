@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+Resumos de movimentação por dia, semana e mês
+Cada tabela guarda, por período, código de barras, ação e motivo (o responsável,
+nas retiradas/entradas feitas pela home), a soma das quantidades e o número de
+movimentações. Um trigger em movimentacao (ver migracoes.py) soma cada inserção
+nas três tabelas na mesma transação; os gráficos de tendência leem só os resumos.
+Linhas com timestamp fora do formato (sem período calculável) ficam de fora dos resumos.
+Períodos em UTC, como movimentacao.timestamp: dia 'YYYY-MM-DD', semana pela
+segunda-feira 'YYYY-MM-DD', mês 'YYYY-MM'.
+"""
+
+from collections import namedtuple
+from datetime import date, timedelta
+
+# tabela e expressão SQL que leva um timestamp (texto canônico) ao período
+Granularidade = namedtuple('Granularidade', 'tabela expressao')
+
+GRANULARIDADES = {
+    'dia': Granularidade('resumo_movimentacao_dia', "substr({ts}, 1, 10)"),
+    'semana': Granularidade('resumo_movimentacao_semana', "date({ts}, 'weekday 0', '-6 days')"),
+    'mes': Granularidade('resumo_movimentacao_mes', "substr({ts}, 1, 7)"),
+}
+
+# Agrupamentos aceitos pela consulta de tendência -> coluna
+AGRUPAMENTOS = {'total': None, 'codigo': 'product_barcode', 'acao': 'action', 'motivo': 'motivo'}
+
+# Períodos mostrados quando a consulta não informa o início
+PERIODOS_PADRAO = {'dia': 30, 'semana': 12, 'mes': 12}
+
+
+def sql_criar_tabela(granularidade):
+    return f'''
+        CREATE TABLE IF NOT EXISTS {GRANULARIDADES[granularidade].tabela} (
+            periodo TEXT NOT NULL,
+            product_barcode TEXT NOT NULL,
+            action TEXT NOT NULL,
+            motivo TEXT NOT NULL DEFAULT '',
+            quantidade INTEGER NOT NULL DEFAULT 0,
+            movimentacoes INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (periodo, product_barcode, action, motivo)
+        ) WITHOUT ROWID
+    '''
+
+
+def sql_somar(granularidade, prefixo='NEW.'):
+    """INSERT ... ON CONFLICT que soma uma linha de movimentacao (NEW.* no trigger) ao resumo."""
+    g = GRANULARIDADES[granularidade]
+    return f'''
+        INSERT INTO {g.tabela} (periodo, product_barcode, action, motivo, quantidade, movimentacoes)
+        VALUES ({g.expressao.format(ts=prefixo + 'timestamp')}, {prefixo}product_barcode, {prefixo}action,
+                COALESCE({prefixo}motivo, ''), {prefixo}quantidade, 1)
+        ON CONFLICT(periodo, product_barcode, action, motivo) DO UPDATE SET
+            quantidade = quantidade + excluded.quantidade,
+            movimentacoes = movimentacoes + 1;
+    '''
+
+
+def reconstruir_resumos(cursor):
+    """Refaz as três tabelas a partir de todo o histórico de movimentacao (uma passada por tabela)."""
+    for granularidade, g in GRANULARIDADES.items():
+        cursor.execute(f'DELETE FROM {g.tabela}')
+        cursor.execute(f'''
+            INSERT INTO {g.tabela} (periodo, product_barcode, action, motivo, quantidade, movimentacoes)
+            SELECT {g.expressao.format(ts='timestamp')} AS p, product_barcode, action, COALESCE(motivo, '') AS m,
+                   SUM(quantidade), COUNT(*)
+            FROM movimentacao
+            WHERE datetime(timestamp) IS NOT NULL
+            GROUP BY p, product_barcode, action, m
+        ''')
+
+
+def periodo_de(granularidade, dia):
+    """Rótulo do período (dia, segunda-feira da semana ou mês) que contém a data."""
+    if granularidade == 'semana':
+        return (dia - timedelta(days=dia.weekday())).isoformat()
+    if granularidade == 'mes':
+        return dia.strftime('%Y-%m')
+    return dia.isoformat()
+
+
+def inicio_padrao(granularidade, hoje):
+    """Data inicial padrão: os últimos PERIODOS_PADRAO períodos até hoje."""
+    n = PERIODOS_PADRAO[granularidade]
+    if granularidade == 'semana':
+        return hoje - timedelta(weeks=n - 1)
+    if granularidade == 'mes':
+        mes = hoje.year * 12 + hoje.month - 1 - (n - 1)
+        return date(mes // 12, mes % 12 + 1, 1)
+    return hoje - timedelta(days=n - 1)
+
+
+def consulta_tendencia(granularidade, inicio, fim, agrupar='total', codigo=None, acao=None, motivo=None):
+    """SQL e parâmetros da série de consultar_tendencia (também conferida por migracoes.verificar_planos)."""
+    g = GRANULARIDADES[granularidade]
+    coluna = AGRUPAMENTOS[agrupar]
+    chave = f'r.{coluna}' if coluna else "''"
+    clausulas = ['r.periodo >= ?', 'r.periodo <= ?']
+    params = [periodo_de(granularidade, inicio), periodo_de(granularidade, fim)]
+    for coluna_filtro, valor in (('product_barcode', codigo), ('action', acao), ('motivo', motivo)):
+        if valor is not None:
+            clausulas.append(f'r.{coluna_filtro} = ?')
+            params.append(valor)
+    nome, juncao = ('p.produto_nome', 'LEFT JOIN produtos p ON p.codigo_de_barras = r.product_barcode') \
+        if agrupar == 'codigo' else ('NULL', '')
+    return f'''
+        SELECT r.periodo AS periodo, {chave} AS chave, {nome} AS nome,
+               SUM(r.quantidade) AS quantidade, SUM(r.movimentacoes) AS movimentacoes
+        FROM {g.tabela} r {juncao}
+        WHERE {' AND '.join(clausulas)}
+        GROUP BY r.periodo, {chave}
+        ORDER BY r.periodo, {chave}
+    ''', params
+
+
+def consultar_tendencia(db, granularidade, inicio, fim, agrupar='total', codigo=None, acao=None, motivo=None):
+    """
+    Série por período entre as datas inicio e fim (inclusivas), lida só das tabelas de resumo.
+    agrupar: total | codigo | acao | motivo. Retorna [{periodo, chave, nome, quantidade, movimentacoes}]
+    (nome = nome do produto no catálogo quando agrupado por código).
+    """
+    sql, params = consulta_tendencia(granularidade, inicio, fim, agrupar, codigo, acao, motivo)
+    return [dict(row) for row in db.execute(sql, params)]
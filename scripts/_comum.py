@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+"""Utilitários compartilhados pelos scripts de verificação e carga (não é um script)."""
+import os
+import sqlite3
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from conexoes import PRAGMAS_PADRAO
+
+
+def conectar(caminho, timeout=10):
+    """Conexão com os mesmos PRAGMAs do app; pode ser usada por outras threads (cada uma com a sua)."""
+    conn = sqlite3.connect(caminho, timeout=timeout, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    for nome, valor in PRAGMAS_PADRAO:
+        conn.execute(f'PRAGMA {nome} = {valor}')
+    return conn
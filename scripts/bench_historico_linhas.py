@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""Microbenchmark: montagem das linhas de uma página do histórico.
+
+Compara o caminho antigo (sqlite3.Row -> dict -> strptime em vários formatos ->
+SimpleNamespace) com o atual (Movimentacao com __slots__ criada pelo row_factory,
+timestamp convertido pelo driver via detect_types=PARSE_COLNAMES), para páginas
+de 50 e 500 linhas. Inclui o tempo da consulta nos dois casos.
+Execute: python3 scripts/bench_historico_linhas.py
+"""
+import os
+import sqlite3
+import sys
+import timeit
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from registros import Movimentacao, fabrica_movimentacao
+
+REPETICOES = 200
+
+
+def caminho_antigo(db, limite):
+    """Cópia do laço que historico() usava antes dos registros tipados."""
+    movimentacoes = []
+    for mov in db.execute('SELECT * FROM movimentacao ORDER BY timestamp DESC, id DESC LIMIT ?', (limite,)).fetchall():
+        try:
+            row = dict(mov)
+        except Exception:
+            row = mov
+        ts = row.get('timestamp')
+        parsed = ts
+        if isinstance(ts, (int, float)):
+            try:
+                parsed = datetime.fromtimestamp(ts)
+            except Exception:
+                parsed = ts
+        elif isinstance(ts, str):
+            for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d'):
+                try:
+                    parsed = datetime.strptime(ts, fmt)
+                    break
+                except Exception:
+                    try:
+                        parsed = datetime.fromisoformat(ts)
+                        break
+                    except Exception:
+                        parsed = ts
+        row['timestamp'] = parsed
+        movimentacoes.append(SimpleNamespace(**row))
+    return movimentacoes
+
+
+def caminho_novo(db, limite):
+    cursor = db.cursor()
+    cursor.row_factory = fabrica_movimentacao
+    return cursor.execute(f'SELECT {Movimentacao.COLUNAS_SQL} FROM movimentacao '
+                          'ORDER BY timestamp DESC, id DESC LIMIT ?', (limite,)).fetchall()
+
+
+def main():
+    db = sqlite3.connect(':memory:', detect_types=sqlite3.PARSE_COLNAMES)
+    db.row_factory = sqlite3.Row
+    db.execute('''
+        CREATE TABLE movimentacao (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, product_id INTEGER NOT NULL, product_barcode TEXT NOT NULL,
+            name TEXT NOT NULL, action TEXT NOT NULL, quantidade INTEGER NOT NULL,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP, motivo TEXT DEFAULT NULL)
+    ''')
+    db.execute('CREATE INDEX idx_movimentacao_timestamp ON movimentacao(timestamp)')
+    inicio = datetime(2025, 1, 1)
+    db.executemany('''
+        INSERT INTO movimentacao (product_id, product_barcode, name, action, quantidade, motivo, timestamp)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', [(i % 40, '7890000000000', f'Produto {i % 40}', 'entrada' if i % 3 else 'retirada', i % 9 + 1,
+           'Distribuição', (inicio + timedelta(minutes=7 * i)).strftime('%Y-%m-%d %H:%M:%S'))
+          for i in range(5000)])
+
+    for limite in (50, 500):
+        antigo, novo = caminho_antigo(db, limite), caminho_novo(db, limite)
+        assert [(m.id, m.timestamp) for m in antigo] == [(m.id, m.timestamp) for m in novo]
+        t_antigo = min(timeit.repeat(lambda: caminho_antigo(db, limite), number=REPETICOES, repeat=3)) / REPETICOES
+        t_novo = min(timeit.repeat(lambda: caminho_novo(db, limite), number=REPETICOES, repeat=3)) / REPETICOES
+        print(f'{limite:4d} linhas: antigo {t_antigo * 1000:7.3f} ms | novo {t_novo * 1000:7.3f} ms | '
+              f'{t_antigo / t_novo:4.1f}x mais rápido')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""Teste de estresse das retiradas concorrentes.
+
+Cria um banco temporário com um lote, dispara várias threads (cada uma com a sua
+conexão, como workers diferentes do gunicorn) retirando do mesmo lote ao mesmo
+tempo e confere que nenhuma unidade foi perdida nem o estoque ficou negativo.
+Execute: python3 scripts/stress_retirada.py
+"""
+import os
+import sys
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from migracoes import aplicar_migracoes
+from servico_estoque import retirar, adicionar, ErroEstoque
+from _comum import conectar
+
+N_THREADS = 8
+RETIRADAS_POR_THREAD = 200
+ESTOQUE_INICIAL = 1000
+
+
+def main():
+    caminho = os.path.join(tempfile.mkdtemp(), 'stress.db')
+    conn = conectar(caminho)
+    aplicar_migracoes(conn)
+    cur = conn.execute('''INSERT INTO estoque (codigo_de_barras, lote, validade_int, validade_text, produto_nome, quantidade, categoria)
+                          VALUES ('7890000000001', 'L1', 1893456000, '01/01/2030', 'Arroz Stress', ?, 1)''', (ESTOQUE_INICIAL,))
+    produto_id = cur.lastrowid
+    conn.commit()
+
+    contagem = {'retiradas': 0, 'entradas': 0, 'recusadas': 0}
+    lock = threading.Lock()
+
+    def trabalhador(n):
+        db = conectar(caminho)
+        for i in range(RETIRADAS_POR_THREAD):
+            try:
+                # A cada 10 operações uma entrada, para misturar os dois sentidos
+                if i % 10 == 0:
+                    adicionar(db, produto_id, 1, f'thread {n}')
+                    chave = 'entradas'
+                else:
+                    retirar(db, produto_id, 1, f'thread {n}')
+                    chave = 'retiradas'
+            except ErroEstoque:
+                # Sem saldo, ou lote já removido por ter zerado
+                chave = 'recusadas'
+            with lock:
+                contagem[chave] += 1
+        db.close()
+
+    threads = [threading.Thread(target=trabalhador, args=(n,)) for n in range(N_THREADS)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    # O lote é removido na mesma transação se zerar
+    row = conn.execute('SELECT quantidade FROM estoque WHERE id = ?', (produto_id,)).fetchone()
+    final = row[0] if row else 0
+    saidas = conn.execute("SELECT COALESCE(SUM(quantidade), 0) FROM movimentacao WHERE action = 'retirada'").fetchone()[0]
+    entradas = conn.execute("SELECT COALESCE(SUM(quantidade), 0) FROM movimentacao WHERE action = 'entrada'").fetchone()[0]
+    esperado = ESTOQUE_INICIAL + contagem['entradas'] - contagem['retiradas']
+
+    print(f"Operações: {contagem}")
+    print(f"Estoque final: {final} (esperado {esperado})")
+    print(f"Movimentação: {entradas} entradas, {saidas} retiradas")
+
+    ok = (final == esperado and final >= 0
+          and saidas == contagem['retiradas'] and entradas == contagem['entradas'])
+    print('OK: nenhuma unidade perdida' if ok else 'FALHA: estoque e movimentação divergem')
+    conn.close()
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""Confere o cache de consultas por código de barras sob invalidação concorrente.
+
+1. Carga lenta que começa antes de uma invalidação e termina depois: não pode ser guardada.
+2. Leitura feita entre a mudança (dentro da transação) e o commit: vê o estado antigo e
+   não pode sobreviver ao commit.
+3. Estresse: cada thread escritora é dona de um código e, após cada mutação
+   (retirar, adicionar, registrar_entrada, retirar_fefo), exige que o cache já mostre o
+   total que ela espera; threads leitoras ficam recarregando os mesmos códigos o tempo todo.
+   No fim, cache e banco precisam coincidir para todos os códigos.
+O TTL é aumentado para uma hora, para que só a invalidação possa corrigir um valor velho.
+Execute: python3 scripts/verificar_cache_codigos.py
+"""
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from cache_codigos import CACHE_CODIGOS, CacheCodigos, invalidar_codigos, lotes_por_codigo, produto_do_catalogo
+from migracoes import aplicar_migracoes
+from servico_estoque import (adicionar, executar_transacao, retirar, retirar_fefo, registrar_entrada,
+                             ErroEstoque)
+from _comum import conectar
+
+N_ESCRITORES = 4
+N_LEITORES = 6
+OPERACOES_POR_ESCRITOR = 300
+
+
+def total_no_cache(db, codigo):
+    return sum(lote['quantidade'] for lote in lotes_por_codigo(db, codigo))
+
+
+def total_no_banco(db, codigo):
+    return db.execute('SELECT COALESCE(SUM(quantidade), 0) FROM estoque WHERE codigo_de_barras = ?',
+                      (codigo,)).fetchone()[0]
+
+
+def carga_lenta_descartada():
+    cache = CacheCodigos(ttl=3600)
+    comecou, liberar = threading.Event(), threading.Event()
+
+    def carregar():
+        comecou.set()
+        liberar.wait()
+        return 'velho'
+
+    leitor = threading.Thread(target=lambda: cache.obter('lotes', 'A', carregar))
+    leitor.start()
+    comecou.wait()
+    cache.invalidar({'A'})
+    liberar.set()
+    leitor.join()
+    valor = cache.obter('lotes', 'A', lambda: 'novo')
+    return [] if valor == 'novo' else [f'carga iniciada antes da invalidação ficou no cache ({valor!r})']
+
+
+def leitura_antes_do_commit(caminho):
+    escrita, leitura = conectar(caminho), conectar(caminho)
+    codigo = '7891000000999'
+    escrita.execute('''INSERT INTO estoque (codigo_de_barras, lote, validade_int, validade_text, produto_nome, quantidade, categoria)
+                       VALUES (?, 'L', 1893456000, '01/01/2030', 'Produto Commit', 10, 1)''', (codigo,))
+    escrita.commit()
+    vista = {}
+
+    def mutacao(db):
+        db.execute('UPDATE estoque SET quantidade = quantidade + 5 WHERE codigo_de_barras = ?', (codigo,))
+        invalidar_codigos(codigo)
+        # Outra conexão lê agora: ainda vê 10 (WAL) e tenta guardar esse valor
+        leitor = threading.Thread(target=lambda: vista.update(total=total_no_cache(leitura, codigo)))
+        leitor.start()
+        leitor.join()
+
+    executar_transacao(escrita, mutacao)
+    problemas = []
+    if vista.get('total') != 10:
+        problemas.append(f'leitura no meio da transação viu {vista.get("total")}, esperado 10')
+    depois = total_no_cache(leitura, codigo)
+    if depois != 15:
+        problemas.append(f'depois do commit o cache mostra {depois}, esperado 15')
+    return problemas
+
+
+def estresse(caminho):
+    codigos = [f'78920000000{n:02d}' for n in range(N_ESCRITORES)]
+    db = conectar(caminho)
+    for codigo in codigos:
+        registrar_entrada(db, codigo, 1893456000, '01/01/2030', 50,
+                          {'produto_nome': f'Produto {codigo}', 'lote': 'L', 'categoria': 1, 'image_path': ''})
+    parar = threading.Event()
+    problemas = []
+    lock = threading.Lock()
+
+    def registrar_falha(funcao):
+        # Exceção numa thread (p.ex. banco travado) também é falha, não um teste que parou cedo
+        def executar(*args):
+            try:
+                funcao(*args)
+            except Exception as e:
+                with lock:
+                    problemas.append(f'{funcao.__name__}{args}: {e!r}')
+        return executar
+
+    @registrar_falha
+    def leitor():
+        conn = conectar(caminho)
+        while not parar.is_set():
+            codigo = random.choice(codigos)
+            lotes_por_codigo(conn, codigo)
+            produto_do_catalogo(conn, codigo)
+            # Cede o GIL: leitores girando sem pausa atrasam as escritoras além do busy_timeout
+            time.sleep(0.0001)
+
+    @registrar_falha
+    def escritor(codigo):
+        conn, leitura = conectar(caminho), conectar(caminho)
+        esperado = 50
+        for i in range(OPERACOES_POR_ESCRITOR):
+            lotes = lotes_por_codigo(leitura, codigo)
+            escolha = random.random()
+            try:
+                if escolha < 0.3 and lotes:
+                    lote = random.choice(lotes)
+                    quantidade = random.randint(1, 3)
+                    retirar(conn, lote['id'], quantidade, 'teste')
+                    esperado -= quantidade
+                elif escolha < 0.5 and lotes:
+                    adicionar(conn, random.choice(lotes)['id'], 2, 'teste')
+                    esperado += 2
+                elif escolha < 0.8:
+                    dia = 1893456000 + random.randint(0, 5) * 86400
+                    registrar_entrada(conn, codigo, dia, f'dia {dia}', 3, None)
+                    esperado += 3
+                else:
+                    quantidade = random.randint(1, 6)
+                    retirar_fefo(conn, codigo, quantidade, 'teste')
+                    esperado -= quantidade
+            except ErroEstoque:
+                pass
+            visto = total_no_cache(leitura, codigo)
+            if visto != esperado:
+                with lock:
+                    problemas.append(f'{codigo} op {i}: cache mostra {visto}, esperado {esperado}')
+                return
+
+    leitores = [threading.Thread(target=leitor) for _ in range(N_LEITORES)]
+    escritores = [threading.Thread(target=escritor, args=(codigo,)) for codigo in codigos]
+    for thread in leitores + escritores:
+        thread.start()
+    for thread in escritores:
+        thread.join()
+    parar.set()
+    for thread in leitores:
+        thread.join()
+
+    for codigo in codigos:
+        if total_no_cache(db, codigo) != total_no_banco(db, codigo):
+            problemas.append(f'{codigo}: cache {total_no_cache(db, codigo)} != banco {total_no_banco(db, codigo)}')
+    return problemas
+
+
+def main():
+    caminho = os.path.join(tempfile.mkdtemp(), 'cache.db')
+    conn = conectar(caminho)
+    aplicar_migracoes(conn)
+    conn.close()
+    CACHE_CODIGOS.ttl = 3600
+
+    falhas = 0
+    for nome, verificacao in (('carga lenta x invalidação', carga_lenta_descartada),
+                              ('leitura antes do commit', lambda: leitura_antes_do_commit(caminho)),
+                              ('estresse concorrente', lambda: estresse(caminho))):
+        problemas = verificacao()
+        falhas += len(problemas)
+        print(f'{nome}: {"ok" if not problemas else "FALHA"}')
+        for problema in problemas[:10]:
+            print('  ' + problema)
+    print('métricas:', CACHE_CODIGOS.metricas())
+    return 1 if falhas else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
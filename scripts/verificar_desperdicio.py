@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""Confere a projeção de desperdício (previsao.risco_desperdicio) contra uma simulação dia a dia.
+
+Cria um banco temporário com lotes aleatórios de alguns códigos (validades nos próximos
+dias, alguns já vencidos) e retiradas diárias nos resumos. A simulação consome, a cada
+dia, a taxa do código a partir do lote que vence primeiro (FEFO) e conta o que sobra em
+cada lote no fim do dia da validade; o resultado tem de coincidir com a consulta única.
+Confere também que o cache é descartado depois de uma mudança de estoque.
+Execute: python3 scripts/verificar_desperdicio.py
+"""
+import os
+import random
+import sys
+import tempfile
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from migracoes import aplicar_migracoes
+from previsao import DIAS_HORIZONTE_DESPERDICIO, limpar_cache_previsao, risco_desperdicio, taxas_de_consumo
+from servico_estoque import registrar_entrada, retirar
+from validade import limites_validade
+from _comum import conectar
+
+CODIGOS = [f'78940000000{n:02d}' for n in range(6)]
+RODADAS = 20
+
+
+def simular(db, hoje, taxas):
+    """Perda por lote consumindo taxa/dia em ordem de validade, dia a dia."""
+    hoje_ts = limites_validade(hoje).hoje
+    limite = limites_validade(hoje + timedelta(days=DIAS_HORIZONTE_DESPERDICIO)).hoje
+    perdas = {}
+    for codigo in CODIGOS:
+        lotes = [dict(r) for r in db.execute('''
+            SELECT id, validade_int, quantidade FROM estoque
+            WHERE codigo_de_barras = ? AND validade_int >= ? AND validade_int < ? AND quantidade > 0
+            ORDER BY validade_int, id
+        ''', (codigo, hoje_ts, limite))]
+        taxa = taxas.get(codigo, (0, 0))[0]
+        restante = {lote['id']: lote['quantidade'] for lote in lotes}
+        for dia in range(DIAS_HORIZONTE_DESPERDICIO + 1):
+            fim_do_dia = limites_validade(hoje + timedelta(days=dia)).hoje
+            consumo = taxa
+            for lote in lotes:
+                if consumo <= 0:
+                    break
+                if restante[lote['id']] > 0 and lote['validade_int'] >= fim_do_dia:
+                    usado = min(consumo, restante[lote['id']])
+                    restante[lote['id']] -= usado
+                    consumo -= usado
+            for lote in lotes:
+                if lote['validade_int'] == fim_do_dia and round(restante[lote['id']]) > 0:
+                    perdas[lote['id']] = round(restante[lote['id']])
+    return perdas
+
+
+def main():
+    random.seed(11)
+    caminho = os.path.join(tempfile.mkdtemp(), 'desperdicio.db')
+    db = conectar(caminho)
+    aplicar_migracoes(db)
+    hoje = date.today()
+
+    falhas = 0
+    for rodada in range(RODADAS):
+        for codigo in CODIGOS:
+            for _ in range(random.randint(0, 3)):
+                dia = hoje + timedelta(days=random.randint(-3, DIAS_HORIZONTE_DESPERDICIO + 5))
+                registrar_entrada(db, codigo, limites_validade(dia).hoje, dia.strftime('%d/%m/%Y'),
+                                  random.randint(1, 40),
+                                  {'produto_nome': f'Produto {codigo}', 'lote': 'L', 'categoria': 1, 'image_path': ''})
+        db.execute('DELETE FROM resumo_movimentacao_dia')
+        for codigo in CODIGOS[:-1]:
+            taxa = random.choice([0.5, 1, 2, 3, 7])
+            for d in range(1, 30):
+                db.execute('''INSERT INTO resumo_movimentacao_dia VALUES (?, ?, 'retirada', '', ?, 1)''',
+                           ((hoje - timedelta(days=d)).isoformat(), codigo, taxa))
+        db.commit()
+        limpar_cache_previsao()
+
+        esperado = simular(db, hoje, taxas_de_consumo(db, hoje))
+        obtido = {lote['id']: lote['desperdicio'] for lote in risco_desperdicio(db, hoje)}
+        if obtido != esperado:
+            falhas += 1
+            diferentes = {k for k in set(obtido) | set(esperado) if obtido.get(k) != esperado.get(k)}
+            print(f'FALHA na rodada {rodada}: lotes {sorted(diferentes)[:10]}')
+
+        # Uma retirada muda o estoque: a próxima consulta não pode vir do cache
+        lote = db.execute('SELECT id, quantidade FROM estoque WHERE quantidade > 0 ORDER BY RANDOM() LIMIT 1').fetchone()
+        antes = risco_desperdicio(db, hoje)
+        retirar(db, lote['id'], lote['quantidade'], 'teste')
+        if any(item['id'] == lote['id'] for item in risco_desperdicio(db, hoje)):
+            falhas += 1
+            print(f'FALHA na rodada {rodada}: lote {lote["id"]} zerado continua na projeção (cache)')
+        elif antes is risco_desperdicio(db, hoje):
+            falhas += 1
+            print(f'FALHA na rodada {rodada}: projeção não foi recalculada após a retirada')
+
+    lotes = db.execute('SELECT COUNT(*) FROM estoque').fetchone()[0]
+    print(f'{RODADAS} rodadas, {lotes} lotes, {falhas} falhas.')
+    return 1 if falhas else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+"""Confere o fluxo de eventos de estoque (eventos.py) e o endpoint SSE.
+
+1. Ponta a ponta: abre /api/eventos_estoque num cliente de teste, faz retirada (zerando o
+   lote), adição, entrada, FEFO e importação por outras rotas/funções e confere que cada
+   commit chega como um evento 'estoque' com o saldo igual ao do banco.
+2. Fila limitada: um assinante que não lê perde a fila e recebe 'recarregar', sem afetar
+   os outros; o limite de conexões devolve 503.
+3. Tipo de worker: requisição de servidor síncrono (wsgi.multithread falso) recebe 503 sem
+   criar assinatura; com threads vale EVENTOS_MAX_CONEXOES.
+4. Muitos ociosos: 300 assinantes parados (com batimento curto) recebem um evento cada
+   um, e o tempo de CPU do processo enquanto esperam fica perto de zero.
+Execute: python3 scripts/verificar_eventos.py
+"""
+import io
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import app as appmod
+import eventos as eventosmod
+from eventos import CANAL_EVENTOS, CanalEventos
+from importacao import importar_estoque, ler_linhas
+from servico_estoque import registrar_entrada, retirar_fefo
+from _comum import conectar
+
+N_OCIOSOS = 300
+
+# Como o gthread do gunicorn (ou o servidor de desenvolvimento) marca as requisições
+COM_THREADS = {'wsgi.multithread': True}
+
+
+def ler_eventos(iterador, destino, parar):
+    """Junta os blocos do corpo SSE e guarda cada evento (tipo, dados) em destino."""
+    buffer = ''
+    for bloco in iterador:
+        buffer += bloco.decode() if isinstance(bloco, bytes) else bloco
+        while '\n\n' in buffer:
+            mensagem, buffer = buffer.split('\n\n', 1)
+            campos = dict(linha.split(': ', 1) for linha in mensagem.split('\n') if ': ' in linha and linha[0] != ':')
+            if 'event' in campos:
+                destino.append((campos['event'], json.loads(campos['data'])))
+        if parar.is_set():
+            return
+
+
+def esperar(condicao, segundos=5):
+    limite = time.monotonic() + segundos
+    while time.monotonic() < limite:
+        if condicao():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def ponta_a_ponta():
+    problemas = []
+    cliente = appmod.app.test_client()
+    with cliente.session_transaction() as sessao:
+        sessao['user'] = 'verificacao'
+    # Outra conexão, como outra estação: as rotas usam a do pool
+    db = conectar(appmod.DATABASE_PATH)
+
+    resposta = cliente.get('/api/eventos_estoque', buffered=False, environ_overrides=COM_THREADS)
+    if resposta.status_code != 200 or resposta.mimetype != 'text/event-stream':
+        return [f'endpoint respondeu {resposta.status_code} {resposta.mimetype}']
+    eventos, parar = [], threading.Event()
+    leitor = threading.Thread(target=ler_eventos, args=(iter(resposta.response), eventos, parar), daemon=True)
+    leitor.start()
+    esperar(CANAL_EVENTOS.tem_assinantes)
+
+    codigo = '7895000000001'
+    registrar_entrada(db, codigo, 1893456000, '01/01/2030', 5,
+                      {'produto_nome': 'Produto Eventos', 'lote': 'L', 'categoria': 1, 'image_path': ''})
+    registrar_entrada(db, codigo, 1893542400, '02/01/2030', 8, None)
+    lotes = [r['id'] for r in db.execute('SELECT id FROM estoque WHERE codigo_de_barras = ? ORDER BY validade_int', (codigo,))]
+    cliente.post('/api/adicionar_com_motivo', json={'product_id': lotes[1], 'quantidade': 2, 'motivo': 'Ana'})
+    cliente.post('/api/retirar_com_motivo', json={'product_id': lotes[0], 'quantidade': 5, 'motivo': 'Ana'})
+    retirar_fefo(db, codigo, 3, 'teste')
+    importar_estoque(db, ler_linhas(io.BytesIO(f'codigo_de_barras;validade;quantidade\n{codigo};2030-01-02;4\n'.encode()),
+                                    'entrega.csv'))
+    esperados = [
+        {lotes[0]: (5, False)},
+        {lotes[1]: (8, False)},
+        {lotes[1]: (10, False)},
+        {lotes[0]: (0, True)},
+        {lotes[1]: (7, False)},
+        {lotes[1]: (11, False)},
+    ]
+    esperar(lambda: len(eventos) >= len(esperados))
+    # O leitor sai no próximo batimento; a resposta é fechada pela mesma linha do servidor
+    parar.set()
+    leitor.join(5)
+    recebidos = [{lote['id']: (lote['quantidade'], lote['removido']) for lote in dados['lotes']}
+                 for tipo, dados in eventos if tipo == 'estoque']
+    if recebidos != esperados:
+        problemas.append(f'eventos recebidos {recebidos} != esperados {esperados}')
+    atual = db.execute('SELECT quantidade FROM estoque WHERE id = ?', (lotes[1],)).fetchone()[0]
+    if recebidos and recebidos[-1].get(lotes[1], (None,))[0] != atual:
+        problemas.append(f'último evento difere do banco ({atual})')
+    resposta.close()
+    if not esperar(lambda: not CANAL_EVENTOS.tem_assinantes()):
+        problemas.append('assinatura continuou ativa depois de fechar a conexão')
+    return problemas
+
+
+def fila_limitada():
+    problemas = []
+    canal = CanalEventos(max_fila=5, max_assinantes=2)
+    parado, ativo = canal.assinar(), canal.assinar()
+    if canal.assinar() is not None:
+        problemas.append('limite de assinantes não foi respeitado')
+    for i in range(8):
+        canal.publicar('estoque', {'n': i})
+        mensagens, atrasado = ativo.esperar(0)
+        if len(mensagens) != 1 or atrasado:
+            problemas.append(f'assinante ativo recebeu {len(mensagens)} mensagens (atrasado={atrasado})')
+    mensagens, atrasado = parado.esperar(0)
+    if not atrasado or mensagens:
+        problemas.append(f'assinante parado: atrasado={atrasado}, {len(mensagens)} mensagens (esperado aviso e fila vazia)')
+    fluxo = canal.fluxo(parado, intervalo=0.01)
+    if not next(fluxo).startswith('retry:') or next(fluxo) != ': heartbeat\n\n':
+        problemas.append('fluxo sem cabeçalho retry ou sem batimento')
+    fluxo.close()
+    if canal.metricas()['assinantes'] != 1:
+        problemas.append('fechar o fluxo não cancelou a assinatura')
+    return problemas
+
+
+def tipo_de_worker():
+    problemas = []
+    cliente = appmod.app.test_client()
+    with cliente.session_transaction() as sessao:
+        sessao['user'] = 'verificacao'
+    resposta = cliente.get('/api/eventos_estoque', environ_overrides={'wsgi.multithread': False})
+    if resposta.status_code != 503 or CANAL_EVENTOS.tem_assinantes():
+        problemas.append(f'worker síncrono: respondeu {resposta.status_code} (esperado 503 sem assinatura)')
+
+    appmod.app.config['EVENTOS_MAX_CONEXOES'] = 2
+    try:
+        abertas = [cliente.get('/api/eventos_estoque', buffered=False, environ_overrides=COM_THREADS)
+                   for _ in range(3)]
+        codigos = [r.status_code for r in abertas]
+        if codigos != [200, 200, 503]:
+            problemas.append(f'EVENTOS_MAX_CONEXOES=2: respostas {codigos} (esperado [200, 200, 503])')
+        for r in abertas:
+            r.close()
+    finally:
+        appmod.app.config['EVENTOS_MAX_CONEXOES'] = None
+    if CANAL_EVENTOS.tem_assinantes():
+        problemas.append('assinaturas ficaram abertas depois de fechar as conexões')
+    return problemas
+
+
+def muitos_ociosos():
+    problemas = []
+    canal = CanalEventos(max_assinantes=N_OCIOSOS)
+    recebidos = []
+    lock = threading.Lock()
+
+    def assinante():
+        fluxo = canal.fluxo(canal.assinar(), intervalo=1)
+        for bloco in fluxo:
+            if bloco.startswith('id:'):
+                with lock:
+                    recebidos.append(bloco)
+                fluxo.close()
+
+    threads = [threading.Thread(target=assinante, daemon=True) for _ in range(N_OCIOSOS)]
+    for thread in threads:
+        thread.start()
+    esperar(lambda: canal.metricas()['assinantes'] == N_OCIOSOS)
+    cpu = time.process_time()
+    time.sleep(2.5)
+    cpu_ocioso = time.process_time() - cpu
+    canal.publicar('estoque', {'lotes': []})
+    for thread in threads:
+        thread.join(5)
+    if len(recebidos) != N_OCIOSOS:
+        problemas.append(f'{len(recebidos)} de {N_OCIOSOS} assinantes receberam o evento')
+    if canal.metricas()['assinantes']:
+        problemas.append(f'{canal.metricas()["assinantes"]} assinaturas ficaram abertas')
+    if cpu_ocioso > 0.5:
+        problemas.append(f'{N_OCIOSOS} ociosos gastaram {cpu_ocioso:.2f}s de CPU em 2,5s')
+    print(f'  {N_OCIOSOS} ociosos: {cpu_ocioso * 1000:.0f} ms de CPU em 2,5 s (batimento a cada 1 s)')
+    return problemas
+
+
+def main():
+    appmod.DATABASE_PATH = os.path.join(tempfile.mkdtemp(), 'banco.db')
+    # Batimento curto para o leitor do teste ponta a ponta perceber o fim rapidamente
+    eventosmod.INTERVALO_HEARTBEAT = 0.2
+    with appmod.app.app_context():
+        appmod.init_db()
+
+    falhas = 0
+    for nome, verificacao in (('ponta a ponta', ponta_a_ponta),
+                              ('fila limitada', fila_limitada),
+                              ('tipo de worker', tipo_de_worker),
+                              ('muitos ociosos', muitos_ociosos)):
+        problemas = verificacao()
+        falhas += len(problemas)
+        print(f'{nome}: {"ok" if not problemas else "FALHA"}')
+        for problema in problemas:
+            print('  ' + problema)
+    return 1 if falhas else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
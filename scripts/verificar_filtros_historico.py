@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""Confere que a tela do histórico e as exportações devolvem as mesmas linhas.
+
+Cria um banco temporário com movimentações espalhadas pelos últimos ~400 dias e,
+para cada combinação de período, ação e busca, compara:
+  - as linhas da tela (todas as páginas de buscar_pagina, como em historico());
+  - a consulta da exportação (filtros_historico.consulta);
+  - a planilha de /exportar_historico e o CSV de /exportar_historico/csv;
+  - e, sem busca textual, um filtro feito em Python sobre todas as linhas.
+Execute: python3 scripts/verificar_filtros_historico.py
+"""
+import csv
+import io
+import os
+import random
+import sys
+import tempfile
+from datetime import date, datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from openpyxl import load_workbook
+
+import app as appmod
+from filtros_historico import filtro_da_requisicao, clausulas, consulta, limites_periodo
+from registros import Movimentacao, fabrica_movimentacao
+
+PERIODOS = [{'periodo': p} for p in ('today', 'week', 'month', 'current_month', 'last_month', 'year', 'all', 'xyz')]
+PERIODOS += [{'periodo': 'custom', 'date': (date.today() - timedelta(days=40)).isoformat()},
+             {'periodo': 'custom', 'date': 'invalida'}]
+ACOES = [None, 'entrada', 'retirada']
+BUSCAS = [None, 'arroz', 'acucar', 'feijao preto']
+PRODUTOS = [('7890000000001', 'Arroz Tipo 1'), ('7890000000002', 'Feijão Preto'),
+            ('7890000000003', 'Açúcar Cristal'), ('7890000000004', 'Óleo de Soja')]
+
+
+def popular(db, total=3000):
+    random.seed(42)
+    agora = datetime.now().replace(microsecond=0)
+    linhas = []
+    for _ in range(total):
+        codigo, nome = random.choice(PRODUTOS)
+        momento = agora - timedelta(seconds=random.randint(0, 400 * 86400))
+        linhas.append((1, codigo, nome, random.choice(('entrada', 'retirada')), random.randint(1, 9),
+                       'teste', momento.strftime('%Y-%m-%d %H:%M:%S')))
+    # Alguns empates de timestamp para exercitar o desempate por id
+    linhas += [linhas[0]] * 5
+    db.executemany('''
+        INSERT INTO movimentacao (product_id, product_barcode, name, action, quantidade, motivo, timestamp)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', linhas)
+    db.commit()
+
+
+def ids_da_tela(db, filtro):
+    where_clauses, params = clausulas(filtro)
+    ids, after = [], None
+    while True:
+        linhas, _, has_next, _, ultima = appmod.buscar_pagina(
+            db.cursor(), 'movimentacao', where_clauses, params, ('timestamp', 'id'), True, 50, after=after,
+            selecao=Movimentacao.COLUNAS_SQL, fabrica=fabrica_movimentacao)
+        ids += [linha.id for linha in linhas]
+        if not has_next:
+            return ids
+        after = ultima
+
+
+def ids_de_referencia(todas, filtro):
+    periodo = filtro.periodo
+    inicio, fim = limites_periodo(periodo.date_from, periodo.date_to) if periodo.date_from else (None, None)
+    selecionadas = [m for m in todas
+                    if (inicio is None or inicio <= m['timestamp'] < fim)
+                    and (filtro.action is None or m['action'] == filtro.action)]
+    selecionadas.sort(key=lambda m: (m['timestamp'], m['id']), reverse=True)
+    return [m['id'] for m in selecionadas]
+
+
+def main():
+    diretorio = tempfile.mkdtemp()
+    appmod.DATABASE_PATH = os.path.join(diretorio, 'banco.db')
+    appmod.app.config['CACHE_EXPORTACAO_DIR'] = os.path.join(diretorio, 'cache')
+    with appmod.app.app_context():
+        appmod.init_db()
+        popular(appmod.get_db_escrita())
+
+    cliente = appmod.app.test_client()
+    with cliente.session_transaction() as sessao:
+        sessao['user'] = 'verificacao'
+
+    falhas = 0
+    combinacoes = 0
+    with appmod.app.app_context():
+        db = appmod.get_db()
+        todas = [dict(m) for m in db.execute('SELECT id, timestamp, action FROM movimentacao')]
+        for periodo in PERIODOS:
+            for acao in ACOES:
+                for busca in BUSCAS:
+                    args = dict(periodo)
+                    if acao:
+                        args['action'] = acao
+                    if busca:
+                        args['q'] = busca
+                    filtro = filtro_da_requisicao(args)
+                    combinacoes += 1
+
+                    tela = ids_da_tela(db, filtro)
+                    sql, params = consulta(filtro, 'id')
+                    exportacao = [linha[0] for linha in db.execute(sql, params)]
+
+                    planilha = load_workbook(io.BytesIO(cliente.get('/exportar_historico', query_string=args).data),
+                                             read_only=True)
+                    linhas_planilha = sum(1 for _ in planilha.active.iter_rows(values_only=True)) - 1
+                    texto_csv = cliente.get('/exportar_historico/csv', query_string=args).get_data(as_text=True)
+                    ids_csv = [int(linha['id']) for linha in csv.DictReader(io.StringIO(texto_csv))]
+
+                    problemas = []
+                    if tela != exportacao:
+                        problemas.append(f'tela ({len(tela)}) != consulta da exportação ({len(exportacao)})')
+                    if linhas_planilha != len(tela):
+                        problemas.append(f'planilha com {linhas_planilha} linhas, tela com {len(tela)}')
+                    if sorted(ids_csv) != sorted(tela):
+                        problemas.append(f'CSV ({len(ids_csv)}) != tela ({len(tela)})')
+                    if busca is None and tela != ids_de_referencia(todas, filtro):
+                        problemas.append('tela diverge do filtro de referência em Python')
+                    if problemas:
+                        falhas += 1
+                        print(f'FALHA {args}: ' + '; '.join(problemas))
+
+    print(f'{combinacoes} combinações verificadas, {falhas} com divergência.')
+    return 1 if falhas else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""Confere o livro-razão, as fotografias de saldo e o "estoque em uma data".
+
+Cria um banco temporário, faz entradas, retiradas (inclusive zerando lotes), FEFO,
+retirada em lote e importação em várias rodadas separadas por alguns segundos,
+gravando fotografias entre elas. Depois, para cada segundo em que houve movimento,
+compara saldos_em() (fotografia mais próxima + reprodução parcial) com a reprodução
+completa do razão desde o início, e roda verificar_razao(completo=True).
+Por fim migra um banco na versão 7 (com estoque) a partir de várias threads ao mesmo
+tempo e reexecuta a migração do razão: o saldo de abertura e a primeira fotografia
+têm de entrar uma única vez.
+Leva alguns segundos: os momentos do razão têm resolução de um segundo.
+Execute: python3 scripts/verificar_razao.py
+"""
+import io
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from importacao import importar_estoque, ler_linhas
+from migracoes import _v8_razao_estoque, aplicar_migracoes
+from razao import gravar_snapshot, saldos_em, verificar_razao
+from servico_estoque import (adicionar, registrar_entrada, retirar, retirar_fefo, retirar_lote, varrer_estoque_zerado,
+                             ErroEstoque)
+from _comum import conectar
+
+RODADAS = 6
+THREADS_MIGRACAO = 4
+OPERACOES_POR_RODADA = 60
+CODIGOS = [f'78930000000{n:02d}' for n in range(8)]
+
+
+def operacao_aleatoria(db):
+    lotes = db.execute('SELECT id, codigo_de_barras, quantidade FROM estoque WHERE quantidade > 0').fetchall()
+    escolha = random.random()
+    codigo = random.choice(CODIGOS)
+    if escolha < 0.3 or not lotes:
+        dia = 1893456000 + random.randint(0, 9) * 86400
+        registrar_entrada(db, codigo, dia, f'dia {dia}', random.randint(1, 20),
+                          {'produto_nome': f'Produto {codigo}', 'lote': 'L', 'categoria': 1, 'image_path': ''})
+    elif escolha < 0.55:
+        lote = random.choice(lotes)
+        # Às vezes retira tudo, removendo o lote
+        quantidade = lote['quantidade'] if random.random() < 0.3 else random.randint(1, lote['quantidade'])
+        retirar(db, lote['id'], quantidade, 'teste')
+    elif escolha < 0.7:
+        adicionar(db, random.choice(lotes)['id'], random.randint(1, 5), 'teste')
+    elif escolha < 0.85:
+        retirar_fefo(db, codigo, random.randint(1, 15), 'teste')
+    elif escolha < 0.95:
+        itens = [{'produto_id': lote['id'], 'quantidade': 1, 'motivo': 'teste'} for lote in random.sample(lotes, min(3, len(lotes)))]
+        retirar_lote(db, itens)
+    else:
+        texto = 'codigo_de_barras;validade;quantidade\n' + ''.join(
+            f'{random.choice(CODIGOS)};2031-0{random.randint(1, 9)}-01;{random.randint(1, 4)}\n' for _ in range(5))
+        importar_estoque(db, ler_linhas(io.BytesIO(texto.encode()), 'entrega.csv'))
+
+
+def reproducao_completa(db, ate):
+    return {r[0]: r[1] for r in db.execute('''
+        SELECT produto_id, SUM(delta) FROM razao_estoque WHERE momento < ?
+        GROUP BY produto_id HAVING SUM(delta) <> 0
+    ''', (ate,))}
+
+
+def migracao_concorrente():
+    """Threads migrando o mesmo banco da versão 7 ao mesmo tempo; depois reexecuta a v8."""
+    problemas = []
+    caminho = os.path.join(tempfile.mkdtemp(), 'v7.db')
+    db = conectar(caminho)
+    aplicar_migracoes(db, ate=7)
+    for n, codigo in enumerate(CODIGOS):
+        db.execute('''INSERT INTO estoque (codigo_de_barras, lote, validade_int, validade_text, produto_nome, quantidade, categoria)
+                      VALUES (?, 'L', 1893456000, '01/01/2030', ?, ?, 1)''', (codigo, f'Produto {codigo}', 10 + n))
+    db.commit()
+
+    barreira = threading.Barrier(THREADS_MIGRACAO)
+    aplicadas = []
+
+    def migrar():
+        conn = conectar(caminho)
+        barreira.wait()
+        aplicadas.append(aplicar_migracoes(conn))
+        conn.close()
+
+    threads = [threading.Thread(target=migrar) for _ in range(THREADS_MIGRACAO)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if sorted(v for lista in aplicadas for v in lista) != [8, 9]:
+        problemas.append(f'migrações aplicadas pelas threads: {aplicadas}')
+
+    # A própria migração também não pode duplicar nada se rodar de novo
+    _v8_razao_estoque(db.cursor())
+    db.commit()
+    snapshots = db.execute('SELECT COUNT(*) FROM snapshots_estoque').fetchone()[0]
+    if snapshots != 1:
+        problemas.append(f'{snapshots} fotografias de abertura (esperado 1)')
+    for problema in verificar_razao(db, completo=True):
+        problemas.append(f'divergência após migrar: {problema}')
+    return problemas
+
+
+def main():
+    random.seed(7)
+    caminho = os.path.join(tempfile.mkdtemp(), 'razao.db')
+    db = conectar(caminho)
+    aplicar_migracoes(db)
+
+    for rodada in range(RODADAS):
+        for _ in range(OPERACOES_POR_RODADA):
+            try:
+                operacao_aleatoria(db)
+            except ErroEstoque:
+                pass
+        if rodada % 2:
+            gravar_snapshot(db)
+        if rodada == RODADAS - 2:
+            # Lote removido com saldo (edição manual) também entra no razão
+            db.execute('DELETE FROM estoque WHERE id = (SELECT MIN(id) FROM estoque WHERE quantidade > 0)')
+            db.commit()
+            varrer_estoque_zerado(db)
+        time.sleep(1.05)
+
+    falhas = 0
+    direcoes = {}
+    momentos = [r[0] for r in db.execute('SELECT DISTINCT momento FROM razao_estoque ORDER BY momento')]
+    limites = momentos + [time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(time.time() + 5)), '2000-01-01']
+    for ate in limites:
+        esperado = reproducao_completa(db, ate)
+        resultado = saldos_em(db, ate)
+        obtido = {lote['produto_id']: lote['quantidade'] for lote in resultado['lotes']}
+        direcoes[resultado['base']['direcao']] = direcoes.get(resultado['base']['direcao'], 0) + 1
+        if obtido != esperado:
+            falhas += 1
+            print(f'FALHA em {ate} ({resultado["base"]}): {len(obtido)} lotes != {len(esperado)} esperados')
+        codigo = CODIGOS[0]
+        por_codigo = {lote['produto_id']: lote['quantidade'] for lote in saldos_em(db, ate, codigo)['lotes']}
+        ids_codigo = {r[0] for r in db.execute('SELECT DISTINCT produto_id FROM razao_estoque WHERE codigo_de_barras = ?',
+                                                 (codigo,))}
+        if por_codigo != {k: v for k, v in esperado.items() if k in ids_codigo}:
+            falhas += 1
+            print(f'FALHA em {ate} filtrando o código {codigo}')
+
+    problemas = verificar_razao(db, completo=True)
+    for problema in problemas:
+        print('DIVERGÊNCIA', problema)
+    falhas += len(problemas)
+
+    for problema in migracao_concorrente():
+        print('MIGRAÇÃO', problema)
+        falhas += 1
+
+    snapshots = db.execute('SELECT COUNT(*) FROM snapshots_estoque').fetchone()[0]
+    linhas = db.execute('SELECT COUNT(*) FROM razao_estoque').fetchone()[0]
+    print(f'{len(limites)} datas conferidas ({direcoes}), {snapshots} snapshots, {linhas} linhas no razão, '
+          f'{falhas} falhas.')
+    return 1 if falhas else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,429 @@
+# -*- coding: utf-8 -*-
+"""
+Serviço de mutações de estoque
+Toda alteração de quantidade passa por aqui: o delta é aplicado em um único
+UPDATE condicional (quantidade = quantidade - ? WHERE ... AND quantidade >= ?)
+dentro de BEGIN IMMEDIATE, então duas retiradas simultâneas do mesmo lote
+nunca perdem unidades nem deixam o estoque negativo.
+Um lote que chega a zero é removido na mesma transação da retirada; a varredura
+em lotes (varrer_estoque_zerado) só existe para sobras antigas.
+Toda mutação invalida os códigos tocados no cache de consultas por código de
+barras (cache_codigos), dentro da transação e de novo após o commit, e publica
+o novo saldo dos lotes tocados para as telas conectadas (eventos).
+"""
+
+import logging
+import random
+import sqlite3
+import threading
+import time
+
+from cache_codigos import confirmar_invalidacoes, invalidar_codigos, produto_do_catalogo
+from eventos import coletar_mudancas, marcar_mudancas, publicar_mudancas
+
+logger = logging.getLogger(__name__)
+
+# Tentativas quando o banco continua ocupado mesmo após o busy_timeout
+TENTATIVAS_OCUPADO = 5
+
+# Linhas apagadas por transação na varredura de lotes zerados
+TAMANHO_LOTE_VARREDURA = 500
+
+# Contadores da limpeza de estoque zerado (expostos em /api/saude)
+METRICAS_LIMPEZA = {
+    'removidos_na_retirada': 0,
+    'varreduras': 0,
+    'removidos_na_varredura': 0,
+    'ultima_varredura': None,
+}
+_lock_metricas = threading.Lock()
+
+# Consultas de lote usadas pelo serviço e pelas rotas (também conferidas por migracoes.verificar_planos)
+SQL_LOTE_POR_ID = 'SELECT * FROM estoque WHERE id = ?'
+SQL_LOTE_POR_CODIGO_E_VALIDADE = '''
+    SELECT * FROM estoque
+    WHERE codigo_de_barras = ? AND validade_int = ?
+    AND quantidade > 0
+'''
+SQL_LOTE_POR_CODIGO_E_LOTE = 'SELECT * FROM estoque WHERE codigo_de_barras = ? AND lote = ?'
+SQL_LOTE_POR_VALIDADE_TEXTO = '''
+    SELECT * FROM estoque
+    WHERE codigo_de_barras = ? AND validade_text = ?
+'''
+SQL_LOTES_FEFO = '''
+    SELECT id, codigo_de_barras, produto_nome, validade_text, quantidade FROM estoque
+    WHERE codigo_de_barras = ? AND validade_int >= ? AND quantidade > 0
+    ORDER BY validade_int ASC, id ASC
+'''
+
+
+class ErroEstoque(Exception):
+    """Erro de regra de negócio em uma mutação de estoque."""
+
+
+class ProdutoNaoEncontrado(ErroEstoque):
+    pass
+
+
+class EstoqueInsuficiente(ErroEstoque):
+    pass
+
+
+class QuantidadeInvalida(ErroEstoque):
+    pass
+
+
+class RetiradaEmLoteRecusada(ErroEstoque):
+    """Alguma linha de uma retirada em lote não pode ser atendida; nada foi aplicado."""
+
+    def __init__(self, resultados):
+        super().__init__('Retirada em lote recusada: há linhas inválidas')
+        self.resultados = resultados
+
+
+def _banco_ocupado(erro):
+    mensagem = str(erro).lower()
+    return 'locked' in mensagem or 'busy' in mensagem
+
+
+def executar_transacao(db, funcao, *args, **kwargs):
+    """
+    Executa funcao(db, *args) dentro de BEGIN IMMEDIATE e faz commit.
+    Se o banco estiver ocupado (SQLITE_BUSY), desfaz e tenta de novo com espera crescente.
+    Se já houver uma transação aberta na conexão, apenas participa dela.
+    Ao final (commit ou rollback) confirma as invalidações do cache de códigos feitas pela função;
+    depois do commit publica os lotes alterados para os assinantes de eventos.
+    """
+    if db.in_transaction:
+        return funcao(db, *args, **kwargs)
+
+    try:
+        for tentativa in range(TENTATIVAS_OCUPADO):
+            try:
+                db.execute('BEGIN IMMEDIATE')
+                marcador = marcar_mudancas(db)
+                resultado = funcao(db, *args, **kwargs)
+                mudancas = coletar_mudancas(db, marcador)
+                db.commit()
+                publicar_mudancas(mudancas)
+                return resultado
+            except sqlite3.OperationalError as e:
+                if db.in_transaction:
+                    db.rollback()
+                if not _banco_ocupado(e) or tentativa == TENTATIVAS_OCUPADO - 1:
+                    raise
+                time.sleep(0.05 * (2 ** tentativa) + random.uniform(0, 0.05))
+            except Exception:
+                if db.in_transaction:
+                    db.rollback()
+                raise
+    finally:
+        confirmar_invalidacoes()
+
+
+def _incrementar_metrica(nome, valor=1):
+    with _lock_metricas:
+        METRICAS_LIMPEZA[nome] += valor
+
+
+def metricas_limpeza():
+    """Cópia dos contadores de limpeza."""
+    with _lock_metricas:
+        return dict(METRICAS_LIMPEZA)
+
+
+def _validar_quantidade(quantidade):
+    if not isinstance(quantidade, int) or quantidade <= 0:
+        raise QuantidadeInvalida('Quantidade deve ser maior que zero')
+
+
+def _registrar_movimentacao(db, produto_id, codigo_de_barras, nome, acao, quantidade, motivo):
+    db.execute('''
+        INSERT INTO movimentacao (product_id, product_barcode, name, action, quantidade, motivo)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (produto_id, codigo_de_barras, nome, acao, quantidade, motivo))
+
+
+def _retirar(db, produto_id, quantidade, motivo):
+    cursor = db.execute('''
+        UPDATE estoque SET quantidade = quantidade - ?
+        WHERE id = ? AND quantidade >= ?
+    ''', (quantidade, produto_id, quantidade))
+    produto = db.execute('SELECT id, codigo_de_barras, produto_nome, quantidade FROM estoque WHERE id = ?',
+                         (produto_id,)).fetchone()
+    if produto is None:
+        raise ProdutoNaoEncontrado('Produto não encontrado')
+    if cursor.rowcount == 0:
+        raise EstoqueInsuficiente('Quantidade insuficiente em estoque')
+    invalidar_codigos(produto['codigo_de_barras'])
+    _registrar_movimentacao(db, produto_id, produto['codigo_de_barras'], produto['produto_nome'],
+                            'retirada', quantidade, motivo)
+    if produto['quantidade'] <= 0:
+        # Lote zerado sai do estoque junto com a retirada (só esta linha, pela chave primária)
+        db.execute('DELETE FROM estoque WHERE id = ?', (produto_id,))
+        _incrementar_metrica('removidos_na_retirada')
+    return produto['quantidade']
+
+
+def _adicionar(db, produto_id, quantidade, motivo):
+    cursor = db.execute('UPDATE estoque SET quantidade = quantidade + ? WHERE id = ?', (quantidade, produto_id))
+    if cursor.rowcount == 0:
+        raise ProdutoNaoEncontrado('Produto não encontrado')
+    produto = db.execute('SELECT id, codigo_de_barras, produto_nome, quantidade FROM estoque WHERE id = ?',
+                         (produto_id,)).fetchone()
+    invalidar_codigos(produto['codigo_de_barras'])
+    _registrar_movimentacao(db, produto_id, produto['codigo_de_barras'], produto['produto_nome'],
+                            'entrada', quantidade, motivo)
+    return produto['quantidade']
+
+
+def retirar(db, produto_id, quantidade, motivo=None):
+    """Retira unidades de um lote de forma atômica; retorna a nova quantidade."""
+    _validar_quantidade(quantidade)
+    return executar_transacao(db, _retirar, produto_id, quantidade, motivo)
+
+
+def _buscar_lotes(db, ids):
+    """Lotes por id em blocos (respeita o limite de variáveis do SQLite)."""
+    lotes = {}
+    ids = list(ids)
+    for i in range(0, len(ids), 500):
+        bloco = ids[i:i + 500]
+        marcadores = ','.join('?' * len(bloco))
+        for row in db.execute(f'''
+            SELECT id, codigo_de_barras, produto_nome, quantidade FROM estoque WHERE id IN ({marcadores})
+        ''', bloco):
+            lotes[row['id']] = row
+    return lotes
+
+
+def _retirar_lote(db, itens):
+    lotes = _buscar_lotes(db, {item['produto_id'] for item in itens})
+
+    # Valida linha a linha contra o saldo atual; linhas do mesmo lote consomem o mesmo saldo
+    saldo = {produto_id: row['quantidade'] for produto_id, row in lotes.items()}
+    resultados = []
+    falhou = False
+    for linha, item in enumerate(itens):
+        produto_id = item['produto_id']
+        resultado = {'linha': linha, 'product_id': produto_id, 'quantidade': item['quantidade']}
+        if produto_id not in lotes:
+            resultado.update(ok=False, error='Produto não encontrado')
+        elif saldo[produto_id] < item['quantidade']:
+            resultado.update(ok=False, error='Quantidade insuficiente em estoque')
+        else:
+            saldo[produto_id] -= item['quantidade']
+            resultado.update(ok=True, new_quantity=saldo[produto_id])
+        falhou = falhou or not resultado['ok']
+        resultados.append(resultado)
+    if falhou:
+        raise RetiradaEmLoteRecusada(resultados)
+
+    totais = {}
+    for item in itens:
+        totais[item['produto_id']] = totais.get(item['produto_id'], 0) + item['quantidade']
+    cursor = db.executemany('''
+        UPDATE estoque SET quantidade = quantidade - ?
+        WHERE id = ? AND quantidade >= ?
+    ''', [(total, produto_id, total) for produto_id, total in totais.items()])
+    if cursor.rowcount != len(totais):
+        # Não deveria acontecer dentro de BEGIN IMMEDIATE, mas nunca aplica um lote pela metade
+        raise EstoqueInsuficiente('Estoque mudou durante a retirada em lote')
+    invalidar_codigos(*{row['codigo_de_barras'] for row in lotes.values()})
+
+    db.executemany('''
+        INSERT INTO movimentacao (product_id, product_barcode, name, action, quantidade, motivo)
+        VALUES (?, ?, ?, 'retirada', ?, ?)
+    ''', [(item['produto_id'], lotes[item['produto_id']]['codigo_de_barras'],
+           lotes[item['produto_id']]['produto_nome'], item['quantidade'], item.get('motivo'))
+          for item in itens])
+
+    zerados = [(produto_id,) for produto_id in totais if saldo[produto_id] <= 0]
+    if zerados:
+        db.executemany('DELETE FROM estoque WHERE id = ?', zerados)
+        _incrementar_metrica('removidos_na_retirada', len(zerados))
+    return resultados
+
+
+def retirar_lote(db, itens):
+    """
+    Retirada de vários lotes de uma vez: itens = [{produto_id, quantidade, motivo}].
+    Tudo ou nada, em uma única transação (um commit para o despacho inteiro).
+    Retorna o resultado por linha; se alguma linha falhar levanta RetiradaEmLoteRecusada
+    com os resultados de todas as linhas e nada é aplicado.
+    """
+    if not itens:
+        raise QuantidadeInvalida('Nenhum item informado')
+    for item in itens:
+        _validar_quantidade(item['quantidade'])
+    return executar_transacao(db, _retirar_lote, itens)
+
+
+def _alocar_fefo(db, codigo_de_barras, quantidade, validade_minima):
+    """
+    Plano FEFO: percorre os lotes do código pelo índice (codigo_de_barras, validade_int),
+    do vencimento mais próximo ao mais distante, e para assim que a quantidade é coberta.
+    Retorna [(lote, unidades)].
+    """
+    alocacoes = []
+    falta = quantidade
+    for row in db.execute(SQL_LOTES_FEFO, (codigo_de_barras, validade_minima)):
+        unidades = min(row['quantidade'], falta)
+        alocacoes.append((row, unidades))
+        falta -= unidades
+        if falta == 0:
+            return alocacoes
+    if not alocacoes:
+        raise ProdutoNaoEncontrado('Produto não encontrado')
+    raise EstoqueInsuficiente(f'Quantidade insuficiente em estoque (disponível: {quantidade - falta})')
+
+
+def _retirar_fefo(db, codigo_de_barras, quantidade, motivo, validade_minima):
+    alocacoes = _alocar_fefo(db, codigo_de_barras, quantidade, validade_minima)
+
+    cursor = db.executemany('''
+        UPDATE estoque SET quantidade = quantidade - ?
+        WHERE id = ? AND quantidade >= ?
+    ''', [(unidades, lote['id'], unidades) for lote, unidades in alocacoes])
+    if cursor.rowcount != len(alocacoes):
+        raise EstoqueInsuficiente('Estoque mudou durante a retirada')
+    invalidar_codigos(codigo_de_barras)
+
+    db.executemany('''
+        INSERT INTO movimentacao (product_id, product_barcode, name, action, quantidade, motivo)
+        VALUES (?, ?, ?, 'retirada', ?, ?)
+    ''', [(lote['id'], lote['codigo_de_barras'], lote['produto_nome'], unidades, motivo)
+          for lote, unidades in alocacoes])
+
+    zerados = [(lote['id'],) for lote, unidades in alocacoes if lote['quantidade'] == unidades]
+    if zerados:
+        db.executemany('DELETE FROM estoque WHERE id = ?', zerados)
+        _incrementar_metrica('removidos_na_retirada', len(zerados))
+    return [{
+        'produto_id': lote['id'],
+        'validade_text': lote['validade_text'],
+        'quantidade': unidades,
+        'nova_quantidade': lote['quantidade'] - unidades,
+    } for lote, unidades in alocacoes]
+
+
+def retirar_fefo(db, codigo_de_barras, quantidade, motivo=None, validade_minima=None):
+    """
+    Retirada por código de barras em FEFO (primeiro a vencer, primeiro a sair): consome os
+    lotes com validade mais próxima primeiro, quantos forem necessários, em uma única transação,
+    com uma movimentação por lote tocado. validade_minima (timestamp) ignora lotes que vencem
+    antes dela, p.ex. os já vencidos. Se o estoque não cobrir a quantidade nada é retirado.
+    Retorna a alocação: [{produto_id, validade_text, quantidade, nova_quantidade}].
+    """
+    _validar_quantidade(quantidade)
+    return executar_transacao(db, _retirar_fefo, codigo_de_barras, quantidade, motivo,
+                              validade_minima if validade_minima is not None else -2 ** 63)
+
+
+def adicionar(db, produto_id, quantidade, motivo=None):
+    """Adiciona unidades a um lote existente de forma atômica; retorna a nova quantidade."""
+    _validar_quantidade(quantidade)
+    return executar_transacao(db, _adicionar, produto_id, quantidade, motivo)
+
+
+def gravar_no_catalogo(db, codigo_de_barras, dados):
+    """
+    Insere ou atualiza o produto no catálogo (dados com produto_nome, categoria, image_path).
+    Só escreve se algo mudou; o trigger trg_produtos_update repassa a mudança aos lotes do código.
+    """
+    db.execute('''
+        INSERT INTO produtos (codigo_de_barras, produto_nome, categoria, image_path) VALUES (?, ?, ?, ?)
+        ON CONFLICT(codigo_de_barras) DO UPDATE SET
+            produto_nome = excluded.produto_nome, categoria = excluded.categoria, image_path = excluded.image_path
+        WHERE produto_nome IS NOT excluded.produto_nome OR categoria IS NOT excluded.categoria
+           OR image_path IS NOT excluded.image_path
+    ''', (codigo_de_barras, dados['produto_nome'], dados['categoria'], dados['image_path']))
+
+
+def _registrar_entrada(db, codigo_de_barras, validade_int, validade_text, quantidade, dados):
+    existente = db.execute(SQL_LOTE_POR_VALIDADE_TEXTO, (codigo_de_barras, validade_text)).fetchone()
+
+    if dados is None:
+        # Modo rápido: dados do catálogo (chave primária, em cache; existe mesmo sem estoque do código)
+        produto = produto_do_catalogo(db, codigo_de_barras)
+        if produto is None:
+            raise ProdutoNaoEncontrado('Produto não encontrado')
+        dados = dict(produto, lote=existente['lote'] if existente else '')
+        invalidar_codigos(codigo_de_barras)
+    else:
+        invalidar_codigos(codigo_de_barras)
+        gravar_no_catalogo(db, codigo_de_barras, dados)
+
+    if existente:
+        produto_id = existente['id']
+        db.execute('''
+            UPDATE estoque
+            SET quantidade = quantidade + ?, validade_int = ?, validade_text = ?, categoria = ?, produto_nome = ?, image_path = ?, lote = ?
+            WHERE id = ?
+        ''', (quantidade, validade_int, validade_text, dados['categoria'], dados['produto_nome'],
+              dados['image_path'], dados['lote'], produto_id))
+        nova_quantidade = db.execute('SELECT quantidade FROM estoque WHERE id = ?', (produto_id,)).fetchone()[0]
+    else:
+        cursor = db.execute('''
+            INSERT INTO estoque (codigo_de_barras, lote, validade_int, validade_text, produto_nome, quantidade, categoria, image_path)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (codigo_de_barras, dados['lote'], validade_int, validade_text, dados['produto_nome'],
+              quantidade, dados['categoria'], dados['image_path']))
+        produto_id = cursor.lastrowid
+        nova_quantidade = quantidade
+
+    _registrar_movimentacao(db, produto_id, codigo_de_barras, dados['produto_nome'], 'entrada', quantidade, None)
+    return {
+        'produto_id': produto_id,
+        'produto_nome': dados['produto_nome'],
+        'nova_quantidade': nova_quantidade,
+        'novo_lote': existente is None,
+    }
+
+
+def registrar_entrada(db, codigo_de_barras, validade_int, validade_text, quantidade, dados=None):
+    """
+    Entrada de estoque por código de barras + validade: soma no lote existente ou cria um novo.
+    dados = {produto_nome, lote, categoria, image_path}, gravados também no catálogo de produtos
+    (vale para todos os lotes do código); None no modo rápido (usa o catálogo).
+    """
+    _validar_quantidade(quantidade)
+    return executar_transacao(db, _registrar_entrada, codigo_de_barras, validade_int, validade_text, quantidade, dados)
+
+
+def _apagar_lote_zerado(db, tamanho):
+    cursor = db.execute('''
+        DELETE FROM estoque WHERE id IN (
+            SELECT id FROM estoque WHERE quantidade <= 0 LIMIT ?
+        )
+    ''', (tamanho,))
+    if cursor.rowcount:
+        # Os códigos apagados não são conhecidos aqui: esvazia o cache inteiro
+        invalidar_codigos(None)
+    return cursor.rowcount
+
+
+def varrer_estoque_zerado(db, tamanho=TAMANHO_LOTE_VARREDURA):
+    """
+    Remove lotes com quantidade <= 0 que tenham escapado da limpeza na retirada
+    (dados antigos, edições manuais). Apaga em transações curtas de `tamanho`
+    linhas, pelo índice de quantidade, para não segurar o lock de escrita.
+    Retorna o total removido.
+    """
+    total = 0
+    inicio = time.monotonic()
+    while True:
+        apagados = executar_transacao(db, _apagar_lote_zerado, tamanho)
+        total += apagados
+        if apagados < tamanho:
+            break
+
+    with _lock_metricas:
+        METRICAS_LIMPEZA['varreduras'] += 1
+        METRICAS_LIMPEZA['removidos_na_varredura'] += total
+        METRICAS_LIMPEZA['ultima_varredura'] = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())
+    if total:
+        logger.info('Varredura de estoque zerado: %d lotes removidos em %.3fs', total, time.monotonic() - inicio)
+    else:
+        logger.debug('Varredura de estoque zerado: nada a remover')
+    return total
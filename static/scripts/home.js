@@ -13,14 +13,41 @@ document.addEventListener('DOMContentLoaded', () => {
     }
 
     if (searchInput) {
+        // Autocomplete: busca sugestões no servidor sem recarregar a página
+        const sugestoes = document.getElementById('sugestoesBusca');
+        let ultimaBusca = '';
         searchInput.addEventListener('input', debounce((e) => {
             const q = e.target.value.trim();
-            // Simples: atualiza query string e recarrega a página
+            if (!sugestoes || q.length < 2 || q === ultimaBusca) return;
+            ultimaBusca = q;
+            fetch(`/api/busca_produtos?q=${encodeURIComponent(q)}`)
+                .then(r => r.json())
+                .then(lista => {
+                    // Ignora respostas atrasadas de buscas anteriores
+                    if (q !== ultimaBusca) return;
+                    sugestoes.innerHTML = '';
+                    lista.forEach(p => {
+                        const opt = document.createElement('option');
+                        opt.value = p.produto_nome;
+                        opt.label = `${p.codigo_de_barras} — ${p.validade_text} (${p.quantidade})`;
+                        sugestoes.appendChild(opt);
+                    });
+                })
+                .catch(err => console.error('Erro ao buscar sugestões:', err));
+        }, 300));
+
+        // Ao enviar a busca, descarta o cursor de paginação
+        const form = searchInput.closest('form');
+        form && form.addEventListener('submit', (e) => {
+            e.preventDefault();
+            const q = searchInput.value.trim();
             const params = new URLSearchParams(window.location.search);
             if (q) params.set('q', q); else params.delete('q');
+            params.delete('after');
+            params.delete('before');
             params.set('page', 1);
             window.location.search = params.toString();
-        }, 400));
+        });
     }
 
     // Delegate clicks nos botões de ação
@@ -57,24 +84,14 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     });
 
-    // Paginação
+    // Paginação: os links já carregam o cursor (after/before) gerado pelo servidor
     const pagination = document.querySelector('.pagination');
     if (pagination) {
         pagination.addEventListener('click', (e) => {
-            const btn = e.target.closest('.page-btn');
-            if (!btn || btn.disabled) return;
-            
-            const isNext = btn.querySelector('.bi-chevron-right');
-            const params = new URLSearchParams(window.location.search);
-            let currentPage = parseInt(params.get('page') || '1');
-            
-            if (isNext) {
-                params.set('page', currentPage + 1);
-            } else {
-                params.set('page', Math.max(1, currentPage - 1));
+            const item = e.target.closest('.page-item');
+            if (item && item.classList.contains('disabled')) {
+                e.preventDefault();
             }
-            
-            window.location.search = params.toString();
         });
     }
 
@@ -114,14 +131,39 @@ document.addEventListener('DOMContentLoaded', () => {
                 }
             }
             
-            // Resetar para primeira página ao aplicar filtros
+            // Resetar para primeira página ao aplicar filtros (descarta o cursor)
+            params.delete('after');
+            params.delete('before');
             params.set('page', 1);
             
             window.location.search = params.toString();
         });
     });
+
+    // Atualizações ao vivo: outras estações retiram/adicionam e os cartões mudam sem recarregar
+    if (productsGrid && window.EventSource) {
+        const eventos = new EventSource('/api/eventos_estoque');
+        eventos.addEventListener('estoque', (e) => {
+            const dados = JSON.parse(e.data);
+            dados.lotes.forEach(lote => atualizarCartao(lote.id, lote.quantidade, lote.removido));
+        });
+        // A fila desta conexão transbordou no servidor: só recarregando para ter tudo certo
+        eventos.addEventListener('recarregar', () => window.location.reload());
+    }
 });
 
+// Atualiza a quantidade de um cartão da grade (ou remove o cartão se o lote saiu do estoque)
+function atualizarCartao(produtoId, quantidade, removido) {
+    const card = document.querySelector(`.product-card[data-id="${produtoId}"]`);
+    if (!card) return;
+    if (removido) {
+        card.parentElement.remove();
+        return;
+    }
+    const badge = card.querySelector('.quantity');
+    if (badge) badge.innerHTML = `<i class="bi bi-stack"></i> ${quantidade}`;
+}
+
 // Variáveis globais do modal
 let modalProdutoId = null;
 let modalEstoqueMax = 0;
@@ -305,7 +347,9 @@ function confirmarRetirada() {
     }).then(r => r.json())
     .then(json => {
         if (json.ok) {
-            window.location.reload();
+            // Atualiza o cartão no lugar (as outras estações recebem pelo fluxo de eventos)
+            atualizarCartao(modalProdutoId, json.new_quantity, json.new_quantity <= 0);
+            fecharModalRetirada();
         } else {
             alert(json.error || 'Erro ao retirar produto');
         }
@@ -458,7 +502,8 @@ function confirmarAdicao() {
     }).then(r => r.json())
     .then(json => {
         if (json.ok) {
-            window.location.reload();
+            atualizarCartao(modalAdicaoProdutoId, json.new_quantity, false);
+            fecharModalAdicao();
         } else {
             alert(json.error || 'Erro ao adicionar produto');
         }
@@ -596,6 +596,30 @@ TRANSLATIONS = {
         'pt': 'Movimentações Hoje',
         'es': 'Movimientos Hoy'
     },
+    'reorder_needed': {
+        'pt': 'Repor Estoque',
+        'es': 'Reponer Inventario'
+    },
+    'daily_consumption': {
+        'pt': 'Consumo/dia',
+        'es': 'Consumo/día'
+    },
+    'days_of_cover': {
+        'pt': 'Dias de Cobertura',
+        'es': 'Días de Cobertura'
+    },
+    'reorder_point': {
+        'pt': 'Ponto de Reposição',
+        'es': 'Punto de Reposición'
+    },
+    'waste_risk': {
+        'pt': 'Só lotes com risco de desperdício',
+        'es': 'Solo lotes con riesgo de desperdicio'
+    },
+    'predicted_waste': {
+        'pt': 'Perda prevista',
+        'es': 'Pérdida prevista'
+    },
 
     # ==================== ERROS/INSTRUÇÕES ESPECÍFICAS ====================
     'invalid_date': {
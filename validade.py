@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+Classificação de validade dos lotes
+O status (vencido / vence_urgente / vence_proximo / ok) é calculado pelo próprio
+SQLite com uma expressão CASE sobre validade_int e limites passados como
+parâmetros, então as linhas já chegam prontas para a home. Os limites só mudam
+à meia-noite e ficam em cache por dia.
+"""
+
+from collections import namedtuple
+from datetime import date, datetime, timedelta
+from functools import lru_cache
+
+# Dias a partir de hoje que definem "vence urgente" e "vence próximo"
+DIAS_URGENTE = 7
+DIAS_PROXIMO = 15
+
+# Timestamps (meia-noite local) de hoje, hoje + DIAS_URGENTE e hoje + DIAS_PROXIMO
+LimitesValidade = namedtuple('LimitesValidade', 'hoje urgente proximo')
+
+# Expressão de status; parâmetros na ordem de LimitesValidade
+EXPRESSAO_STATUS_VALIDADE = '''CASE
+    WHEN validade_int < ? THEN 'vencido'
+    WHEN validade_int < ? THEN 'vence_urgente'
+    WHEN validade_int < ? THEN 'vence_proximo'
+    ELSE 'ok'
+END'''
+
+
+def _meia_noite(dia):
+    return int(datetime.combine(dia, datetime.min.time()).timestamp())
+
+
+@lru_cache(maxsize=8)
+def _limites_do_dia(dia):
+    return LimitesValidade(
+        _meia_noite(dia),
+        _meia_noite(dia + timedelta(days=DIAS_URGENTE)),
+        _meia_noite(dia + timedelta(days=DIAS_PROXIMO)),
+    )
+
+
+def limites_validade(dia=None):
+    """Limites de classificação para o dia (hoje por padrão), em cache."""
+    return _limites_do_dia(dia or date.today())
+
+
+def selecao_com_status(colunas='*'):
+    """Lista de colunas para SELECT acrescida do status_validade (parâmetros: limites_validade())."""
+    return f'{colunas}, {EXPRESSAO_STATUS_VALIDADE} AS status_validade'
+
+
+# Parâmetros: hoje, hoje, urgente, urgente, proximo (ver contar_vencimentos_por_categoria)
+SQL_VENCIMENTOS_POR_CATEGORIA = '''
+    SELECT categoria,
+           SUM(validade_int < ?) AS vencido,
+           SUM(validade_int >= ? AND validade_int < ?) AS vence_urgente,
+           SUM(validade_int >= ?) AS vence_proximo,
+           SUM(quantidade) AS unidades
+    FROM estoque
+    WHERE validade_int < ?
+    GROUP BY +categoria
+    ORDER BY +categoria
+'''
+
+
+def contar_vencimentos_por_categoria(db, limites=None):
+    """
+    Lotes vencidos / vencendo em até DIAS_URGENTE / em até DIAS_PROXIMO dias, por categoria.
+    Só lê os lotes com validade_int < limite "próximo" (busca por faixa no índice de validade),
+    nunca a tabela inteira: o '+' em +categoria impede o planner de preferir percorrer o índice
+    (categoria, validade_int) inteiro só para evitar a ordenação do GROUP BY.
+    Retorna {categoria: {status: lotes, 'unidades': soma}}.
+    """
+    limites = limites or limites_validade()
+    resultado = {}
+    for row in db.execute(SQL_VENCIMENTOS_POR_CATEGORIA,
+                          (limites.hoje, limites.hoje, limites.urgente, limites.urgente, limites.proximo)):
+        resultado[row['categoria']] = {
+            'vencido': row['vencido'],
+            'vence_urgente': row['vence_urgente'],
+            'vence_proximo': row['vence_proximo'],
+            'unidades': row['unidades'] or 0,
+        }
+    return resultado